@@ -19,6 +19,7 @@ def request_storage(client: ContractInterface, amount: int):
 
 
 def free_storage(client: ContractInterface):
+    client.forget_reclaimed()
     print("Seleccione la entrada que desea liberar ")
     # Enumerate posibilities
     posibilities = list(enumerate(client.remoteStorage.items()))
@@ -41,6 +42,7 @@ def request_cpu(client: ContractInterface, amount: int):
     client.request_computing_power(amount)
 
 def free_cpu(client: ContractInterface):
+    client.forget_reclaimed()
     print("Seleccione la entrada que desea liberar ")
     # Enumerate posibilities
     posibilities = list(enumerate(client.remoteCPU.items()))
@@ -59,6 +61,7 @@ def free_cpu(client: ContractInterface):
     client.free_computing_power(id)
 
 def list_reservations(client: ContractInterface):
+    client.forget_reclaimed()
     print('Storage reservations:')
     print(client.remoteStorage)
 
@@ -66,6 +69,9 @@ def list_reservations(client: ContractInterface):
     print('CPU reservations:')
     print(client.remoteCPU)
 
+def renew_leases(client: ContractInterface):
+    client.renew_leases()
+
 def force_error(client: ContractInterface):
     client.force_error()
 
@@ -107,6 +113,7 @@ def menu():
     7) Listar reservas
     8) Force error
     9) Get balances
+    10) Renovar reservas
 
     """
     # Show the menu
@@ -144,6 +151,9 @@ def menu():
             force_error(client)
         elif choice == 9:
             get_balances(client)
+        # Renovar las reservas antes de que expiren
+        elif choice == 10:
+            renew_leases(client)
         else:
             print('Opción invalida')
 
@@ -172,6 +182,11 @@ def main():
 
 if __name__ == "__main__":
     try:
-        menu()
+        # python client.py --workload <workload.json> [results.json|results.csv]
+        if argv[1] == '--workload':
+            import workload
+            workload.main(*argv[2:4])
+        else:
+            menu()
     except KeyboardInterrupt:
         print('Exiting...')
@@ -0,0 +1,237 @@
+''' Simulator of a fleet of devices, to load test the server from a single process.
+
+Thousands of virtual devices run as asyncio tasks in one process. All of them
+share one w3 - and its pool of keep-alive connections - one contract object and
+one router of the server answers, so a single eth_getLogs scan serves every
+request in flight. Like the devices behind the proxy, the virtual devices only
+have an address: their transactions are sent by the sender account of the node.
+
+The fleet is described by a JSON file:
+
+    {
+        "node": "http://localhost:8545",
+        "sender": 5,
+        "devices": 1000,
+        "duration": 300,
+        "workers": 32,
+        "seed": 1,
+        "arrival": {"distribution": "exponential", "mean": 30},
+        "hold": {"distribution": "lognormal", "mean": 60, "sigma": 0.5},
+        "cpu_share": 0.3,
+        "storage": {"distribution": "uniform", "min": 10, "max": 500},
+        "cpu": {"distribution": "constant", "value": 5}
+    }
+
+Every device registers and then requests storage or cpu - cpu with probability
+"cpu_share" - with "arrival" seconds between two requests, holding every
+reservation it gets for "hold" seconds before freeing it. No new requests are
+made after "duration" seconds, and the simulation ends when all the
+reservations are freed. "workers" is the number of transactions sent at the
+same time. The distributions are constant (value), uniform (min, max),
+exponential (mean), normal (mean, sigma) and lognormal (mean, sigma).
+
+The node is a local ganache or any other development node where the contract
+has been deployed and the server is running. The latency of every operation is
+written like the results of a workload '''
+
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sys import argv
+from web3 import Web3
+
+import reservation_journal
+import workload
+from interface import ContractInterface
+from providers import make_provider, NODE_URI
+
+# Fields of every record of the results
+FIELDS = ('device', 'op', 'index', 'start', 'latency', 'ok', 'accepted', 'error')
+
+
+class Distribution:
+    ''' Random values of one of the distributions of the fleet file '''
+
+    def __init__(self, spec: dict, rng: random.Random):
+        self.spec = spec
+        self.rng = rng
+        kind = spec['distribution']
+        if kind not in ('constant', 'uniform', 'exponential', 'normal', 'lognormal'):
+            raise ValueError('Unknown distribution {}'.format(kind))
+
+    def sample(self):
+        spec = self.spec
+        kind = spec['distribution']
+        if kind == 'constant':
+            return spec['value']
+        if kind == 'uniform':
+            return self.rng.uniform(spec['min'], spec['max'])
+        if kind == 'exponential':
+            return self.rng.expovariate(1 / spec['mean'])
+        if kind == 'normal':
+            return max(0, self.rng.gauss(spec['mean'], spec['sigma']))
+        # Lognormal with the given mean
+        sigma = spec['sigma']
+        return self.rng.lognormvariate(math.log(spec['mean']) - sigma**2 / 2, sigma)
+
+
+class Fleet:
+    ''' Virtual devices sharing one connection to the node '''
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.rng = random.Random(config.get('seed'))
+
+        self.arrival = Distribution(config['arrival'], self.rng)
+        self.hold = Distribution(config['hold'], self.rng)
+        self.amounts = {'storage': Distribution(config['storage'], self.rng),
+                        'cpu': Distribution(config['cpu'], self.rng)}
+
+        self.w3 = Web3(make_provider(config.get('node', NODE_URI)))
+        self.w3.eth.defaultAccount = self.w3.eth.accounts[config.get('sender', 5)]
+
+        # Transactions are sent by these threads, as many as connections in the pool
+        self.executor = ThreadPoolExecutor(max_workers=config.get('workers', 32))
+
+        self.records = []
+        self.operations = 0
+
+        # The virtual devices keep their reservations in memory backed storage,
+        # deleted when the run ends, and each of them keeps its journal open
+        self.reservations_dir = tempfile.mkdtemp(
+            prefix='fleet-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        _raise_open_files_limit()
+
+        first = ContractInterface(account=self._new_address(), w3=self.w3,
+                                  ip_address=_ip_address(0), mac_address=_mac_address(0),
+                                  reservations_dir=self.reservations_dir)
+        self.devices = [first] + [
+            ContractInterface(account=self._new_address(), w3=self.w3, contract=first.contract,
+                              ip_address=_ip_address(n), mac_address=_mac_address(n),
+                              reservations_dir=self.reservations_dir)
+            for n in range(1, config['devices'])]
+        print('Created {} virtual devices'.format(len(self.devices)))
+
+    def run(self):
+        ''' Runs the simulation and returns the records of all the operations '''
+        started = time.time()
+        try:
+            asyncio.run(self._run())
+        finally:
+            self.executor.shutdown()
+            reservation_journal.close_journals(self.reservations_dir)
+            shutil.rmtree(self.reservations_dir, ignore_errors=True)
+
+        errors = sum(1 for record in self.records if not record['ok'])
+        print('Fleet of {} devices: {} operations, {} errors in {:.2f}s'.format(
+            len(self.devices), len(self.records), errors, time.time() - started))
+        return self.records
+
+    async def _run(self):
+        deadline = time.time() + self.config['duration']
+        await asyncio.gather(*(self._device(n, device, deadline)
+                               for n, device in enumerate(self.devices)))
+
+    async def _device(self, n: int, device: ContractInterface, deadline: float):
+        accepted = await self._measure(n, 'register', device.register_async)
+        if not accepted:
+            return
+
+        sessions = []
+        # Devices do not start all at the same time
+        await asyncio.sleep(self.rng.uniform(0, self.config['arrival'].get('mean', 1)))
+        while time.time() < deadline:
+            sessions.append(asyncio.ensure_future(self._session(n, device)))
+            await asyncio.sleep(self.arrival.sample())
+
+        if len(sessions) > 0:
+            await asyncio.gather(*sessions)
+
+    async def _session(self, n: int, device: ContractInterface):
+        ''' Requests a reservation, holds it and frees it '''
+        kind = 'cpu' if self.rng.random() < self.config.get('cpu_share', 0) else 'storage'
+        amount = max(1, int(round(self.amounts[kind].sample())))
+
+        if kind == 'storage':
+            request, free = device.request_storage_async, device.free_storage_async
+        else:
+            request, free = device.request_computing_power_async, device.free_computing_power_async
+
+        answer = {}
+        accepted = await self._measure(n, 'request_' + kind, request, amount, answer=answer)
+        if not accepted:
+            return
+
+        await asyncio.sleep(self.hold.sample())
+        await self._measure(n, 'free_' + kind, free, answer['grantID'])
+
+    async def _measure(self, n: int, op: str, function, *args, answer: dict = None):
+        ''' Sends an operation of a device and waits for its result. Returns whether
+        the server accepted it '''
+        loop = asyncio.get_event_loop()
+        record = {'device': n, 'op': op, 'index': self.operations, 'start': time.time(),
+                  'ok': True, 'accepted': None, 'error': None}
+        self.operations += 1
+
+        started = time.perf_counter()
+        try:
+            # The transaction is sent by a worker, the answer is resolved by the router
+            future = await loop.run_in_executor(self.executor, function, *args)
+            result = await asyncio.wait_for(asyncio.wrap_future(future), ContractInterface.ANSWER_TIMEOUT)
+            if 'accepted' in result:
+                record['accepted'] = result['accepted']
+                if answer is not None:
+                    answer.update(result)
+            else:
+                record['accepted'] = True
+        except Exception as error:
+            record['ok'] = False
+            record['error'] = repr(error)
+        record['latency'] = time.perf_counter() - started
+
+        self.records.append(record)
+        return record['ok'] and record['accepted']
+
+    def _new_address(self):
+        return Web3.toChecksumAddress('0x{:040x}'.format(self.rng.getrandbits(160)))
+
+
+def _ip_address(n: int):
+    return '10.{}.{}.{}'.format(n >> 16 & 255, n >> 8 & 255, n & 255)
+
+
+def _mac_address(n: int):
+    return '02:00:00:{:02x}:{:02x}:{:02x}'.format(n >> 16 & 255, n >> 8 & 255, n & 255)
+
+
+def _raise_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main(fleet_file: str, output_file: str = None):
+    with open(fleet_file, 'r') as f:
+        config = json.load(f)
+
+    records = Fleet(config).run()
+    for op, stats in workload.summarize(records).items():
+        print(op, json.dumps(stats))
+
+    if output_file is not None:
+        workload.write_results(records, output_file, FIELDS)
+
+
+if __name__ == "__main__":
+    # python fleet.py <fleet.json> [results.json|results.csv]
+    try:
+        main(*argv[1:3])
+    except KeyboardInterrupt:
+        print('Exiting...')
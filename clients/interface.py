@@ -1,23 +1,35 @@
 ''' This file acts as an interface between the python programming 
 language and the smart contract interface deployed on the blockchain '''
 
-from web3 import Web3, HTTPProvider
-from solc import compile_source
+from web3 import Web3
 from web3.contract import ConciseContract
-import time
+from web3.utils.events import get_event_data
+from eth_utils import event_abi_to_log_topic
 import utils
 import pickle
+import secrets
+from concurrent.futures import Future
 import os
 import os.path as path
+import sys
 
-''' This contract address should be a constant in the end of development,
-and stay in the blockchain '''
+# Modules shared by the clients and the server
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), '..', 'common'))
+from receipt_watcher import get_watcher
+import deployments
+import artifacts
+from providers import make_provider, NODE_URI
+from response_router import get_router
+from reservation_journal import get_journal, STORAGE, CPU
+from view_cache import get_view_cache
+
+''' Address of the contract used when it is not in the deployment registry,
+which is where the server records the contract it deploys '''
 
 CONTRACT_ADDRESS = "0x1f24b48b2999d6ff6ce642581074A350e104563E"
+# Reservations of every account written before the reservation journal, moved into it
 RESERVATIONS_PICKLE_FILE = os.path.dirname(
     os.path.abspath(__file__)) + "/reservations.pickle"
-ADDRESS_PICKLE_FILE = os.path.dirname(
-    os.path.abspath(__file__)) + "/address.pickle"
 
 
 class ContractInterface:
@@ -29,23 +41,27 @@ class ContractInterface:
     contract functions from the client side
     '''
 
-    CONTRACT_PATH = path.dirname(path.abspath(__file__)) + "/../contracts/token.sol"
-    COMPILED_CONTRACT_PATH = path.dirname(path.abspath(__file__)) + "/../contracts/contract_compiled.pickle"
+    # Seconds to wait for an answer of the server
+    ANSWER_TIMEOUT = 120
 
     # Client number is only for tests
     def __init__(self,  account=None, ip_address=None, mac_address=None,
-                 w3=None, client_number: int = None):
+                 w3=None, client_number: int = None, contract=None, reservations_dir: str = None):
         ''' Default constructor of the interface class, with parameters
     that make the code much cleaner in our client API .
 
     For now the only parameter is the client number which identifies which of 
     the default accounts provided by ganache-cli the client sets as its default one
-    {1 - 9} since 0 is for the server and owner of the contract '''
+    {1 - 9} since 0 is for the server and owner of the contract.
+
+    Many interfaces sharing a w3 can share its contract object too, instead of
+    loading the contract once per interface. The reservations are journaled in
+    reservations_dir, by default the reservations directory of the client '''
 
         # In case there's no w3 given we initialize to the default server
         if w3 is None:
-            self.w3 = Web3(HTTPProvider("http://localhost:8545"))
-            #self.w3 = Web3(HTTPProvider("http://192.168.0.29:8545"))
+            self.w3 = Web3(make_provider(NODE_URI))
+            #self.w3 = Web3(make_provider("http://192.168.0.29:8545"))
         else:
             self.w3 = w3
 
@@ -57,14 +73,22 @@ class ContractInterface:
             self.IP = ip_address
             self.MAC = mac_address
 
-        self.contract = self._getContract(self.w3)
-        #self.contract = self._load_contract(self.w3)
+        # Receipt watcher shared by all the interfaces using this w3
+        self.receipts = get_watcher(self.w3)
+
+        self.contract = self._getContract(self.w3) if contract is None else contract
+
+        # Router of the server answers shared by all the interfaces using this w3
+        self.responses = get_router(self.w3, self.contract)
+
+        # View calls are cached until the next block
+        self.views = get_view_cache(self.w3, self.contract)
 
         # The ConciseContract class is much better for reaidng variables straight away.
         # If our goal is not transact something, we'll use the Concise version of the contract
         self.contractConcise = ConciseContract(self.contract)
 
-        # set the default account for the client, if it's None we'll register and we'll get a new one
+        # set the default account for the client, it's needed to register
         # Only for tests
         if client_number is not None:
             self.w3.eth.defaultAccount = self.w3.eth.accounts[client_number]
@@ -77,115 +101,67 @@ class ContractInterface:
 
         # DATA FOR LEASES:
 
+        # Journal where every reservation made or freed is recorded, so they
+        # survive a reboot of the service
+        self.reservations = get_journal(self.account, reservations_dir)
+        # The old pickle file was written by the client of this machine, not by the
+        # devices of a proxy or a fleet
+        self._load_reservations(migrate=reservations_dir is None and client_number is not None)
+
         # The dictionary is of the shape { grant_id : amount } so for the total memory we
         # just add the values
-        self.remoteStorage = {}
+        self.remoteStorage = self.reservations.reservations[STORAGE]
 
         # The dictionary is of the shape { grant_id : amount } where amount is a number from
         # 0 to 100. 100 would mean that the amount is equal to all the available storage on
         # the remote server
-        self.remoteCPU = {}
-
-        # Load the reservations
-        self._load_reservations()
+        self.remoteCPU = self.reservations.reservations[CPU]
 
     def register(self):
         ''' Registers the client in the server's contract, and sends the useful information
         so that the server can recognize each client '''
 
-        tx_hash = None
         print('Registering with', self.account)
 
-        # Regular register
-        tx_hash = self.contract.functions.register(
-            self.account, self.IP, self.MAC).transact()
-
-        self.w3.eth.waitForTransactionReceipt(tx_hash)
-
-        # build a listener so we can get the server's response
-        server_answer_filter = self.contract.events.RegisterResponse.createFilter(
-            fromBlock=0,
-            toBlock='latest',
-            argument_filters={
-                'account': self.account
-            })
-
-        print('Created filter to wait for server register response')
-        while True:
-            response = server_answer_filter.get_new_entries()
-            if len(response) != 0:
-                for grant in response:
-                    args = grant['args']
-                    if args['accepted']:
-                        print('Accepted request')
-                        # If we don't have an account we stablish it
-                        if self.account is None:
-                            self.account = args['account']
-                            self.w3.eth.defaultAccount = self.account
-                            self._pickle_address()
-                            print('Address pickled')
-                    else:
-                        print('Grant rejected')
-                break
-            else:
-                print('No answer yet')
-                time.sleep(1)
-
-        print('Balance after register:', self.contractConcise.balanceOf(
-            self.account), self.contractConcise.symbol())
-
-        del server_answer_filter
+        # Send the register and wait for the server's response
+        args = self.register_async().result(timeout=self.ANSWER_TIMEOUT)
+        if args['accepted']:
+            print('Accepted request')
+        else:
+            print('Grant rejected')
+
+        print('Balance after register:', self.views.call('balanceOf',
+            self.account), self.views.call('symbol'))
 
     def transfer(self, to: str, amount: int):
         ''' Transfers to the specified ethereum account (expressed
         as a hexadecimal string) the specified amount of IoT (tokens) '''
 
         print('Balances before: {}, {}'
-              .format(self.contractConcise.balanceOf(self.account), self.contractConcise.balanceOf(to)))
+              .format(self.views.call('balanceOf', self.account), self.views.call('balanceOf', to)))
         tx_hash = self.contract.functions.transfer(
             self.account, to, amount).transact()
-        self.w3.eth.waitForTransactionReceipt(tx_hash)
+        receipt = self.receipts.wait(tx_hash)
+
+        # Read the balances at the block of the transfer
+        self.views.invalidate(self.account, to)
+        self.views.observe_block(receipt.blockNumber)
         print('Balances after: {}, {}'
-              .format(self.contractConcise.balanceOf(self.account), self.contractConcise.balanceOf(to)))
+              .format(self.views.call('balanceOf', self.account), self.views.call('balanceOf', to)))
 
     def request_storage(self, amount: int):
         ''' Requests storage from the server '''
 
         print('Asking for {} for account {}'.format(amount, self.account))
 
-        tx_hash = self.contract.functions.getStorage(
-            self.account, amount).transact()
-        self.w3.eth.waitForTransactionReceipt(tx_hash)
-
-        # Wait for the storage grant and filter just the ones for us
-        petitionFilter = self.contract.events.StorageResponse.createFilter(
-            fromBlock=0,
-            toBlock='latest',
-            argument_filters={
-                'account': self.account
-            })
-        print('Created filter for storage grants')
-
-        while True:
-            response = petitionFilter.get_new_entries()
-            if len(response) != 0:
-                for grant in response:
-                    args = grant['args']
-                    if args['accepted']:
-                        print('Accepted request')
-                        self.remoteStorage[args['grantID']] = int(
-                            args['amount'])
-                        print('new dict:', self.remoteStorage)
-                    else:
-                        print('Grant rejected')
-                break
-            else:
-                print('No answer yet')
-                time.sleep(1)
-
-        # We no longer need the filter
-        del petitionFilter
-        self._update_reservations()
+        # Wait for the answer to this request. The answers are only looked
+        # for in the blocks mined since the request was sent
+        args = self.request_storage_async(amount).result(timeout=self.ANSWER_TIMEOUT)
+        if args['accepted']:
+            print('Accepted request')
+            print('new dict:', self.remoteStorage)
+        else:
+            print('Grant rejected')
 
     def free_storage(self, id):
         ''' Free the storage acquired from the server '''
@@ -193,50 +169,24 @@ class ContractInterface:
         print('Removing item with id=', id)
         tx_hash = self.contract.functions.freeStorage(
             self.account, id).transact()
-        self.w3.eth.waitForTransactionReceipt(tx_hash)
+        if self.receipts.wait(tx_hash).get('status', 1) == 0:
+            print('Could not free the storage, the transaction failed')
+            return
         print('freed storage')
-        # Pop the item
-        self.remoteStorage.pop(id)
-        self._update_reservations()
+        # Forget the item
+        self.reservations.remove(STORAGE, id)
 
     def request_computing_power(self, amount: int):
         """ Request computing power from the server """
         print('Asking for {}% of cpu for account {}'.format(amount, self.account))
 
-        # Transact and wait for the transaction receipt
-        tx_hash = self.contract.functions.getComputingPower(
-            self.account, amount).transact()
-        self.w3.eth.waitForTransactionReceipt(tx_hash)
-
-        # Filter the answers to get if our request was granted
-        petition_filter = self.contract.events.CPUResponse.createFilter(
-            fromBlock=0,
-            toBlock='latest',
-            argument_filters={
-                'account': self.account
-            })
-
-        print('Created computing power filter for account', self.account)
-
-        # Wait for our response
-        while True:
-            response = petition_filter.get_new_entries()
-            if len(response) != 0:
-                for answer in response:
-                    args = answer['args']
-                    if args['accepted']:
-                        print('Our computing power request was granted')
-                        self.remoteCPU[args['grantID']] = int(args['amount'])
-                        print('New dict: ', self.remoteCPU)
-                    else:
-                        print('Grant rejected')
-                break
-            else:
-                print('No answer to cpu request yet')
-                time.sleep(1)
-
-        del petition_filter
-        self._update_reservations()
+        # Wait for the answer to this request to get if it was granted
+        args = self.request_computing_power_async(amount).result(timeout=self.ANSWER_TIMEOUT)
+        if args['accepted']:
+            print('Our computing power request was granted')
+            print('New dict: ', self.remoteCPU)
+        else:
+            print('Grant rejected')
 
     def free_computing_power(self, id):
         ''' Free the cpu reservation '''
@@ -244,73 +194,210 @@ class ContractInterface:
         print('Removing cpu reservation with id', id)
         tx_hash = self.contract.functions.freeComputingPower(
             self.account, id).transact()
-        self.w3.eth.waitForTransactionReceipt(tx_hash)
+        if self.receipts.wait(tx_hash).get('status', 1) == 0:
+            print('Could not free the cpu, the transaction failed')
+            return
         print('Freed cpu storage')
-        # Pop item
-        self.remoteCPU.pop(id)
-        self._update_reservations()
+        # Forget item
+        self.reservations.remove(CPU, id)
+
+    # NON BLOCKING API: every call sends its transaction and returns a future
+    # right away, so many requests can be in flight at the same time
+
+    def register_async(self) -> Future:
+        ''' Registers the client. The future holds the args of the server's answer '''
+        if self.account is None:
+            # The contract registers a given address, it does not hand out new ones
+            raise ValueError('An account is needed to register, give one or a client number')
+        answer = self.responses.expect('RegisterResponse', self.account)
+        try:
+            self.contract.functions.register(
+                self.account, self.IP, self.MAC).transact()
+        except Exception:
+            self.responses.forget('RegisterResponse', self.account)
+            raise
+        return _then(answer, lambda entry: entry['args'])
+
+    def request_storage_async(self, amount: int) -> Future:
+        ''' Requests storage. The future holds the args of the server's answer,
+        and the reservation is recorded when it's accepted '''
+        return self._request_async('getStorage', 'StorageResponse', STORAGE, amount)
+
+    def request_computing_power_async(self, amount: int) -> Future:
+        ''' Requests computing power. The future holds the args of the server's answer,
+        and the reservation is recorded when it's accepted '''
+        return self._request_async('getComputingPower', 'CPUResponse', CPU, amount)
+
+    def free_storage_async(self, id) -> Future:
+        ''' Frees a storage reservation. The future holds the transaction receipt '''
+        return self._free_async('freeStorage', STORAGE, id)
+
+    def free_computing_power_async(self, id) -> Future:
+        ''' Frees a cpu reservation. The future holds the transaction receipt '''
+        return self._free_async('freeComputingPower', CPU, id)
+
+    def _request_async(self, function: str, response_event: str, kind: str, amount: int):
+        request_id = self._new_request_id()
+        answer = self.responses.expect(response_event, self.account, request_id)
+        try:
+            tx_hash = getattr(self.contract.functions, function)(
+                self.account, amount, request_id).transact()
+        except Exception:
+            self.responses.forget(response_event, self.account, request_id)
+            raise
+
+        def record(entry):
+            args = entry['args']
+            if args['accepted']:
+                self.reservations.add(kind, args['grantID'], args['amount'])
+                if self.reservations.reclaims_block is None:
+                    # No lease of the account can be reclaimed before its first grant
+                    self.reservations.set_reclaims_block(entry['blockNumber'])
+            return args
+
+        result = _then(answer, record)
+
+        # If the contract rejects the request the server will never answer it
+        def check(receipt):
+            if receipt.get('status', 1) == 0 and not result.done():
+                self.responses.forget(response_event, self.account, request_id)
+                result.set_exception(ValueError('{} transaction {} failed'.format(
+                    function, Web3.toHex(tx_hash))))
+
+        self.receipts.watch(tx_hash).add_done_callback(
+            lambda f: f.exception() is None and check(f.result()))
+
+        return result
+
+    def _free_async(self, function: str, kind: str, id):
+        tx_hash = getattr(self.contract.functions, function)(self.account, id).transact()
+
+        def forget(receipt):
+            # A reverted free leaves the reservation in place
+            if receipt.get('status', 1) == 0:
+                raise ValueError('{} transaction {} failed'.format(function, Web3.toHex(tx_hash)))
+            self.reservations.remove(kind, id)
+            return receipt
+
+        return _then(self.receipts.watch(tx_hash), forget)
+
+    def renew_lease(self, id):
+        ''' Renews the lease of a reservation so the server does not reclaim it '''
+
+        if id in self.forget_reclaimed():
+            return
+        tx_hash = self.contract.functions.renewLease(
+            self.account, id).transact()
+        self.receipts.wait(tx_hash)
+        print('Renewed lease of reservation', id)
+
+    def renew_leases(self):
+        ''' Renews the leases of all the reservations of the client. All the
+        transactions are sent first and then their receipts are awaited together '''
+
+        self.forget_reclaimed()
+        tx_hashes = [self.contract.functions.renewLease(self.account, id).transact()
+                     for id in list(self.remoteStorage) + list(self.remoteCPU)]
+        for tx_hash in tx_hashes:
+            self.receipts.wait(tx_hash)
+        print('Renewed {} leases'.format(len(tx_hashes)))
+
+    def forget_reclaimed(self):
+        ''' Forgets the reservations the server took back because their lease
+        expired, telling which ones. Returns their ids '''
+
+        abi = next((abi for abi in self.contract.abi
+                    if abi['type'] == 'event' and abi['name'] == 'LeaseExpired'), None)
+        if abi is None:
+            # Contract deployed before leases could expire
+            return []
+
+        latest = self.w3.eth.blockNumber
+        # The journal keeps where the last look ended, or the block of the first grant.
+        # Without reservations there is nothing to look for, and the ones journaled
+        # by older versions may have been reclaimed at any block
+        start = self.reservations.reclaims_block
+        if len(self.remoteStorage) + len(self.remoteCPU) == 0:
+            logs = []
+        else:
+            logs = self.w3.eth.getLogs({
+                'address': self.contract.address,
+                'fromBlock': 0 if start is None else start,
+                'toBlock': latest,
+                'topics': [Web3.toHex(event_abi_to_log_topic(abi)),
+                           '0x' + self.account[2:].lower().rjust(64, '0')]})
+        if start is None or latest + 1 > start:
+            self.reservations.set_reclaims_block(latest + 1)
+
+        reclaimed = []
+        for log in logs:
+            id = get_event_data(abi, log)['args']['grantID']
+            for kind, reservations in ((STORAGE, self.remoteStorage), (CPU, self.remoteCPU)):
+                if id in reservations:
+                    self.reservations.remove(kind, id)
+                    reclaimed.append(id)
+                    print('The lease of reservation {} expired and the server reclaimed it'.format(id))
+        return reclaimed
 
     def force_error(self):
         """ Method to test whether the onlyOwner modifier works properly """
         print('Trying to force an error')
         tx_hash = self.contract.functions._freeStorage(
             self.account, 500).transact()
-        self.w3.eth.waitForTransactionReceipt(tx_hash)
+        self.receipts.wait(tx_hash)
         print('Received transaction hash')
 
-    def _pickle_address(self):
-        """ Saves the device's address in a pickle file """
-        with open(ADDRESS_PICKLE_FILE, 'wb') as pickle_file:
-            # dump the address
-            pickle.dump(self.account, pickle_file)
-
-    def _unpickle_address(self):
-        """ Gets this device's address from the file """
-        if os.path.exists(ADDRESS_PICKLE_FILE):
-            with open(ADDRESS_PICKLE_FILE, 'rb') as pickle_file:
-                self.account = pickle.load(pickle_file)
-                self.w3.eth.defaultAccount = self.account
-
-                #self.w3.eth.defaultAccount = self.w3.eth.accounts[client_number]
-                #self.account = self.w3.eth.defaultAccount
-
-    def _update_reservations(self):
-        """ Updates the reservations in the pickle file after a reservation is made or freed """
-        with open(RESERVATIONS_PICKLE_FILE, 'wb') as pickle_file:
-            # save the dictionaries
-            pickle.dump(self.remoteStorage, pickle_file)
-            pickle.dump(self.remoteCPU, pickle_file)
-
-    def _load_reservations(self):
-        """ Use pickle to load the remote storage and computing power reservations. 
-        This way we make them persistent in case of a reboot of the service. The variables
-        inside the pickle file keep the same name """
-        if os.path.exists(RESERVATIONS_PICKLE_FILE):
+    @staticmethod
+    def _new_request_id():
+        """ Random id of a request, echoed by the server in its answer so the
+        answer can be told apart from the ones to other requests """
+        return secrets.randbits(64)
 
+    def _load_reservations(self, migrate: bool):
+        """ Shows the reservations restored from the journal. If asked to, the reservations
+        of the old pickle file, written before the journal existed, are moved into the journal """
+        if migrate and os.path.exists(RESERVATIONS_PICKLE_FILE):
             with open(RESERVATIONS_PICKLE_FILE, 'rb') as pickle_file:
                 # restore the dictionaries
-                self.remoteStorage = pickle.load(pickle_file)
-                self.remoteCPU = pickle.load(pickle_file)
-
-            print('Restored storage reservations:\n', self.remoteStorage)
-            print('Restored cpu reservations:\n', self.remoteCPU)
-    
-    def _load_contract(self, w3:Web3):
-        with open(self.COMPILED_CONTRACT_PATH, 'rb') as pickle_file:
-            interface = pickle.load(pickle_file)
-            contract = w3.eth.contract(
-                abi=interface['abi'],
-                address=CONTRACT_ADDRESS)
-            return contract
-
+                for kind in (STORAGE, CPU):
+                    for id, amount in pickle.load(pickle_file).items():
+                        self.reservations.add(kind, id, amount)
+            os.rename(RESERVATIONS_PICKLE_FILE, RESERVATIONS_PICKLE_FILE + '.migrated')
+
+        if self.reservations.records > 0:
+            print('Restored storage reservations:\n', self.reservations.reservations[STORAGE])
+            print('Restored cpu reservations:\n', self.reservations.reservations[CPU])
+
+    def _load_contract(self, w3: Web3):
+        """ Returns the contract at CONTRACT_ADDRESS with the ABI of the compiled
+        artifact of the contract source. solc is only needed if it was never compiled """
+        interface = artifacts.load_contract('IoToken') or artifacts.compile_contract('IoToken')
+        return w3.eth.contract(
+            abi=interface['abi'],
+            address=CONTRACT_ADDRESS)
 
     def _getContract(self, w3: Web3):
-        with open(self.CONTRACT_PATH, "r") as contract_file:
-            global CONTRACT_ADDRESS
-            source_code = contract_file.read()
-            compiled = compile_source(source_code)
-            interface = compiled['<stdin>:IoToken']
-            contract = w3.eth.contract(
-                abi=interface['abi'],
-                address=CONTRACT_ADDRESS)
-            return contract
+        """ Returns the contract registered by the server for this network. If
+        it's not registered, uses the one at CONTRACT_ADDRESS """
+        deployment = deployments.load(w3)
+        if deployment is not None:
+            return w3.eth.contract(
+                abi=deployment['abi'],
+                address=Web3.toChecksumAddress(deployment['address']))
+
+        return self._load_contract(w3)
+
+
+def _then(future: Future, function) -> Future:
+    """ Returns a future holding the result of applying the function to
+    the result of the given future, once it's done """
+    result = Future()
+
+    def done(f):
+        try:
+            result.set_result(function(f.result()))
+        except Exception as error:
+            result.set_exception(error)
+
+    future.add_done_callback(done)
+    return result
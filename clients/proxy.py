@@ -2,8 +2,7 @@
 
 # Special imports
 from scapy.all import *
-from web3 import Web3, HTTPProvider
-from solc import compile_source
+from web3 import Web3
 
 # Common imports
 import os.path as path
@@ -21,6 +20,7 @@ import sqlite3
 # The proxy will have to use the contract interface as it will perform 
 # the operations on behalf of the users
 from interface import ContractInterface as Client
+from providers import make_provider, NODE_URI
 
 
 class Proxy:
@@ -35,7 +35,7 @@ class Proxy:
         self._initialize_database()
 
         # Initialize sniffer with our function
-        self.w3 = Web3(HTTPProvider('http://localhost:8545'))
+        self.w3 = Web3(make_provider(NODE_URI))
         # Cambiar esto
         self.w3.eth.defaultAccount = self.w3.eth.accounts[5]
         self.account = self.w3.eth.defaultAccount
@@ -0,0 +1,201 @@
+''' Append-only journal of the reservations of an account.
+
+Every reservation made or freed is appended as one line to the journal of its
+account, in clients/reservations/<account>.journal, instead of rewriting all the
+reservations after every operation. Each line carries the checksum of its record,
+so a line only half written when the device crashed is detected and dropped when
+the journal is loaded again. The journal also keeps the block from which the leases
+of the account reclaimed by the server have to be looked for.
+
+Appends of concurrent threads share their fsync: a thread whose line has already
+been synced by another one returns right away. When the journal holds many more
+records than live reservations it is compacted into a new file with one record
+per reservation, which replaces the old one atomically '''
+
+import json
+import os
+import threading
+import zlib
+
+RESERVATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reservations')
+
+# Kinds of reservations kept by the journal
+STORAGE = 'storage'
+CPU = 'cpu'
+
+
+class ReservationJournal:
+    ''' Reservations of an account, of the shape { kind : { grant_id : amount } } '''
+
+    # The journal is compacted when it has more records than this and more than
+    # twice the number of live reservations
+    COMPACT_MIN_RECORDS = 1000
+
+    def __init__(self, path: str):
+        self.path = path
+        self.reservations = {STORAGE: {}, CPU: {}}
+        # Next block where the leases reclaimed by the server are looked for,
+        # None if they were never looked for
+        self.reclaims_block = None
+
+        # Number of records in the file, appended and made durable
+        self.records = 0
+        self.written = 0
+        self.synced = 0
+
+        # The sync lock is always taken before the lock
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._load()
+        self.file = open(path, 'ab')
+
+    def add(self, kind: str, grant_id: str, amount: int):
+        ''' Records a granted reservation '''
+        self._append({'op': 'add', 'kind': kind, 'id': grant_id, 'amount': int(amount)})
+
+    def remove(self, kind: str, grant_id: str):
+        ''' Records a freed reservation '''
+        self._append({'op': 'remove', 'kind': kind, 'id': grant_id})
+
+    def set_reclaims_block(self, block: int):
+        ''' Records the next block where the reclaimed leases are looked for '''
+        self._append({'op': 'reclaims', 'block': int(block)})
+
+    def compact(self):
+        ''' Rewrites the journal with one record per live reservation '''
+        with self.sync_lock, self.lock:
+            temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(temporary, 'wb') as f:
+                for kind, reservations in self.reservations.items():
+                    for grant_id, amount in reservations.items():
+                        f.write(_encode({'op': 'add', 'kind': kind, 'id': grant_id, 'amount': amount}))
+                if self.reclaims_block is not None:
+                    f.write(_encode({'op': 'reclaims', 'block': self.reclaims_block}))
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.file.close()
+            os.replace(temporary, self.path)
+            _fsync_directory(os.path.dirname(self.path))
+            self.file = open(self.path, 'ab')
+
+            self.records = sum(len(reservations) for reservations in self.reservations.values()) + \
+                (self.reclaims_block is not None)
+            self.synced = self.written
+
+    def close(self):
+        with self.sync_lock, self.lock:
+            self.file.close()
+
+    def _append(self, record: dict):
+        with self.lock:
+            self._apply(record)
+            self.file.write(_encode(record))
+            self.file.flush()
+            self.records += 1
+            self.written += 1
+            position = self.written
+
+        self._sync(position)
+
+        if self._needs_compaction():
+            self.compact()
+
+    def _sync(self, position: int):
+        # Only one thread syncs at a time, and its fsync covers the lines of
+        # all the threads that appended before it
+        with self.sync_lock:
+            if self.synced >= position:
+                return
+            with self.lock:
+                target = self.written
+            os.fsync(self.file.fileno())
+            self.synced = target
+
+    def _needs_compaction(self):
+        with self.lock:
+            live = sum(len(reservations) for reservations in self.reservations.values())
+            return self.records > max(self.COMPACT_MIN_RECORDS, 2*live)
+
+    def _apply(self, record: dict):
+        if record['op'] == 'reclaims':
+            self.reclaims_block = record['block']
+            return
+        reservations = self.reservations.setdefault(record['kind'], {})
+        if record['op'] == 'add':
+            reservations[record['id']] = record['amount']
+        else:
+            reservations.pop(record['id'], None)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        valid = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                record = _decode(line)
+                if record is None:
+                    # Crashed in the middle of this write, nothing after it was synced
+                    break
+                self._apply(record)
+                self.records += 1
+                valid += len(line)
+
+        if valid < os.path.getsize(self.path):
+            print('Dropping the incomplete end of the reservation journal', self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid)
+                os.fsync(f.fileno())
+
+
+def _encode(record: dict):
+    data = json.dumps(record, sort_keys=True).encode('utf-8')
+    return '{:08x} '.format(zlib.crc32(data)).encode('utf-8') + data + b'\n'
+
+
+def _decode(line: bytes):
+    ''' Record of a journal line, None if the line is incomplete or corrupted '''
+    if not line.endswith(b'\n') or len(line) < 10:
+        return None
+    checksum, data = line[:8], line[9:-1]
+    try:
+        if int(checksum, 16) != zlib.crc32(data):
+            return None
+        return json.loads(data.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def _fsync_directory(directory: str):
+    # Makes the rename of the compacted journal durable
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Journals of this process, of the shape { path : journal }
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def get_journal(account: str, directory: str = None) -> ReservationJournal:
+    ''' Returns the journal shared by all the interfaces of the account in this process,
+    kept in the given directory or in RESERVATIONS_DIR '''
+    path = os.path.join(RESERVATIONS_DIR if directory is None else directory,
+                        ('default' if account is None else account.lower()) + '.journal')
+    with _journals_lock:
+        if path not in _journals:
+            _journals[path] = ReservationJournal(path)
+        return _journals[path]
+
+
+def close_journals(directory: str):
+    ''' Closes and forgets the journals kept in the given directory '''
+    with _journals_lock:
+        for path in [path for path in _journals if os.path.dirname(path) == directory]:
+            _journals.pop(path).close()
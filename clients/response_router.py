@@ -0,0 +1,135 @@
+''' Router of the server answers shared by all the interfaces of a process.
+
+Instead of one filter per request, the router pulls the logs of all the response
+events of the contract with a single eth_getLogs call per scan and resolves the
+future of the request each of them answers. Dozens of requests in flight - from
+one device or from all the devices behind a proxy - cost the same as one '''
+
+import threading
+import time
+from concurrent.futures import Future
+from web3 import Web3
+from web3.utils.events import get_event_data
+from eth_utils import event_abi_to_log_topic
+
+
+class ResponseRouter:
+    ''' Resolves the futures of the requests as their answers are mined '''
+
+    # Events with the answers of the server
+    RESPONSE_EVENTS = ('RegisterResponse', 'StorageResponse', 'CPUResponse',
+                       'BandwidthResponse', 'MemoryResponse')
+
+    # Seconds between checks for new blocks. The interval is reset to the minimum
+    # every time a block is mined and doubles while no new block shows up
+    MIN_POLL_INTERVAL = 0.05
+    MAX_POLL_INTERVAL = 1
+
+    def __init__(self, w3: Web3, contract):
+        self.w3 = w3
+        self.contract = contract
+
+        # Response event abis indexed by their topic, of the shape { topic : abi }
+        self.event_abis = {
+            Web3.toHex(event_abi_to_log_topic(abi)): abi
+            for abi in contract.abi
+            if abi['type'] == 'event' and abi['name'] in self.RESPONSE_EVENTS}
+
+        # Futures of the pending requests, of the shape
+        # { (event name, account, request id) : Future }
+        self.futures = {}
+        self.lock = threading.Lock()
+
+        # Next block to scan
+        self.next_block = None
+        self.thread = None
+
+    def expect(self, event_name: str, account: str, request_id: int = None) -> Future:
+        ''' Returns a future that will hold the entry answering the request.
+        It must be called before the request is sent, so the answer is not missed '''
+        key = _key(event_name, account, request_id)
+
+        # Blocks are scanned from the first request onwards
+        first_block = self.w3.eth.blockNumber if self.next_block is None else None
+
+        with self.lock:
+            if self.next_block is None:
+                self.next_block = first_block
+            if key in self.futures:
+                return self.futures[key]
+            future = Future()
+            self.futures[key] = future
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._route_forever, daemon=True)
+                self.thread.start()
+
+        return future
+
+    def forget(self, event_name: str, account: str, request_id: int = None):
+        ''' Stops waiting for an answer, e.g. because the request failed '''
+        with self.lock:
+            self.futures.pop(_key(event_name, account, request_id), None)
+
+    def _route_forever(self):
+        interval = self.MIN_POLL_INTERVAL
+        while True:
+            try:
+                new_blocks = self._scan()
+            except Exception as error:
+                print('Error scanning for server answers: {}'.format(error))
+                new_blocks = False
+
+            interval = self.MIN_POLL_INTERVAL if new_blocks else min(2*interval, self.MAX_POLL_INTERVAL)
+            time.sleep(interval)
+
+    def _scan(self):
+        ''' Routes the answers mined since the last scan. Returns whether there were new blocks '''
+        latest = self.w3.eth.blockNumber
+        if self.next_block > latest:
+            return False
+
+        with self.lock:
+            idle = len(self.futures) == 0
+        if idle:
+            # Nobody is waiting for the answers mined in the meantime
+            self.next_block = latest + 1
+            return True
+
+        logs = self.w3.eth.getLogs({
+            'address': self.contract.address,
+            'fromBlock': self.next_block,
+            'toBlock': latest,
+            'topics': [list(self.event_abis.keys())]})
+
+        for log in logs:
+            abi = self.event_abis[Web3.toHex(log['topics'][0])]
+            entry = get_event_data(abi, log)
+            args = entry['args']
+            with self.lock:
+                future = self.futures.pop(
+                    _key(abi['name'], args['account'], args.get('requestId')), None)
+            if future is not None and not future.done():
+                future.set_result(entry)
+
+        self.next_block = latest + 1
+        return True
+
+
+def _key(event_name: str, account: str, request_id):
+    # Accounts are compared case insensitively, they may come checksummed or not
+    return (event_name, account.lower(), None if request_id is None else int(request_id))
+
+
+# Routers of this process, of the shape { (id(w3), contract address) : router }
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(w3: Web3, contract) -> ResponseRouter:
+    ''' Returns the router shared by everyone using the same w3 and contract in this process '''
+    with _routers_lock:
+        key = (id(w3), contract.address)
+        if key not in _routers:
+            _routers[key] = ResponseRouter(w3, contract)
+        return _routers[key]
@@ -0,0 +1,126 @@
+""" Tests of the reservation journal. Run from this directory with python -m unittest test_reservation_journal """
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import reservation_journal
+from reservation_journal import ReservationJournal, STORAGE, CPU
+
+
+class ReservationJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'account.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopen(self, journal: ReservationJournal):
+        journal.close()
+        return ReservationJournal(self.path)
+
+    def test_reservations_survive_a_reopen(self):
+        journal = ReservationJournal(self.path)
+        journal.add(STORAGE, 'a', 100)
+        journal.add(CPU, 'b', 5)
+        journal.add(STORAGE, 'c', 20)
+        journal.remove(STORAGE, 'a')
+        journal.set_reclaims_block(42)
+
+        journal = self.reopen(journal)
+        self.assertEqual(journal.reservations, {STORAGE: {'c': 20}, CPU: {'b': 5}})
+        self.assertEqual(journal.reclaims_block, 42)
+        self.assertEqual(journal.records, 5)
+        journal.close()
+
+    def test_an_incomplete_last_line_is_dropped(self):
+        journal = ReservationJournal(self.path)
+        journal.add(STORAGE, 'a', 100)
+        journal.close()
+        size = os.path.getsize(self.path)
+
+        # Crashed in the middle of the next write
+        with open(self.path, 'ab') as f:
+            f.write(reservation_journal._encode({'op': 'add', 'kind': CPU, 'id': 'b', 'amount': 5})[:-7])
+
+        journal = ReservationJournal(self.path)
+        self.assertEqual(journal.reservations, {STORAGE: {'a': 100}, CPU: {}})
+        self.assertEqual(os.path.getsize(self.path), size)
+
+        # The journal goes on after the good records
+        journal.add(CPU, 'c', 10)
+        journal = self.reopen(journal)
+        self.assertEqual(journal.reservations, {STORAGE: {'a': 100}, CPU: {'c': 10}})
+        journal.close()
+
+    def test_a_corrupted_line_and_the_ones_after_it_are_dropped(self):
+        journal = ReservationJournal(self.path)
+        journal.add(STORAGE, 'a', 100)
+        journal.add(STORAGE, 'b', 200)
+        journal.add(STORAGE, 'c', 300)
+        journal.close()
+
+        with open(self.path, 'rb') as f:
+            lines = f.readlines()
+        with open(self.path, 'wb') as f:
+            f.write(lines[0] + lines[1].replace(b'200', b'900') + lines[2])
+
+        journal = ReservationJournal(self.path)
+        self.assertEqual(journal.reservations[STORAGE], {'a': 100})
+        self.assertEqual(os.path.getsize(self.path), len(lines[0]))
+        journal.close()
+
+    def test_compaction_keeps_one_record_per_reservation(self):
+        journal = ReservationJournal(self.path)
+        journal.COMPACT_MIN_RECORDS = 10
+        journal.set_reclaims_block(7)
+        for n in range(20):
+            journal.add(STORAGE, str(n), n)
+            if n % 4 != 0:
+                journal.remove(STORAGE, str(n))
+
+        # Compacted every time the records outgrow the live reservations
+        self.assertLessEqual(journal.records, max(10, 2 * len(journal.reservations[STORAGE])) + 1)
+        journal.compact()
+        self.assertEqual(journal.records, 6)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(len(f.readlines()), 6)
+        journal = self.reopen(journal)
+        self.assertEqual(journal.reservations[STORAGE], {str(n): n for n in range(0, 20, 4)})
+        self.assertEqual(journal.reclaims_block, 7)
+        journal.close()
+
+    def test_concurrent_appends_are_all_written(self):
+        journal = ReservationJournal(self.path)
+
+        def append(worker: int):
+            for n in range(50):
+                journal.add(CPU, '{}-{}'.format(worker, n), n)
+
+        threads = [threading.Thread(target=append, args=(worker,)) for worker in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        journal = self.reopen(journal)
+        self.assertEqual(len(journal.reservations[CPU]), 200)
+        journal.close()
+
+    def test_journals_are_shared_per_account_and_directory(self):
+        journal = reservation_journal.get_journal('0xAB', self.directory)
+        self.assertIs(reservation_journal.get_journal('0xab', self.directory), journal)
+        self.assertEqual(journal.path, os.path.join(self.directory, '0xab.journal'))
+
+        reservation_journal.close_journals(self.directory)
+        self.assertIsNot(reservation_journal.get_journal('0xab', self.directory), journal)
+        reservation_journal.close_journals(self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+''' Scripted workloads for the client, to benchmark the server without the menu.
+
+A workload is a JSON file with the phases to run one after the other:
+
+    {
+        "client_number": 1,
+        "concurrency": 4,
+        "phases": [
+            {"op": "register"},
+            {"op": "request_storage", "amount": 100, "count": 50, "think_time": 0.1},
+            {"op": "request_cpu", "amount": 5, "count": 10, "concurrency": 10},
+            {"op": "transfer", "to": 2, "amount": 1, "count": 5},
+            {"op": "free_storage", "count": "all"},
+            {"op": "free_cpu", "count": "all"}
+        ]
+    }
+
+Each phase runs its operation "count" times, with "concurrency" of them in
+flight at the same time, every worker sleeping "think_time" seconds between
+two of its operations. The frees take the reservations of the client when the
+phase starts, "all" of them or just "count". "to" of a transfer is the index of
+a node account or an address.
+
+The latency of every operation is recorded and written as JSON - with a
+summary per operation - or CSV, depending on the extension of the output file '''
+
+import csv
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from interface import ContractInterface
+
+OPERATIONS = ('register', 'request_storage', 'request_cpu', 'free_storage', 'free_cpu', 'transfer')
+
+# Fields of every record of the results
+FIELDS = ('phase', 'op', 'index', 'start', 'latency', 'ok', 'accepted', 'error')
+
+
+def load_workload(path: str):
+    ''' Reads a workload file and checks its phases '''
+    with open(path, 'r') as f:
+        workload = json.load(f)
+
+    for phase in workload['phases']:
+        if phase.get('op') not in OPERATIONS:
+            raise ValueError('Unknown operation {} in workload {}'.format(phase.get('op'), path))
+    return workload
+
+
+def run_workload(client: ContractInterface, workload: dict):
+    ''' Runs all the phases of the workload with the client and returns the records
+    of all the operations '''
+    records = []
+    for number, phase in enumerate(workload['phases']):
+        started = time.time()
+        phase_records = _run_phase(client, number, phase, workload.get('concurrency', 1))
+        records.extend(phase_records)
+
+        errors = sum(1 for record in phase_records if not record['ok'])
+        print('Phase {} ({}): {} operations, {} errors in {:.2f}s'.format(
+            number, phase['op'], len(phase_records), errors, time.time() - started))
+    return records
+
+
+def summarize(records: list):
+    ''' Latency statistics of every operation, of the shape { op : stats } '''
+    summary = {}
+    for op in OPERATIONS:
+        latencies = sorted(record['latency'] for record in records if record['op'] == op and record['ok'])
+        total = sum(1 for record in records if record['op'] == op)
+        if total == 0:
+            continue
+
+        stats = {'count': total, 'errors': total - len(latencies)}
+        if len(latencies) > 0:
+            ops = [record for record in records if record['op'] == op]
+            elapsed = max(r['start'] + r['latency'] for r in ops) - min(r['start'] for r in ops)
+            stats.update({
+                'mean': sum(latencies) / len(latencies),
+                'p50': _percentile(latencies, 50),
+                'p95': _percentile(latencies, 95),
+                'p99': _percentile(latencies, 99),
+                'max': latencies[-1],
+                'throughput': len(latencies) / elapsed if elapsed > 0 else None})
+        summary[op] = stats
+    return summary
+
+
+def write_results(records: list, path: str, fields: tuple = FIELDS):
+    ''' Writes the records in CSV if the path ends in .csv, otherwise in JSON
+    together with their summary '''
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'summary': summarize(records), 'operations': records}, f, indent=2)
+    print('Wrote {} operations to {}'.format(len(records), path))
+
+
+def _run_phase(client: ContractInterface, number: int, phase: dict, concurrency: int):
+    op = phase['op']
+    count = phase.get('count', 1)
+    concurrency = phase.get('concurrency', concurrency)
+    think_time = phase.get('think_time', 0)
+
+    # The frees share the reservations there are when the phase starts
+    if op in ('free_storage', 'free_cpu'):
+        reservations = client.remoteStorage if op == 'free_storage' else client.remoteCPU
+        ids = list(reservations)
+        count = len(ids) if count == 'all' else min(count, len(ids))
+        ids = iter(ids[:count])
+    else:
+        ids = None
+
+    operation = _operation(client, phase, ids, threading.Lock())
+
+    def worker(indexes):
+        records = []
+        for index in indexes:
+            records.append(_measure(number, op, index, operation))
+            if think_time > 0:
+                time.sleep(think_time)
+        return records
+
+    # Every worker runs every concurrency-th operation
+    concurrency = max(1, min(concurrency, count))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = executor.map(worker, [range(w, count, concurrency) for w in range(concurrency)])
+        return sorted((record for records in results for record in records),
+                      key=lambda record: record['index'])
+
+
+def _operation(client: ContractInterface, phase: dict, ids, ids_lock):
+    ''' Function running one operation of the phase. It returns whether the server
+    accepted it, None if it does not need an answer of the server '''
+    op = phase['op']
+
+    if op == 'register':
+        return lambda: client.register_async().result(timeout=client.ANSWER_TIMEOUT)['accepted']
+    if op == 'request_storage':
+        return lambda: client.request_storage_async(phase['amount']).result(
+            timeout=client.ANSWER_TIMEOUT)['accepted']
+    if op == 'request_cpu':
+        return lambda: client.request_computing_power_async(phase['amount']).result(
+            timeout=client.ANSWER_TIMEOUT)['accepted']
+
+    if op == 'transfer':
+        to = phase['to']
+        to = client.w3.eth.accounts[to] if isinstance(to, int) else to
+        return lambda: client.transfer(to, phase['amount'])
+
+    free = client.free_storage_async if op == 'free_storage' else client.free_computing_power_async
+
+    def free_next():
+        with ids_lock:
+            id = next(ids)
+        free(id).result(timeout=client.ANSWER_TIMEOUT)
+    return free_next
+
+
+def _measure(number: int, op: str, index: int, operation):
+    record = {'phase': number, 'op': op, 'index': index, 'start': time.time(),
+              'ok': True, 'accepted': None, 'error': None}
+    started = time.perf_counter()
+    try:
+        record['accepted'] = operation()
+    except Exception as error:
+        record['ok'] = False
+        record['error'] = repr(error)
+    record['latency'] = time.perf_counter() - started
+    return record
+
+
+def _percentile(values: list, percentile: int):
+    # Nearest rank of the sorted values
+    rank = max(0, -(-len(values) * percentile // 100) - 1)
+    return values[rank]
+
+
+def main(workload_file: str, output_file: str = None):
+    workload = load_workload(workload_file)
+    client = ContractInterface(client_number=workload.get('client_number', 1))
+    print('Running workload', workload_file)
+
+    records = run_workload(client, workload)
+    for op, stats in summarize(records).items():
+        print(op, json.dumps(stats))
+
+    if output_file is not None:
+        write_results(records, output_file)
@@ -0,0 +1,73 @@
+''' Content addressed cache of the compiled contracts.
+
+The ABI and bytecode of every contract in a source file are stored in
+contracts/artifacts/<source hash>/<compiler hash>.json, so a source is compiled
+only once per compiler version, whatever the process that needs it: the server,
+the clients, the proxy or any tool.
+
+Loading an artifact only needs the source, so the clients and the proxy do not
+need solc installed as long as someone has compiled that source before '''
+
+import hashlib
+import json
+import os
+
+import deployments
+
+ARTIFACTS_DIR = os.path.join(deployments.CONTRACTS_DIR, 'artifacts')
+
+
+def compile_contract(name: str = 'IoToken', source: str = None):
+    ''' Returns the interface - abi and bin - of a contract of the source, compiling
+    it only if it has not been compiled with the installed compiler yet '''
+
+    # Only needed when compiling
+    from solc import compile_source, get_solc_version_string
+
+    source = deployments.read_source() if source is None else source
+    path = _artifact_path(deployments.source_hash(source), get_solc_version_string())
+
+    if not os.path.exists(path):
+        compiled = compile_source(source)
+        # The contracts are named '<stdin>:ContractName' by solc
+        _write(path, {key.split(':')[-1]: {'abi': interface['abi'], 'bin': interface['bin']}
+                      for key, interface in compiled.items()})
+        print('Compiled contracts of {} into {}'.format(deployments.source_hash(source), path))
+
+    return _read(path)[name]
+
+
+def load_contract(name: str = 'IoToken', source: str = None):
+    ''' Returns the interface of a contract of the source compiled by any compiler,
+    without needing solc. None if the source has never been compiled '''
+
+    source = deployments.read_source() if source is None else source
+    directory = os.path.join(ARTIFACTS_DIR, deployments.source_hash(source))
+    if not os.path.isdir(directory):
+        return None
+
+    # The most recently compiled artifact
+    artifacts = sorted((os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.json')),
+                       key=os.path.getmtime)
+    if len(artifacts) == 0:
+        return None
+    return _read(artifacts[-1]).get(name)
+
+
+def _artifact_path(source_hash: str, compiler_version: str):
+    compiler_hash = hashlib.sha256(compiler_version.encode('utf-8')).hexdigest()
+    return os.path.join(ARTIFACTS_DIR, source_hash, compiler_hash + '.json')
+
+
+def _read(path: str):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _write(path: str, artifact: dict):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so readers never see a half written artifact
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(artifact, f)
+    os.replace(temporary, path)
@@ -0,0 +1,70 @@
+''' Registry of the deployed contracts.
+
+Every deployment of the contract is recorded - address, ABI, hash of the source
+it was compiled from and block it was deployed in - in a JSON file next to the
+contract source, one entry per network. The server reattaches to the registered
+contract instead of deploying a new one on every start, and the clients read the
+address and ABI from it instead of having them hardcoded '''
+
+import hashlib
+import json
+import os
+from web3 import Web3
+
+CONTRACTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'contracts')
+
+# Source of the contract and registry of its deployments
+CONTRACT_SOURCE = os.path.join(CONTRACTS_DIR, 'token.sol')
+REGISTRY_FILE = os.path.join(CONTRACTS_DIR, 'deployments.json')
+
+
+def source_hash(source: str):
+    ''' Hash identifying a version of the contract source '''
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def read_source(path: str = CONTRACT_SOURCE):
+    with open(path, 'r') as source_file:
+        return source_file.read()
+
+
+def network_id(w3: Web3):
+    return str(w3.version.network)
+
+
+def load(w3: Web3, registry_file: str = REGISTRY_FILE):
+    ''' Returns the deployment registered for the network of w3, None if there is none.
+    Deployments are of the shape { address, abi, source_hash, block_number } '''
+    try:
+        with open(registry_file, 'r') as f:
+            registry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return registry.get(network_id(w3))
+
+
+def record(w3: Web3, address: str, abi: list, source_hash: str, block_number: int,
+           registry_file: str = REGISTRY_FILE):
+    ''' Registers a new deployment for the network of w3, replacing the previous one '''
+    try:
+        with open(registry_file, 'r') as f:
+            registry = json.load(f)
+    except (OSError, ValueError):
+        registry = {}
+
+    registry[network_id(w3)] = {
+        'address': address,
+        'abi': abi,
+        'source_hash': source_hash,
+        'block_number': block_number}
+
+    # Write to a temporary file first so readers never see a half written registry
+    temporary = registry_file + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(registry, f, indent=2)
+    os.replace(temporary, registry_file)
+
+
+def is_deployed(w3: Web3, deployment: dict):
+    ''' Whether the registered contract still exists, i.e. the chain was not reset '''
+    return len(w3.eth.getCode(Web3.toChecksumAddress(deployment['address']))) != 0
@@ -0,0 +1,142 @@
+''' Providers used to talk to the node, shared by the clients and the server.
+
+- PooledHTTPProvider keeps a pool of keep-alive connections per process, big enough
+  for all the threads of the process, and can send several requests in a single
+  JSON-RPC batch
+- For a node in the same host, an IPC (unix socket) path can be used instead of
+  an http URI, avoiding HTTP altogether
+
+batch_view_calls reads several view functions of a contract with a single batch,
+falling back to one request per call if the provider can not batch '''
+
+import json
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from eth_abi import decode_abi
+from web3 import Web3, HTTPProvider, IPCProvider, WebsocketProvider
+
+# Default node of the system
+NODE_URI = "http://localhost:8545"
+
+
+class PooledHTTPProvider(HTTPProvider):
+    ''' HTTP provider with a pool of keep-alive connections per process and
+    support for JSON-RPC batches '''
+
+    # Connections kept alive per process
+    POOL_SIZE = 32
+    # Seconds to wait for the node
+    TIMEOUT = 10
+
+    def __init__(self, endpoint_uri: str = NODE_URI, request_kwargs: dict = None, pool_size: int = POOL_SIZE):
+        super().__init__(endpoint_uri, request_kwargs)
+        self.pool_size = pool_size
+        # Session of the shape { pid : session }, so a forked process never
+        # uses the sockets of its parent
+        self._sessions = {}
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        return self.decode_rpc_response(self._post(request_data))
+
+    def make_batch_request(self, calls: list):
+        ''' Sends a list of (method, params) in a single request and returns
+        their responses in the same order '''
+        ids = []
+        batch = []
+        for method, params in calls:
+            ids.append(next(self.request_counter))
+            batch.append({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': ids[-1]})
+
+        responses = {response['id']: response
+                     for response in self.decode_rpc_response(self._post(json.dumps(batch).encode('utf-8')))}
+        return [responses[request_id] for request_id in ids]
+
+    def _post(self, data: bytes):
+        kwargs = self.get_request_kwargs()
+        kwargs.setdefault('timeout', self.TIMEOUT)
+        response = self._session().post(self.endpoint_uri, data=data, **kwargs)
+        response.raise_for_status()
+        return response.content
+
+    def _session(self):
+        pid = os.getpid()
+        session = self._sessions.get(pid)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # Sessions inherited from the parent process are dropped
+            self._sessions = {pid: session}
+        return session
+
+
+def make_provider(uri: str = NODE_URI):
+    ''' Provider for the node at the given URI: http(s)://, ws(s):// or the
+    path of an IPC socket (ipc:///path/to/geth.ipc or /path/to/geth.ipc) '''
+    if uri.startswith('http://') or uri.startswith('https://'):
+        return PooledHTTPProvider(uri)
+    if uri.startswith('ws://') or uri.startswith('wss://'):
+        return WebsocketProvider(uri)
+    if uri.startswith('ipc://'):
+        uri = uri[len('ipc://'):]
+    return IPCProvider(uri)
+
+
+def batch_request(w3: Web3, calls: list):
+    ''' Sends a list of (method, params) to the node, in a single batch if the provider
+    supports it. Returns the raw results in the same order. Raises ValueError if any fails '''
+    if len(calls) == 0:
+        return []
+
+    provider = w3.providers[0]
+    if hasattr(provider, 'make_batch_request'):
+        responses = provider.make_batch_request(calls)
+    else:
+        responses = [provider.make_request(method, params) for method, params in calls]
+
+    results = []
+    for response in responses:
+        if 'error' in response:
+            raise ValueError(response['error'])
+        results.append(response['result'])
+    return results
+
+
+def batch_view_calls(w3: Web3, contract, calls: list, block_identifier='latest'):
+    ''' Calls several view functions of the contract, of the shape [(function, args)],
+    with a single batch. Returns their decoded results in the same order '''
+    block = hex(block_identifier) if isinstance(block_identifier, int) else block_identifier
+
+    rpc_calls = []
+    output_types = []
+    for function, args in calls:
+        abi = _function_abi(contract, function, len(args))
+        output_types.append([output['type'] for output in abi['outputs']])
+        rpc_calls.append(('eth_call', [{'to': contract.address,
+                                        'data': contract.encodeABI(function, args=args)}, block]))
+
+    results = []
+    for types, raw in zip(output_types, batch_request(w3, rpc_calls)):
+        values = [_normalize(abi_type, value) for abi_type, value
+                  in zip(types, decode_abi(types, Web3.toBytes(hexstr=raw)))]
+        results.append(values[0] if len(values) == 1 else values)
+    return results
+
+
+def _normalize(abi_type: str, value):
+    # Same values returned by a regular call of the contract function
+    if abi_type == 'string' and isinstance(value, bytes):
+        return value.decode('utf-8')
+    if abi_type == 'address':
+        return Web3.toChecksumAddress(value)
+    return value
+
+
+def _function_abi(contract, name: str, arguments: int):
+    for abi in contract.abi:
+        if abi['type'] == 'function' and abi['name'] == name and len(abi['inputs']) == arguments:
+            return abi
+    raise ValueError('Unknown function {}'.format(name))
@@ -0,0 +1,113 @@
+''' Receipt watcher shared by every component that waits for transactions.
+
+Instead of polling the node once per pending transaction, the watcher scans
+every new block once and resolves the futures of the pending transactions
+found in it, so a thousand pending transactions cost one block fetch per block '''
+
+import threading
+import time
+from concurrent.futures import Future
+from web3 import Web3
+
+
+class ReceiptWatcher:
+    ''' Resolves transaction receipts as the blocks containing them are mined '''
+
+    # Seconds between checks for new blocks
+    POLL_INTERVAL = 0.5
+    # Default seconds to wait for a receipt
+    TIMEOUT = 120
+
+    def __init__(self, w3: Web3):
+        self.w3 = w3
+
+        # Futures of the pending transactions, of the shape { tx_hash : Future }
+        self.futures = {}
+        self.lock = threading.Lock()
+
+        # Next block to scan
+        self.next_block = None
+        self.thread = None
+
+    def watch(self, tx_hash) -> Future:
+        ''' Returns a future that will hold the receipt of the transaction '''
+        key = Web3.toHex(tx_hash)
+
+        # Blocks are scanned from the first watch onwards
+        first_block = self.w3.eth.blockNumber if self.next_block is None else None
+
+        with self.lock:
+            if self.next_block is None:
+                self.next_block = first_block
+            if key in self.futures:
+                return self.futures[key]
+            future = Future()
+            self.futures[key] = future
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._watch_forever, daemon=True)
+                self.thread.start()
+
+        # The transaction might have been mined before we started watching it
+        receipt = self.w3.eth.getTransactionReceipt(tx_hash)
+        if receipt is not None:
+            self._resolve(key, receipt)
+
+        return future
+
+    def wait(self, tx_hash, timeout=TIMEOUT):
+        ''' Blocks until the receipt of the transaction is available and returns it '''
+        return self.watch(tx_hash).result(timeout=timeout)
+
+    def forget(self, tx_hash):
+        ''' Stops watching a transaction, e.g. after it has been replaced '''
+        with self.lock:
+            self.futures.pop(Web3.toHex(tx_hash), None)
+
+    def _resolve(self, key, receipt):
+        with self.lock:
+            future = self.futures.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(receipt)
+
+    def _watch_forever(self):
+        while True:
+            try:
+                self._scan()
+            except Exception as error:
+                print('Error scanning blocks for receipts: {}'.format(error))
+            time.sleep(self.POLL_INTERVAL)
+
+    def _scan(self):
+        ''' Scans the blocks mined since the last scan '''
+        latest = self.w3.eth.blockNumber
+
+        with self.lock:
+            idle = len(self.futures) == 0
+        if idle:
+            # Nothing to look for in the blocks mined in the meantime
+            self.next_block = latest + 1
+            return
+
+        while self.next_block <= latest:
+            block = self.w3.eth.getBlock(self.next_block)
+            for tx_hash in block['transactions']:
+                key = Web3.toHex(tx_hash)
+                with self.lock:
+                    watched = key in self.futures
+                if watched:
+                    self._resolve(key, self.w3.eth.getTransactionReceipt(tx_hash))
+            self.next_block += 1
+
+
+# Watchers of this process, of the shape { id(w3) : watcher }
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_watcher(w3: Web3) -> ReceiptWatcher:
+    ''' Returns the watcher shared by everyone using the same w3 in this process '''
+    with _watchers_lock:
+        if id(w3) not in _watchers:
+            _watchers[id(w3)] = ReceiptWatcher(w3)
+        return _watchers[id(w3)]
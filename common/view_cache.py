@@ -0,0 +1,119 @@
+''' Cache of the view calls to the contract shared by the clients and the server.
+
+The result of a view call - balanceOf, storageUse... - can only change when a new
+block is mined, so every call is made at an explicit block number and its result is
+reused by every identical call until the next block. The current block number is
+only asked to the node every BLOCK_REFRESH seconds. After sending its own
+transactions, the caller invalidates the entries of the accounts involved so
+their next read goes to the node '''
+
+import threading
+import time
+from web3 import Web3
+
+from providers import batch_view_calls
+
+
+class ViewCache:
+    ''' Results of the view calls at the current block, of the shape
+    { (function, args) : value } '''
+
+    # Seconds the current block number is trusted before asking the node again
+    BLOCK_REFRESH = 0.5
+
+    def __init__(self, w3: Web3, contract):
+        self.w3 = w3
+        self.contract = contract
+
+        self.entries = {}
+        self.block = None
+        self.block_checked_at = 0
+        self.lock = threading.Lock()
+
+        # Number of calls answered from the cache and sent to the node
+        self.hits = 0
+        self.misses = 0
+
+    def call(self, function: str, *args):
+        ''' Returns the result of a view function of the contract at the current block '''
+        block = self.current_block()
+        key = (function, args)
+
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                return self.entries[key]
+
+        value = getattr(self.contract.functions, function)(*args).call(block_identifier=block)
+
+        with self.lock:
+            self.misses += 1
+            # Only keep it if no new block has been seen in the meantime
+            if self.block == block:
+                self.entries[key] = value
+        return value
+
+    def call_many(self, calls: list):
+        ''' Returns the results of several view calls, of the shape [(function, args)].
+        The ones not in the cache are sent to the node in a single batch '''
+        block = self.current_block()
+        keys = [(function, tuple(args)) for function, args in calls]
+
+        with self.lock:
+            cached = {key: self.entries[key] for key in keys if key in self.entries}
+            self.hits += len(cached)
+        missing = list({key for key in keys if key not in cached})
+
+        values = dict(zip(missing, batch_view_calls(self.w3, self.contract, missing, block)))
+
+        with self.lock:
+            self.misses += len(missing)
+            if self.block == block:
+                self.entries.update(values)
+
+        values.update(cached)
+        return [values[key] for key in keys]
+
+    def current_block(self):
+        ''' Current block number. A new block invalidates all the entries '''
+        with self.lock:
+            if self.block is not None and time.time() - self.block_checked_at < self.BLOCK_REFRESH:
+                return self.block
+
+        self.observe_block(self.w3.eth.blockNumber)
+        return self.block
+
+    def observe_block(self, block_number: int):
+        ''' Tells the cache about a block seen by the caller, e.g. in a receipt or a log '''
+        with self.lock:
+            if self.block is None or block_number > self.block:
+                self.block = block_number
+                self.entries = {}
+            self.block_checked_at = time.time()
+
+    def invalidate(self, *accounts):
+        ''' Drops the entries of the given accounts, or all of them if none is given,
+        and asks the node for the current block in the next call '''
+        accounts = {account.lower() for account in accounts}
+        with self.lock:
+            if len(accounts) == 0:
+                self.entries = {}
+            else:
+                self.entries = {
+                    (function, args): value for (function, args), value in self.entries.items()
+                    if not any(isinstance(arg, str) and arg.lower() in accounts for arg in args)}
+            self.block_checked_at = 0
+
+
+# Caches of this process, of the shape { (id(w3), contract address) : cache }
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_view_cache(w3: Web3, contract) -> ViewCache:
+    ''' Returns the cache shared by everyone using the same w3 and contract in this process '''
+    with _caches_lock:
+        key = (id(w3), contract.address)
+        if key not in _caches:
+            _caches[key] = ViewCache(w3, contract)
+        return _caches[key]
@@ -26,11 +26,15 @@ contract IoToken is owned{
 
     // storage management
     uint256 totalStorage; // Total storage available for clients in MB
-    uint256 availableStorage; 
+    uint256 public availableStorage;
 
     // CPU management
     uint256 totalComputingPower = 100; // 100 is all the computing power available. Since solidity does not support floats we have to do it like this
-    uint256 availableComputingPower = 100; // 1 - the amount used by the clients
+    uint256 public availableComputingPower = 100; // 1 - the amount used by the clients
+
+    // Bandwidth and memory management, also as a percentage of the total
+    uint256 public availableBandwidth = 100;
+    uint256 public availableMemory = 100;
 
     // Total coin supply
     uint256 totalSupply;
@@ -42,6 +46,8 @@ contract IoToken is owned{
     // Mappings for resource usage
     mapping(address => uint256)  public storageUse;
     mapping (address => uint256)  public cpuUse;
+    mapping (address => uint256)  public bandwidthUse;
+    mapping (address => uint256)  public memoryUse;
     
 
     // Events produced by the keys
@@ -52,13 +58,24 @@ contract IoToken is owned{
     event Register(address indexed account, string ip_address, string mac_address, uint256 balance);
     event RegisterResponse(bool accepted, address indexed account, string ip_address, string mac_address);
     // Event to get some storage
-    event StoragePetition(address indexed account, uint256 amount);
-    event StorageResponse(bool accepted, address indexed account, uint256 amount, string grantID);
+    event StoragePetition(address indexed account, uint256 amount, uint256 requestId);
+    event StorageResponse(bool accepted, address indexed account, uint256 amount, string grantID, uint256 indexed requestId);
     event FreeStorage(address indexed account, string grantID);
     // Event to get some CPU
-    event CPUPetition(address indexed account, uint256 amount);
-    event CPUResponse(bool accepted, address indexed account, uint256 amount, string grantID);
+    event CPUPetition(address indexed account, uint256 amount, uint256 requestId);
+    event CPUResponse(bool accepted, address indexed account, uint256 amount, string grantID, uint256 indexed requestId);
     event FreeComputingPower(address indexed account, string grantID);
+    // Event to get some bandwidth
+    event BandwidthPetition(address indexed account, uint256 amount, uint256 requestId);
+    event BandwidthResponse(bool accepted, address indexed account, uint256 amount, string grantID, uint256 indexed requestId);
+    event FreeBandwidth(address indexed account, string grantID);
+    // Event to get some memory
+    event MemoryPetition(address indexed account, uint256 amount, uint256 requestId);
+    event MemoryResponse(bool accepted, address indexed account, uint256 amount, string grantID, uint256 indexed requestId);
+    event FreeMemory(address indexed account, string grantID);
+
+    event LeaseRenewal(address indexed account, string grantID);
+    event LeaseExpired(address indexed account, string grantID);
 
 
     // Recibimos la cantidad de dinero con la que queremos inicializar el sistema
@@ -137,7 +154,7 @@ contract IoToken is owned{
     * Function to ask for storage from the server.
     * The amount of storage will be given in MB
     */
-    function getStorage(address _account, uint256 _amount) public {
+    function getStorage(address _account, uint256 _amount, uint256 _requestId) public {
         require(_account != address(0x0));
 
         // Require that the account is not frozen
@@ -150,13 +167,13 @@ contract IoToken is owned{
         require (availableStorage - _amount > 0);
 
         // In case we satisfy all this we emit an Event so the server will know
-        emit StoragePetition(_account, _amount);
+        emit StoragePetition(_account, _amount, _requestId);
     }
 
     /**
     * Function with which the server grants storage to the client
     */
-    function answerStorageRequest(address _account, uint256 _amount, string _grantID, bool _accepted) onlyOwner public {
+    function answerStorageRequest(address _account, uint256 _amount, string _grantID, bool _accepted, uint256 _requestId) onlyOwner public {
        
         // The request has to be accepted in order to decrement the memory
         if (_accepted){
@@ -164,17 +181,37 @@ contract IoToken is owned{
             availableStorage -= _amount;
             // We then add the storage to the corresponding client
             storageUse[_account] += _amount;
-            emit StorageResponse(_accepted, _account, _amount, _grantID);
+            emit StorageResponse(_accepted, _account, _amount, _grantID, _requestId);
         }
 
         // If the storage is not granted for whatever reason we respond that it was not accepted
         else {
-            emit StorageResponse(_accepted, _account, _amount, '-1');
+            emit StorageResponse(_accepted, _account, _amount, '-1', _requestId);
         }
 
 
     }
 
+    /**
+    * Function with which the server answers a whole batch of storage petitions
+    * in a single transaction. The accepted ones are charged at the same time
+    */
+    function answerStorageRequests(address[] _accounts, uint256[] _amounts, bytes32[] _grantIDs, bool[] _accepted, uint256[] _charges, uint256[] _requestIds) onlyOwner public {
+
+        require(_accounts.length == _amounts.length && _accounts.length == _grantIDs.length);
+        require(_accounts.length == _accepted.length && _accounts.length == _charges.length);
+        require(_accounts.length == _requestIds.length);
+
+        for (uint256 i = 0; i < _accounts.length; i++) {
+            if (_accepted[i]) {
+                // The server never charges more than the balance, the subtraction can not wrap
+                require(balanceOf[_accounts[i]] >= _charges[i]);
+                balanceOf[_accounts[i]] -= _charges[i];
+            }
+            answerStorageRequest(_accounts[i], _amounts[i], bytes32ToString(_grantIDs[i]), _accepted[i], _requestIds[i]);
+        }
+    }
+
     /**
     * Function accessible to the clients for freeing storage
     */
@@ -205,7 +242,7 @@ contract IoToken is owned{
     /**
     * Function used by the client to ask for computing power
     */
-    function getComputingPower(address _account, uint256 _amount) public {
+    function getComputingPower(address _account, uint256 _amount, uint256 _requestId) public {
         require(_account != address(0x0));
 
         // Require that the account is not frozen
@@ -218,13 +255,13 @@ contract IoToken is owned{
         //require (availableComputingPower - _amount > 0);
 
         // In case we satisfy all this we emit an Event so the server will know
-        emit CPUPetition(_account, _amount);
+        emit CPUPetition(_account, _amount, _requestId);
     }
 
     /**
     * Function with which the server grants cpu to the client
     */
-    function answerComputingPowerRequest(address _account, uint256 _amount, string _grantID, bool _accepted) onlyOwner public{
+    function answerComputingPowerRequest(address _account, uint256 _amount, string _grantID, bool _accepted, uint256 _requestId) onlyOwner public{
 
         if (_accepted) {
             // We update the current amount available
@@ -232,14 +269,34 @@ contract IoToken is owned{
 
             // We then add the storage to the corresponding client
             cpuUse[_account] += _amount;
-            emit CPUResponse(_accepted, _account, _amount, _grantID);
+            emit CPUResponse(_accepted, _account, _amount, _grantID, _requestId);
         }
         else{
-            emit CPUResponse(_accepted, _account, _amount, '-1');
+            emit CPUResponse(_accepted, _account, _amount, '-1', _requestId);
         }
 
     }
 
+    /**
+    * Function with which the server answers a whole batch of cpu petitions
+    * in a single transaction. The accepted ones are charged at the same time
+    */
+    function answerComputingPowerRequests(address[] _accounts, uint256[] _amounts, bytes32[] _grantIDs, bool[] _accepted, uint256[] _charges, uint256[] _requestIds) onlyOwner public {
+
+        require(_accounts.length == _amounts.length && _accounts.length == _grantIDs.length);
+        require(_accounts.length == _accepted.length && _accounts.length == _charges.length);
+        require(_accounts.length == _requestIds.length);
+
+        for (uint256 i = 0; i < _accounts.length; i++) {
+            if (_accepted[i]) {
+                // The server never charges more than the balance, the subtraction can not wrap
+                require(balanceOf[_accounts[i]] >= _charges[i]);
+                balanceOf[_accounts[i]] -= _charges[i];
+            }
+            answerComputingPowerRequest(_accounts[i], _amounts[i], bytes32ToString(_grantIDs[i]), _accepted[i], _requestIds[i]);
+        }
+    }
+
     /**
     * Method accessible to the clients for freeing cpu
     */
@@ -261,6 +318,164 @@ contract IoToken is owned{
     }
 
 
+    /*
+    * FUNTIONS TO TAKE CARE OF ALL OPERATIONS WHEN A CLIENT ASKS FOR BANDWIDTH
+    */
+
+    /**
+    * Function used by the client to ask for bandwidth
+    */
+    function getBandwidth(address _account, uint256 _amount, uint256 _requestId) public {
+        require(_account != address(0x0));
+        require (!frozenAccount[_account]);
+
+        emit BandwidthPetition(_account, _amount, _requestId);
+    }
+
+    /**
+    * Function with which the server grants bandwidth to the client
+    */
+    function answerBandwidthRequest(address _account, uint256 _amount, string _grantID, bool _accepted, uint256 _requestId) onlyOwner public {
+
+        if (_accepted) {
+            availableBandwidth -= _amount;
+            bandwidthUse[_account] += _amount;
+            emit BandwidthResponse(_accepted, _account, _amount, _grantID, _requestId);
+        }
+        else {
+            emit BandwidthResponse(_accepted, _account, _amount, '-1', _requestId);
+        }
+    }
+
+    /**
+    * Function with which the server answers a whole batch of bandwidth petitions
+    * in a single transaction. The accepted ones are charged at the same time
+    */
+    function answerBandwidthRequests(address[] _accounts, uint256[] _amounts, bytes32[] _grantIDs, bool[] _accepted, uint256[] _charges, uint256[] _requestIds) onlyOwner public {
+
+        require(_accounts.length == _amounts.length && _accounts.length == _grantIDs.length);
+        require(_accounts.length == _accepted.length && _accounts.length == _charges.length);
+        require(_accounts.length == _requestIds.length);
+
+        for (uint256 i = 0; i < _accounts.length; i++) {
+            if (_accepted[i]) {
+                // The server never charges more than the balance, the subtraction can not wrap
+                require(balanceOf[_accounts[i]] >= _charges[i]);
+                balanceOf[_accounts[i]] -= _charges[i];
+            }
+            answerBandwidthRequest(_accounts[i], _amounts[i], bytes32ToString(_grantIDs[i]), _accepted[i], _requestIds[i]);
+        }
+    }
+
+    /**
+    * Method accessible to the clients for freeing bandwidth
+    */
+    function freeBandwidth(address _account, string _grantID) public {
+        require (bandwidthUse[_account] != 0);
+
+        emit FreeBandwidth(_account, _grantID);
+    }
+
+    /*
+    * Method used by the server to free bandwidth after it has done its comprobations
+    */
+    function _freeBandwidth(address _account, uint256 _amountFreed) onlyOwner public {
+
+        availableBandwidth += _amountFreed;
+        bandwidthUse[_account] -= _amountFreed;
+    }
+
+
+    /*
+    * FUNTIONS TO TAKE CARE OF ALL OPERATIONS WHEN A CLIENT ASKS FOR MEMORY
+    */
+
+    /**
+    * Function used by the client to ask for memory
+    */
+    function getMemory(address _account, uint256 _amount, uint256 _requestId) public {
+        require(_account != address(0x0));
+        require (!frozenAccount[_account]);
+
+        emit MemoryPetition(_account, _amount, _requestId);
+    }
+
+    /**
+    * Function with which the server grants memory to the client
+    */
+    function answerMemoryRequest(address _account, uint256 _amount, string _grantID, bool _accepted, uint256 _requestId) onlyOwner public {
+
+        if (_accepted) {
+            availableMemory -= _amount;
+            memoryUse[_account] += _amount;
+            emit MemoryResponse(_accepted, _account, _amount, _grantID, _requestId);
+        }
+        else {
+            emit MemoryResponse(_accepted, _account, _amount, '-1', _requestId);
+        }
+    }
+
+    /**
+    * Function with which the server answers a whole batch of memory petitions
+    * in a single transaction. The accepted ones are charged at the same time
+    */
+    function answerMemoryRequests(address[] _accounts, uint256[] _amounts, bytes32[] _grantIDs, bool[] _accepted, uint256[] _charges, uint256[] _requestIds) onlyOwner public {
+
+        require(_accounts.length == _amounts.length && _accounts.length == _grantIDs.length);
+        require(_accounts.length == _accepted.length && _accounts.length == _charges.length);
+        require(_accounts.length == _requestIds.length);
+
+        for (uint256 i = 0; i < _accounts.length; i++) {
+            if (_accepted[i]) {
+                // The server never charges more than the balance, the subtraction can not wrap
+                require(balanceOf[_accounts[i]] >= _charges[i]);
+                balanceOf[_accounts[i]] -= _charges[i];
+            }
+            answerMemoryRequest(_accounts[i], _amounts[i], bytes32ToString(_grantIDs[i]), _accepted[i], _requestIds[i]);
+        }
+    }
+
+    /**
+    * Method accessible to the clients for freeing memory
+    */
+    function freeMemory(address _account, string _grantID) public {
+        require (memoryUse[_account] != 0);
+
+        emit FreeMemory(_account, _grantID);
+    }
+
+    /*
+    * Method used by the server to free memory after it has done its comprobations
+    */
+    function _freeMemory(address _account, uint256 _amountFreed) onlyOwner public {
+
+        availableMemory += _amountFreed;
+        memoryUse[_account] -= _amountFreed;
+    }
+
+
+    /**
+    * Function used by the clients to renew the lease of any of their grants,
+    * so the server does not take the resources back
+    */
+    function renewLease(address _account, string _grantID) public {
+        require(_account != address(0x0));
+
+        emit LeaseRenewal(_account, _grantID);
+    }
+
+    /**
+    * Function used by the server to tell the clients which of their grants
+    * it has taken back because their lease expired
+    */
+    function notifyExpiredLeases(address[] _accounts, bytes32[] _grantIDs) onlyOwner public {
+        require(_accounts.length == _grantIDs.length);
+
+        for (uint256 i = 0; i < _accounts.length; i++) {
+            emit LeaseExpired(_accounts[i], bytes32ToString(_grantIDs[i]));
+        }
+    }
+
     /**
      * Create new tokens
      */ 
@@ -278,6 +493,15 @@ contract IoToken is owned{
         frozenAccount[target] = freeze;
         emit FrozenFunds(target, freeze);
     }
+
+    /**
+     * Function used by the server to block or unblock a batch of accounts in a single transaction
+     */
+    function freezeAccounts(address[] targets, bool freeze) onlyOwner public {
+        for (uint256 i = 0; i < targets.length; i++) {
+            freezeAccount(targets[i], freeze);
+        }
+    }
     
     
     /**
@@ -295,6 +519,32 @@ contract IoToken is owned{
             balanceOf[_account] -= amount;
         }
     }
+
+    /**
+     * Function so that the server can update the balance of a batch of clients
+     * in a single transaction, e.g. when returning the pending charges
+     */
+    function updateBalances(address[] _accounts, uint256[] amounts, bool _increment) onlyOwner public {
+        require(_accounts.length == amounts.length);
+        for (uint256 i = 0; i < _accounts.length; i++) {
+            updateBalance(_accounts[i], amounts[i], _increment);
+        }
+    }
+
+    /**
+     * Converts a grant id sent as bytes32 by the server back into a string
+     */
+    function bytes32ToString(bytes32 _data) internal pure returns (string) {
+        uint256 length = 0;
+        while (length < 32 && _data[length] != 0) {
+            length++;
+        }
+        bytes memory result = new bytes(length);
+        for (uint256 j = 0; j < length; j++) {
+            result[j] = _data[j];
+        }
+        return string(result);
+    }
         
         
         
@@ -0,0 +1,112 @@
+''' Admission scheduler for the petitions of a resource.
+
+Instead of granting petitions first-come-first-served in log order, all the petitions
+of a resource received in the same batch (block range) are ranked by the priority and
+credit of their clients and packed against the available capacity:
+
+- greedy: admits the petitions in rank order while they fit
+- knapsack: for every priority level, from the highest to the lowest, admits the subset
+  of petitions that makes the best use of the remaining capacity. Used for resources
+  with a small capacity (percentages) where the dynamic programming table is cheap '''
+
+GREEDY = 'greedy'
+KNAPSACK = 'knapsack'
+
+# Largest capacity for which the knapsack policy is used, otherwise greedy is used
+KNAPSACK_MAX_CAPACITY = 1000
+
+
+class Petition:
+    ''' A petition waiting for admission '''
+
+    def __init__(self, entry, account: str, amount: int, price: int, balance: int,
+                 priority: int, credit: int):
+        self.entry = entry
+        self.account = account
+        self.amount = amount
+        self.price = price
+        self.balance = balance
+        # Lower number means higher priority
+        self.priority = priority
+        self.credit = credit
+
+
+def rank(petitions: list):
+    ''' Orders the petitions by priority, then by credit (higher first) and then
+    by amount (smaller first). Petitions that tie keep their log order '''
+    return sorted(petitions, key=lambda p: (p.priority, -p.credit, p.amount))
+
+
+def admit(petitions: list, capacity: int, policy: str = GREEDY):
+    ''' Returns the list of admitted petitions, in rank order. Petitions are only
+    admitted if their client can pay for them, counting all its admitted petitions '''
+
+    # Petitions their clients can not pay for never compete for the capacity
+    ranked = rank([p for p in petitions if p.balance >= p.price])
+
+    if policy == KNAPSACK and capacity <= KNAPSACK_MAX_CAPACITY:
+        return _admit_knapsack(ranked, capacity)
+    return _admit_greedy(ranked, capacity)
+
+
+def _admit_greedy(ranked: list, capacity: int):
+    ''' Fits the petitions in rank order in the capacity and in the balance of their clients '''
+    admitted = []
+    remaining = capacity
+    charged = {}
+    for p in ranked:
+        if p.amount > remaining:
+            continue
+        if p.balance - charged.get(p.account, 0) < p.price:
+            continue
+        admitted.append(p)
+        remaining -= p.amount
+        charged[p.account] = charged.get(p.account, 0) + p.price
+
+    return admitted
+
+
+def _admit_knapsack(ranked: list, capacity: int):
+    ''' Packs every priority level, from the highest to the lowest, in the capacity
+    left by the previous ones '''
+    chosen = set()
+    remaining = capacity
+    charged = {}
+    for level in sorted({p.priority for p in ranked}):
+        # The petitions of the level their clients can pay for all together, counting
+        # what was charged in the previous levels. Any subset of them can be paid, so
+        # whatever the knapsack picks is admitted
+        candidates = []
+        reserved = dict(charged)
+        for p in ranked:
+            if p.priority == level and p.balance - reserved.get(p.account, 0) >= p.price:
+                candidates.append(p)
+                reserved[p.account] = reserved.get(p.account, 0) + p.price
+
+        for p in _knapsack(candidates, remaining):
+            chosen.add(id(p))
+            remaining -= p.amount
+            charged[p.account] = charged.get(p.account, 0) + p.price
+
+    return [p for p in ranked if id(p) in chosen]
+
+
+def _knapsack(petitions: list, capacity: int):
+    ''' 0/1 knapsack maximizing the amount packed in the capacity '''
+    if capacity <= 0:
+        return [p for p in petitions if p.amount <= 0]
+
+    # Petitions asking for nothing always fit
+    free = [p for p in petitions if p.amount <= 0]
+
+    # best[c] = (amount packed, indexes of the petitions) using capacity c
+    best = [(0, ())] * (capacity + 1)
+    for index, p in enumerate(petitions):
+        if p.amount <= 0 or p.amount > capacity:
+            continue
+        for c in range(capacity, p.amount - 1, -1):
+            packed, chosen = best[c - p.amount]
+            if packed + p.amount > best[c][0]:
+                best[c] = (packed + p.amount, chosen + (index,))
+
+    return free + [petitions[index] for index in best[capacity][1]]
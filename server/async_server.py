@@ -0,0 +1,195 @@
+""" asyncio runtime for the blockchain server.
+
+A single event loop replaces the polling processes and threads of serve_forever:
+
+- The event pump is woken up by an eth_subscribe('logs') subscription over the
+  node's websocket, falling back to polling when it is not available, so the
+  allocation latency is bounded by the block time instead of the polling interval
+- The sniffers are served by an asyncio server speaking the same protocol as
+  multiprocessing.connection, instead of a thread per connection
+- The scheduled jobs run as tasks
+
+All the blocking work - database and node access - runs in thread pools so it
+never blocks the loop. The pump has its own single thread so the logs are still
+handled in order """
+
+import asyncio
+import json
+import pickle
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Value, Lock
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+from server import BlockchainServer
+import event_listeners
+import tx_submitter
+
+
+class AsyncBlockchainServer(BlockchainServer):
+
+    # Websocket endpoint of the node used for the subscriptions
+    WEBSOCKET_URI = "ws://localhost:8546"
+
+    # Seconds between pump wakeups when there is no subscription
+    POLL_INTERVAL = 1
+
+    # Seconds between scheduled jobs
+    UPDATE_INTERVAL = 40
+
+    def serve_forever(self):
+        """ Serve until explicit shutdown """
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """ Starts all the tasks of the server and runs them forever """
+
+        # Blocking work is done in these executors
+        self.executor = ThreadPoolExecutor(max_workers=8)
+        self.pump_executor = ThreadPoolExecutor(max_workers=1)
+
+        # Shared state, the same objects used by the thread based server
+        self.ledger = self._create_resource_ledger()
+        tx_submitter.setup(self.w3, self.account, Value('q', -1), Lock())
+
+        self.pump = event_listeners.build_event_pump(
+            self.w3, self.contract, self.ledger, fromBlock=self.deployment_block)
+        self.pump_wakeup = asyncio.Event()
+
+        # Sniffer connections of the shape { peername : StreamWriter }
+        self.connections = {}
+        sniffer_server = await asyncio.start_server(
+            self._serve_sniffer, 'localhost', self.LISTENING_PORT)
+
+        async with sniffer_server:
+            await asyncio.gather(
+                self._run_pump(),
+                self._watch_logs(),
+                self._every(self.UPDATE_INTERVAL, self._send_updated_info_async),
+                self._every(self.SETTLEMENT_INTERVAL, self._review_pending_charges_async),
+                self._every(self.RECLAIM_INTERVAL, self._reclaim_expired_leases_async))
+
+    async def _run(self, function, *args, executor=None):
+        """ Runs a blocking function in an executor """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor or self.executor, function, *args)
+
+    async def _every(self, seconds: int, job):
+        """ Runs a job periodically """
+        while True:
+            await asyncio.sleep(seconds)
+            try:
+                await job()
+            except Exception as error:
+                print('Error in scheduled job {}: {}'.format(job.__name__, error))
+
+    async def _run_pump(self):
+        """ Runs the event pump every time it is woken up """
+        print('[x] event_pump: started')
+        # First poll to catch up since the last checkpoint
+        self.pump_wakeup.set()
+        while True:
+            await self.pump_wakeup.wait()
+            self.pump_wakeup.clear()
+            try:
+                await self._run(self.pump.poll, executor=self.pump_executor)
+            except Exception as error:
+                print('Error in the event pump: {}'.format(error))
+
+    async def _watch_logs(self):
+        """ Wakes up the pump whenever the node notifies new logs of the contract.
+        If the subscription can not be established, falls back to polling """
+        if websockets is not None:
+            try:
+                async with websockets.connect(self.WEBSOCKET_URI) as ws:
+                    await ws.send(json.dumps({
+                        'jsonrpc': '2.0', 'id': 1, 'method': 'eth_subscribe',
+                        'params': ['logs', {'address': self.contract.address}]}))
+                    response = json.loads(await ws.recv())
+                    if 'error' in response:
+                        raise ConnectionError(response['error'])
+                    print('Subscribed to contract logs:', response['result'])
+
+                    async for _ in ws:
+                        self.pump_wakeup.set()
+
+            except (OSError, ConnectionError, websockets.WebSocketException) as error:
+                print('Log subscription not available ({}), polling instead'.format(error))
+
+        while True:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            self.pump_wakeup.set()
+
+    async def _serve_sniffer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ Receives the reports of a sniffer connection """
+        address = writer.get_extra_info('peername')
+        print('Connection accepted from', address)
+        self.connections[address] = writer
+
+        try:
+            while True:
+                report = await _recv_message(reader)
+                print('Received report from sniffer', report)
+                await self._run(self._process_report, report)
+
+        except (asyncio.IncompleteReadError, ConnectionResetError) as error:
+            print('Sniffer {} disconnected: {}'.format(address, error))
+            self.connections.pop(address, None)
+            writer.close()
+
+    async def _send_updated_info_async(self):
+        """ Sends updated info to the packet sniffers """
+        results = await self._run(self._get_clients_info)
+
+        for address, writer in list(self.connections.items()):
+            try:
+                await _send_message(writer, results)
+            except (BrokenPipeError, ConnectionResetError) as e:
+                print('Error sending updates: {}'.format(e))
+                writer.close()
+                self.connections.pop(address, None)
+
+    async def _review_pending_charges_async(self):
+        await self._run(self._review_pending_charges)
+
+    async def _reclaim_expired_leases_async(self):
+        await self._run(self._reclaim_expired_leases, self.ledger)
+
+
+# The sniffers use multiprocessing.connection, which frames every pickled
+# message with its length as a 4 byte big endian integer
+
+async def _recv_message(reader: asyncio.StreamReader):
+    size, = struct.unpack('!i', await reader.readexactly(4))
+    if size == -1:
+        size, = struct.unpack('!Q', await reader.readexactly(8))
+    return pickle.loads(await reader.readexactly(size))
+
+
+async def _send_message(writer: asyncio.StreamWriter, obj):
+    payload = pickle.dumps(obj)
+    if len(payload) > 0x7fffffff:
+        writer.write(struct.pack('!i', -1) + struct.pack('!Q', len(payload)))
+    else:
+        writer.write(struct.pack('!i', len(payload)))
+    writer.write(payload)
+    await writer.drain()
+
+
+def main():
+    # The contract is only deployed when explicitly asked to
+    server = AsyncBlockchainServer(deploy='--deploy' in sys.argv)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
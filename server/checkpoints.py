@@ -0,0 +1,64 @@
+''' Persistent checkpoints of the event handlers.
+
+Every handler of the event pump keeps the position - block number and log index -
+of the last log it has fully processed, so after a restart the pump resumes from
+there instead of replaying the whole chain from block 0 '''
+
+import mysql.connector
+
+# Log index used to mark that a whole block has been processed
+BLOCK_DONE = 2**31 - 1
+
+
+class CheckpointStore:
+    ''' Stores the checkpoints in the event_checkpoints table of the server DB.
+    The checkpoints are of the shape { handler : (block_number, log_index) } '''
+
+    def __init__(self, get_connection):
+        self.get_connection = get_connection
+
+    def load(self):
+        ''' Returns all the stored checkpoints '''
+        connection = self.get_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT handler, block_number, log_index FROM event_checkpoints")
+            return {handler: (int(block), int(index))
+                    for handler, block, index in cursor.fetchall()}
+        finally:
+            cursor.close()
+            connection.close()
+
+    def save(self, checkpoints: dict):
+        ''' Upserts the given checkpoints in a single statement '''
+        if len(checkpoints) == 0:
+            return
+
+        connection = self.get_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.executemany('''
+                INSERT INTO event_checkpoints(handler, block_number, log_index) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE block_number = VALUES(block_number), log_index = VALUES(log_index)''',
+                               [(handler, block, index) for handler, (block, index) in checkpoints.items()])
+            connection.commit()
+
+        except mysql.connector.Error as error:
+            connection.rollback()
+            print('Failed saving event checkpoints: {}'.format(error))
+
+        finally:
+            cursor.close()
+            connection.close()
+
+    def clear(self):
+        ''' Deletes all the checkpoints, e.g. when a new contract is deployed '''
+        connection = self.get_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute("DELETE FROM event_checkpoints")
+            connection.commit()
+        finally:
+            cursor.close()
+            connection.close()
@@ -0,0 +1,212 @@
+''' In-memory table of the clients of the server.
+
+The cache is the authoritative copy of the clients' state inside the server process:
+the hot paths (pricing, report processing, charges) read and write it without opening
+a database connection, and the changes are flushed to MySQL in batches by a
+background thread (write-behind).
+
+Credit is stored as (value, last update time) and the recovered credit is computed
+when it is read, so well behaved or idle clients cost no writes at all and the
+recovery speed is decided by the clock, not by the number of reports received '''
+
+import threading
+import time
+import mysql.connector
+
+
+def recovered_credit(credit: int, updated_at: float, now: float = None):
+    ''' Credit of a client after recovering one point every RECOVERY_PERIOD
+    seconds since its credit was last updated '''
+    if credit >= ClientCache.MAX_CREDIT:
+        return credit
+    now = time.time() if now is None else now
+    recovered = int(max(now - updated_at, 0) // ClientCache.RECOVERY_PERIOD)
+    return min(ClientCache.MAX_CREDIT, credit + recovered)
+
+
+class ClientState:
+    ''' State of a single client '''
+
+    def __init__(self, account: str, mac_address: str, ip_address: str, credit: int = 100,
+                 balance: float = 0, blocked: bool = False, priority: int = 4,
+                 credit_updated_at: float = None):
+        self.account = account
+        self.mac_address = mac_address
+        self.ip_address = ip_address
+        # Credit the last time it was updated, use recovered_credit to read it
+        self.credit = credit
+        self.credit_updated_at = time.time() if credit_updated_at is None else credit_updated_at
+        self.balance = balance
+        self.blocked = blocked
+        self.priority = priority
+
+    def as_sniffer_info(self):
+        ''' Info of the client sent to the packet sniffers '''
+        return {'account_address': self.account, 'ip_address': self.ip_address,
+                'mac_address': self.mac_address, 'isBlocked': self.blocked}
+
+
+class ClientCache:
+    ''' Clients indexed by account with a secondary index by MAC address '''
+
+    # Seconds between flushes of the dirty clients to the database
+    FLUSH_INTERVAL = 5
+
+    # Maximum credit of a client
+    MAX_CREDIT = 100
+    # Seconds to recover one point of credit (the report period of the sniffers)
+    RECOVERY_PERIOD = 120
+
+    def __init__(self, get_connection):
+        self.get_connection = get_connection
+        self.lock = threading.RLock()
+
+        # { account : ClientState }
+        self.clients = {}
+        # { mac_address : account }
+        self.macs = {}
+        # Accounts modified since the last flush
+        self.dirty = set()
+
+    def load(self):
+        ''' Loads all the clients from the database '''
+        connection = self.get_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute('''SELECT account_address, mac_address, ip_address, credit,
+                UNIX_TIMESTAMP(credit_updated_at), coin_balance, isBlocked, priority FROM clients''')
+            with self.lock:
+                self.clients = {}
+                self.macs = {}
+                for account, mac, ip, credit, updated_at, balance, blocked, priority in cursor.fetchall():
+                    self._add(ClientState(account, mac, ip, int(credit), float(balance or 0),
+                                          bool(blocked), int(priority), float(updated_at)))
+            print('Loaded {} clients in the cache'.format(len(self.clients)))
+        finally:
+            cursor.close()
+            connection.close()
+
+    def start(self):
+        ''' Starts the write-behind thread '''
+        threading.Thread(target=self._flush_forever, daemon=True).start()
+
+    def get(self, account: str):
+        with self.lock:
+            return self.clients.get(account)
+
+    def by_mac(self, mac_address: str):
+        with self.lock:
+            account = self.macs.get(mac_address)
+            return self.clients.get(account) if account is not None else None
+
+    def credit(self, account: str, now: float = None):
+        ''' Current credit of the account, recovery included, or None if it's not a client '''
+        with self.lock:
+            client = self.clients.get(account)
+            if client is None:
+                return None
+            return recovered_credit(client.credit, client.credit_updated_at, now)
+
+    def set_credits(self, credits: dict, updated_at: float, blocked: set = frozenset()):
+        ''' Sets the credit - and blocks - the given clients, of the shape
+        { account : credit }. They are written to the database by the next flush '''
+        with self.lock:
+            for account, credit in credits.items():
+                client = self.clients[account]
+                client.credit = credit
+                client.credit_updated_at = updated_at
+                if account in blocked:
+                    client.blocked = True
+                self.dirty.add(account)
+
+    def all(self):
+        with self.lock:
+            return list(self.clients.values())
+
+    def register(self, account: str, mac_address: str, ip_address: str, balance: float):
+        ''' Adds a new client or updates the addresses of a known one. Registrations
+        are written through by the register handler, so they are not marked dirty '''
+        with self.lock:
+            client = self.clients.get(account)
+            if client is None:
+                self._add(ClientState(account, mac_address, ip_address, balance=balance))
+            else:
+                self.macs.pop(client.mac_address, None)
+                client.mac_address = mac_address
+                client.ip_address = ip_address
+                self.macs[mac_address] = account
+
+    def update(self, account: str, **fields):
+        ''' Updates the given fields of a client and schedules it for flushing '''
+        with self.lock:
+            client = self.clients[account]
+            for field, value in fields.items():
+                setattr(client, field, value)
+            if 'credit' in fields:
+                client.credit_updated_at = time.time()
+            self.dirty.add(account)
+
+    def add_balance(self, account: str, amount: float):
+        ''' Adds (or subtracts, if negative) an amount to the balance of a client '''
+        with self.lock:
+            client = self.clients[account]
+            self.update(account, balance=client.balance + amount)
+
+    def flush(self):
+        ''' Writes all the dirty clients to the database in a single batch '''
+        with self.lock:
+            if len(self.dirty) == 0:
+                return
+            rows = [(c.credit, c.credit_updated_at, c.balance, c.blocked, c.priority, c.account)
+                    for c in (self.clients[account] for account in self.dirty)]
+            dirty = self.dirty
+            self.dirty = set()
+
+        connection = self.get_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.executemany('''UPDATE clients SET credit = %s, credit_updated_at = FROM_UNIXTIME(%s),
+                coin_balance = %s, isBlocked = %s, priority = %s WHERE account_address = %s''', rows)
+            connection.commit()
+
+        except mysql.connector.Error as error:
+            connection.rollback()
+            print('Failed flushing the client cache: {}'.format(error))
+            # Try again in the next flush
+            with self.lock:
+                self.dirty |= dirty
+
+        finally:
+            cursor.close()
+            connection.close()
+
+    def _add(self, client: ClientState):
+        self.clients[client.account] = client
+        if client.mac_address is not None:
+            self.macs[client.mac_address] = client.account
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as error:
+                print('Error flushing the client cache: {}'.format(error))
+
+
+# Cache of the server process
+_cache = None
+
+
+def setup(get_connection):
+    ''' Creates, loads and starts the cache of this process '''
+    global _cache
+    _cache = ClientCache(get_connection)
+    _cache.load()
+    _cache.start()
+    return _cache
+
+
+def get_cache():
+    ''' Returns the cache of this process, None if it has not been set up '''
+    return _cache
@@ -1,478 +1,588 @@
 ''' This file contains the functions used to receive new events transacted into the blockchain '''
 
-import time
 import mysql.connector
-import sys
 from web3 import Web3
-from web3.contract import ConciseContract
 from mysql.connector import pooling
 from mysql.connector import Error
 import uuid
-from multiprocessing import Value, Lock
+from functools import partial
 from server import BlockchainServer, Resource
 import web3
-
-# Global variables to use for storage management
-CPU_AVAILABLE = 100
-STORAGE_AVAILABLE = 1000000  # 1 TB = 10^6 MB
+from event_pump import EventPump
+from checkpoints import CheckpointStore
+import processed_events
+import tx_submitter
+import client_cache
+import settlement
+from resource_ledger import ResourceLedger
+import admission
+import leases
+from leases import Lease
+from view_cache import get_view_cache
 
 # Connection pool used by the processes for accesing the database
 connection_pool = None
 
 
-def register_listerner(w3: Web3, contract,  fromBlock=0, toBlock='latest'):
-    ''' This listener listens to register events and executes a series of commands
+def handle_register(contract, new_entries):
+    ''' Handles register events and executes a series of commands
             to update the database records of that particular client '''
 
-    print('[x] register_listener: started')
-    register_filter = contract.events.Register.createFilter(
-        fromBlock=fromBlock, toBlock=toBlock)
-    time.sleep(1)
-
     connection = None
+    processed = processed_events.get_ledger()
 
-    # We iterate infinitelly so we can recover the entries of the filter
-    while True:
-        try:
-            new_entries = register_filter.get_new_entries()
-
-            if len(new_entries) > 0:
-                # If there are new entries, try to insert them in the table
-                try:
-
-                    connection = _getConnection()
-                    cursor = connection.cursor()
-
-                    # print the data of the entries
-                    for entry in new_entries:
-                        args = entry['args']
-                        print('Account =', args['account'])
-
-                        # If it's not the user is already registered and already has an account
-                        cursor.execute('''SELECT account_address, mac_address, ip_address FROM clients WHERE account_address = '{}'
-                        '''.format(args['account']))
-                        # If there's something in the database already
-                        results = cursor.fetchall()
-                        if cursor.rowcount != 0:
-                            print('Client is already in the database')
-                            print(results)
-                            account_address, mac_address, ip_address = results[0]
-                            print('Datos del cliente: {}, {}, {}'.format(
-                                account_address, mac_address, ip_address))
-                            cursor.execute('''UPDATE clients SET mac_address = '{}', ip_address = '{}' WHERE account_address = '{}' '''
-                                            .format(args['mac_address'], args['ip_address'], account_address))
-                        else:
-                            print('Client was not registered')
-                            cursor.execute('''INSERT INTO clients(account_address, mac_address, ip_address, coin_balance, isRegistered) value
-                                ('{}', '{}', '{}', {}, {})'''.format(args['account'], args['mac_address'], args['ip_address'], args['balance'], 'true'))
-
-                        connection.commit()
-                        contract.functions.answerRegisterRequest(
-                            True,
-                            args['account'],
-                            args['ip_address'],
-                            args['mac_address']).transact()
-
-                        print('Answered register request')
-
-                except mysql.connector.Error as error:
-                    connection.rollback()
-                    print('Failed inserting new record into table: {}'.format(error))
-
-                finally:
-                    cursor.close()
-                    connection.close()
-                    print('MySQL connection is closed')
-
-            # Sleep 20 seconds until mining other things
-            time.sleep(1)
-
-        except KeyboardInterrupt:
-            print("[*] register_listener: exiting...")
-            sys.exit(0)
-
-
-def transfer_listener(contract, fromBlock=0, toBlock='latest'):
-    ''' This listener listens to transfer events and executes a series of commands '''
-
-    print('[x] transfer_listener: started')
-    myFilter = contract.events.Transfer.createFilter(
-        fromBlock=fromBlock, toBlock=toBlock)
-    time.sleep(1)
-
-    while True:
-        try:
-            new_entries = myFilter.get_new_entries()
-
-            if len(new_entries) > 0:
-                # print the data of the entries
-                for entry in new_entries:
-                    print(entry['args'])
-                # Sleep 20 seconds until mining other things
-
-            time.sleep(1)
-        except KeyboardInterrupt:
-            print("[*] transfer_listener: exiting...")
-            sys.exit(0)
-
+    # If there are new entries, try to insert them in the table
+    try:
 
-def storage_allocator(contract, available_storage: Value, lock: Lock, fromBlock=0, toBlock='latest'):
-    ''' Process that decides whether a storage request is granted or not.
+        connection = _getConnection()
+        cursor = connection.cursor()
+
+        # print the data of the entries
+        for entry in new_entries:
+            args = entry['args']
+            print('Account =', args['account'])
+
+            # If it's not the user is already registered and already has an account
+            cursor.execute('''SELECT account_address, mac_address, ip_address FROM clients WHERE account_address = '{}'
+            '''.format(args['account']))
+            # If there's something in the database already
+            results = cursor.fetchall()
+            if cursor.rowcount != 0:
+                print('Client is already in the database')
+                print(results)
+                account_address, mac_address, ip_address = results[0]
+                print('Datos del cliente: {}, {}, {}'.format(
+                    account_address, mac_address, ip_address))
+                cursor.execute('''UPDATE clients SET mac_address = '{}', ip_address = '{}' WHERE account_address = '{}' '''
+                                .format(args['mac_address'], args['ip_address'], account_address))
+            else:
+                print('Client was not registered')
+                cursor.execute('''INSERT INTO clients(account_address, mac_address, ip_address, coin_balance, isRegistered) value
+                    ('{}', '{}', '{}', {}, {})'''.format(args['account'], args['mac_address'], args['ip_address'], args['balance'], 'true'))
+
+            processed.record(cursor, [entry], 'Register')
+            connection.commit()
+            processed.remember([entry])
+            client_cache.get_cache().register(
+                args['account'], args['mac_address'], args['ip_address'], args['balance'])
+
+            # The answer is only sent once the register is committed
+            try:
+                tx_submitter.submit(contract.functions.answerRegisterRequest(
+                    True,
+                    args['account'],
+                    args['ip_address'],
+                    args['mac_address']))
+            except Exception:
+                # Handle it again when the pump retries it
+                processed.forget(cursor, [entry])
+                connection.commit()
+                raise
+
+            print('Answered register request')
+
+    except mysql.connector.Error as error:
+        connection.rollback()
+        print('Failed inserting new record into table: {}'.format(error))
+        raise
+
+    finally:
+        cursor.close()
+        connection.close()
+        print('MySQL connection is closed')
+
+
+def handle_transfer(new_entries):
+    ''' Handles transfer events '''
+
+    # print the data of the entries
+    for entry in new_entries:
+        print(entry['args'])
+
+
+class ResourceSpec:
+    ''' Contract events and functions, and database table, of a resource '''
+
+    def __init__(self, name: str, unit: str, petition_event: str, free_event: str,
+                 answer_function: str, free_function: str, use_mapping: str, available_variable: str,
+                 table: str, admission_policy: str = admission.GREEDY):
+        self.name = name
+        self.unit = unit
+        self.petition_event = petition_event
+        self.free_event = free_event
+        self.answer_function = answer_function
+        self.free_function = free_function
+        self.use_mapping = use_mapping
+        # Amount of the resource the contract considers available
+        self.available_variable = available_variable
+        self.table = table
+        # Policy used to pack a batch of petitions in the available capacity
+        self.admission_policy = admission_policy
+
+
+# Every resource served by the allocator. Adding a new resource only needs
+# a new entry here (plus its events and functions in the contract)
+RESOURCES = {
+    Resource.computing_power: ResourceSpec(
+        'cpu', '%', 'CPUPetition', 'FreeComputingPower', 'answerComputingPowerRequests',
+        '_freeComputingPower', 'cpuUse', 'availableComputingPower', 'cpu_allocations', admission.KNAPSACK),
+    Resource.storage: ResourceSpec(
+        'storage', 'MB', 'StoragePetition', 'FreeStorage', 'answerStorageRequests',
+        '_freeStorage', 'storageUse', 'availableStorage', 'storage_allocations'),
+    Resource.bandwidth: ResourceSpec(
+        'bandwidth', '%', 'BandwidthPetition', 'FreeBandwidth', 'answerBandwidthRequests',
+        '_freeBandwidth', 'bandwidthUse', 'availableBandwidth', 'bandwidth_allocations', admission.KNAPSACK),
+    Resource.memory: ResourceSpec(
+        'memory', '%', 'MemoryPetition', 'FreeMemory', 'answerMemoryRequests',
+        '_freeMemory', 'memoryUse', 'availableMemory', 'memory_allocations', admission.KNAPSACK),
+}
+
+
+def handle_petitions(contract, ledger: ResourceLedger, resource: Resource, petitions):
+    ''' Decides whether the petitions of a resource are granted or not.
 
     Most of the requirement checking is done directly by the smart contract, so here
     the main task of this method is to generate a unique id for the reservation - with
     the uuid4 module - and store all the data of the reservation in the database 
 
-    One of the requirements to be able to allocate memory is being reggistered in the system.
-    If not, the call will fail '''
-
-    print('[x] storage_allocator: started')
-
-    # Create filters for all events related to storage
-    petitionFilter = contract.events.StoragePetition.createFilter(
-        fromBlock=fromBlock,
-        toBlock=toBlock)
-    time.sleep(1)
-
-    # Concise contract to access the balances in a much more direct way
-    concise_contract = ConciseContract(contract)
-
+    One of the requirements to be able to allocate resources is being reggistered in the system.
+    If not, the call will fail.
+
+    All the petitions of the batch are ranked by the priority and credit of their clients
+    and packed against the available capacity by the admission scheduler. The whole batch
+    is then answered - and charged - in a single transaction, sent once the allocations
+    are committed '''
+
+    spec = RESOURCES[resource]
+    cache = client_cache.get_cache()
+    processed = processed_events.get_ledger()
+
+    # View calls are cached until the next block
+    views = get_view_cache(contract.web3, contract)
+
+    # Answers of the batch, sent together at the end
+    answers = _BatchAnswers()
+    # Charges of the batch, handed to the settlement engine once committed
+    engine = settlement.get_engine()
+    charges = []
+    # Leases of the accepted petitions, if grants have a lease duration
+    lease_table = leases.get_leases()
+    granted = []
+
+    # The balances of all the accounts of the batch are fetched at once
+    views.call_many([('balanceOf', (account,))
+                     for account in {petition['args']['account'] for petition in petitions}])
+
+    # All the petitions are priced with the amount available before the batch
+    available = ledger.available_of(resource)
+    candidates = []
+
+    for petition in petitions:
+        args = petition['args']
+        amount = int(args['amount'])
+        print('{} petition: {} -> {} {}'.format(
+            spec.name, args['account'], amount, spec.unit))
+
+        client = cache.get(args['account'])
+        if client is None or client.blocked or not cache.credit(args['account']):
+            # Unknown client, or blocked because its credit is exhausted
+            print('Rejecting request of unknown or blocked client')
+            answers.reject(args['account'], amount, args['requestId'])
+            continue
+
+        price = BlockchainServer.calculate_price_of_request(
+            resource, amount, available, args['account']) if amount <= available and available > 0 else None
+
+        if price is None:
+            # Not enough resources available
+            print('Rejecting request')
+            answers.reject(args['account'], amount, args['requestId'])
+            continue
+
+        # Get balance of the account requesting the resource. The one in the contract
+        # does not include the charges of the answers still being mined, which the
+        # cache already has, and the cache misses the transfers between clients
+        balance = min(views.call('balanceOf', args['account']), client.balance)
+
+        candidates.append(admission.Petition(
+            petition, args['account'], amount, price, balance,
+            client.priority, cache.credit(args['account'])))
+
+    admitted = admission.admit(candidates, available, spec.admission_policy)
+
+    # Reserve everything that was admitted at once. If someone else took part of the
+    # resource in the meantime, reserve them one by one in rank order
+    if not ledger.reserve({resource: sum(p.amount for p in admitted)}):
+        admitted = [p for p in admitted if ledger.reserve({resource: p.amount})]
+    admitted_ids = {id(p) for p in admitted}
+
+    for p in candidates:
+        if id(p) not in admitted_ids:
+            print('Rejecting request of {} for {} {} (priority {})'.format(
+                p.account, p.amount, spec.unit, p.priority))
+            answers.reject(p.account, p.amount, p.entry['args']['requestId'])
+
+    grant_ids = []
+    connection = None
+    try:
+        connection = _getConnection()
+        cursor = connection.cursor()
+
+        for p in admitted:
+            print('Accepting request of {} for {} {} (priority {}), price {}'.format(
+                p.account, p.amount, spec.unit, p.priority, p.price))
+            grant_id = uuid.uuid4().hex
+            grant_ids.append(grant_id)
+            answers.accept(p.account, p.amount, grant_id, p.price, p.entry['args']['requestId'])
+
+            # 1) Insert the allocation in the database, with the end of its lease
+            expires_at = lease_table.expiry()
+            cursor.execute("INSERT INTO {}(id, account_address, amount, expires_at) value ('{}','{}',{},{})"
+                           .format(spec.table, grant_id, p.account, p.amount,
+                                   'NULL' if expires_at is None else 'FROM_UNIXTIME({})'.format(expires_at)))
+            if expires_at is not None:
+                granted.append(Lease(grant_id, resource, p.account, p.amount, expires_at))
+
+            # 2) Insert new transaction pending of charge
+            due_at = engine.due_time()
+            cursor.execute("INSERT INTO pending_charges(id, account_address, charge, due_at) value ('{}','{}',{},FROM_UNIXTIME({}))"
+                           .format(grant_id, p.account, p.price, due_at))
+            charges.append((grant_id, p.account, p.price, due_at))
+
+        # 3) The petitions are handled together with the allocations
+        processed.record(cursor, petitions, spec.petition_event)
+        connection.commit()
+
+    except Exception as error:
+        # Give back what was reserved for the batch, whatever failed
+        ledger.release({resource: sum(p.amount for p in admitted)})
+        if connection is not None:
+            connection.rollback()
+        print('Failed inserting new record into table: {}'.format(error))
+        raise
+
+    finally:
+        if connection is not None:
+            cursor.close()
+            connection.close()
+
+    processed.remember(petitions)
+
+    # Answer and charge all the petitions at once, only after they are committed
     try:
-        while True:
-            newStoragePetitions = petitionFilter.get_new_entries()
-
-            if len(newStoragePetitions) != 0:
-                try:
-                    connection = _getConnection()
-                    cursor = connection.cursor()
-
-                    # Acquire lock to change the reservations
-                    with lock:
-                        for petition in newStoragePetitions:
-                            args = petition['args']
-                            print('Args: {}, {}'.format(
-                                args['account'], args['amount']))
-
-                            # Make the appropriate comprobations
-                            if available_storage.value - args['amount'] >= 0:
-                                st_id = uuid.uuid4()
-                                price = BlockchainServer.calculate_price_of_request(Resource.storage, int(args['amount']),available_storage, args['account'])
-                                print('Price of the request:', price, 'IoTokens')
-
-                                # Get balance of the account requesting storage
-                                balance = concise_contract.balanceOf(args['account'])
-                                print('Balance is {} and price is {}'.format(balance, price))
-
-                                if balance >= price:
-                                    # Decrease the balance
-                                    print('Accepting Request')
-                                    # Update balance, False = decrement
-                                    contract.functions.updateBalance(
-                                        args['account'],
-                                        int(price),
-                                        False
-                                    ).transact()
-                                    contract.functions.answerStorageRequest(
-                                        args['account'],
-                                        args['amount'],
-                                        str(st_id),
-                                        True).transact()
-                                    # Add storage reservation to the database
-                                    cursor.execute('''
-                                        INSERT INTO storage_allocations(id, account_address, amount) value 
-                                        ('{}','{}',{})'''.format(str(st_id), args['account'], args['amount']))
-                                    # Update client balance in the database
-                                    cursor.execute("UPDATE clients set coin_balance = coin_balance - {} where account_address = '{}'".format(price, args['account']))
-
-                                    # Insert new transaction pending of charge
-                                    cursor.execute("INSERT INTO pending_charges(id, account_address, charge) value ('{}','{}',{})"
-                                    .format(st_id, args['account'], price))
-                                    connection.commit()
-
-                                    available_storage.value -= args['amount']
-                                    print('Storage available:',
-                                        available_storage.value, 'MB')
-                                    new_balance = concise_contract.balanceOf(args['account'])
-                                    print('New balance', new_balance)
-                                
-                                else:
-                                    # Not enough balance in the client's account
-                                    print('Not enough funds')
-                                    print('Rejecting request')
-                                    contract.functions.answerStorageRequest(
-                                    args['account'],
-                                    args['amount'],
-                                    '',
-                                    False).transact()
-
-
-                            else:
-                                # Not enough available storage
-                                print('Rejecting request')
-                                contract.functions.answerStorageRequest(
-                                    args['account'],
-                                    args['amount'],
-                                    '',
-                                    False).transact()
-
-                except mysql.connector.Error as error:
-                    connection.rollback()
-                    print('Failed inserting new record into table: {}'.format(error))
-
-                finally:
-                    cursor.close()
-                    connection.close()
-
-            time.sleep(1)
-
-    except KeyboardInterrupt:
-        print("[*] storage_allocator: exiting...")
-        sys.exit(0)
-
-
-def free_storage_listener(contract, available_storage: Value, lock: Lock, fromBlock=0, toBlock='latest'):
-    ''' Receives the storage freeing requests from all the clients.
+        tx_submitter.submit(getattr(contract.functions, spec.answer_function)(*answers.arguments()))
+    except Exception:
+        # Nothing was answered nor charged, undo the batch so it is handled again
+        _undo_petitions(spec, grant_ids, petitions)
+        ledger.release({resource: sum(p.amount for p in admitted)})
+        raise
+
+    for p in admitted:
+        cache.add_balance(p.account, -p.price)
+    # The balances of the charged accounts have changed
+    views.invalidate(*{p.account for p in admitted})
+    for charge in charges:
+        engine.add(*charge)
+    for lease in granted:
+        lease_table.add(lease)
+    print('Answered {} {} petitions, {} accepted. {} available: {} {}'.format(
+        len(answers), spec.name, len(admitted), spec.name,
+        ledger.available_of(resource), spec.unit))
+
+
+def _undo_petitions(spec: ResourceSpec, grant_ids: list, petitions):
+    ''' Deletes the allocations and charges of a batch whose answer could not be sent '''
+    processed = processed_events.get_ledger()
+    connection = _getConnection()
+    cursor = connection.cursor()
+    try:
+        if len(grant_ids) != 0:
+            placeholders = ', '.join(['%s'] * len(grant_ids))
+            cursor.execute("DELETE FROM {} WHERE id IN ({})".format(spec.table, placeholders), grant_ids)
+            cursor.execute("DELETE FROM pending_charges WHERE id IN ({})".format(placeholders), grant_ids)
+        processed.forget(cursor, petitions)
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def handle_free(contract, ledger: ResourceLedger, resource: Resource, requests):
+    ''' Receives the freeing requests of a resource from all the clients.
     After that, it deletes the entries for that reservation-id from the database,
     and proceeds to execute the onlyOwner method of the smart contract in order
-    to update the contract's memory management mapping and current storage available '''
-
-    print('[x] free_storage: started')
+    to update the contract's resource mapping and the amount available '''
 
-    freeStorageFilter = contract.events.FreeStorage.createFilter(
-        fromBlock=fromBlock,
-        toBlock=toBlock)
-    time.sleep(1)
+    spec = RESOURCES[resource]
+    views = get_view_cache(contract.web3, contract)
+    processed = processed_events.get_ledger()
 
     try:
-        while True:
-            requests = freeStorageFilter.get_new_entries()
+        connection = _getConnection()
+        cursor = connection.cursor()
+
+        for entry in requests:
+            args = entry['args']  # Devuelve account e id
+            cursor.execute("SELECT amount, UNIX_TIMESTAMP(expires_at) from {} WHERE id = '{}'"
+                           .format(spec.table, args['grantID']))
+            results = cursor.fetchall()
+            deleted = 0
+            if len(results) == 0:
+                print('Unknown {} reservation {}'.format(spec.name, args['grantID']))
+            else:
+                amount, expires_at = results[0]
+                cursor.execute("DELETE FROM {} WHERE id ='{}'"
+                               .format(spec.table, args['grantID']))
+                deleted = cursor.rowcount
+                # The lease may have been reclaimed in the meantime
+                if deleted == 0:
+                    print('{} reservation {} already reclaimed'.format(spec.name, args['grantID']))
+
+            processed.record(cursor, [entry], spec.free_event)
+            connection.commit()
+            processed.remember([entry])
+            if deleted == 0:
+                continue
+            print("Deleted {} reservation".format(spec.name))
+
+            print("{} use before: {}".format(
+                spec.name, views.call(spec.use_mapping, args['account'])))
+
+            # Execute the owner only method of the contract, once the free is committed
+            try:
+                tx_submitter.submit(getattr(contract.functions, spec.free_function)(
+                    args['account'], amount))
+            except Exception:
+                # The contract still has it, put the allocation back so the
+                # free is handled again when the pump retries it
+                cursor.execute("INSERT INTO {}(id, account_address, amount, expires_at) value ('{}','{}',{},{})"
+                               .format(spec.table, args['grantID'], args['account'], amount,
+                                       'NULL' if expires_at is None else 'FROM_UNIXTIME({})'.format(expires_at)))
+                processed.forget(cursor, [entry])
+                connection.commit()
+                raise
+
+            leases.get_leases().release(args['grantID'])
+            views.invalidate(args['account'])
+
+            ledger.release({resource: amount})
+            print('{} available: {} {}'.format(
+                spec.name, ledger.available_of(resource), spec.unit))
+
+    except mysql.connector.Error as error:
+        connection.rollback()
+        print('Failed inserting new record into table: {}'.format(error))
+        raise
+
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def handle_renewals(new_entries):
+    ''' Extends the leases of the grants renewed by their clients.
+    Grants without lease, or whose lease has already expired, are ignored '''
+
+    lease_table = leases.get_leases()
+    processed = processed_events.get_ledger()
 
-            if len(requests) != 0:
-
-                try:
-                    connection = _getConnection()
-                    cursor = connection.cursor()
-
-                    for entry in requests:
-                        args = entry['args']  # Devuelve account e id
-                        cursor.execute("SELECT amount from storage_allocations WHERE id = '{}'"
-                                       .format(args['grantID']))
-                        results = cursor.fetchall()
-                        print(results)
-                        amount = results[0][0]
-
-                        cursor.execute("DELETE FROM storage_allocations WHERE id ='{}'"
-                                       .format(args['grantID']))
-                        print("Deleted storage reservation")
-                        connection.commit()
-
-                        cc = ConciseContract(contract)
-                        print("Storage use:", cc.storageUse(args['account']))
-
-                        contract.functions._freeStorage(
-                            args['account'], amount).transact()
-                        print('transacted function')
-
-                        print("Storage use:", cc.storageUse(args['account']))
-
-                        with lock:
-                            available_storage.value += amount
+    try:
+        connection = _getConnection()
+        cursor = connection.cursor()
+
+        renewed = []
+        for entry in new_entries:
+            args = entry['args']
+            lease = lease_table.get(args['grantID'])
+            # Only the owner of the grant can renew it
+            if lease is None or lease.account != args['account']:
+                print('Can not renew lease of grant {}'.format(args['grantID']))
+                continue
+
+            expires_at = lease_table.expiry()
+            cursor.execute("UPDATE {} SET expires_at = FROM_UNIXTIME({}) WHERE id = '{}'"
+                           .format(RESOURCES[lease.resource].table, expires_at, args['grantID']))
+            renewed.append((args['grantID'], expires_at))
+
+        processed.record(cursor, new_entries, 'LeaseRenewal')
+        connection.commit()
+        processed.remember(new_entries)
+        for grant_id, expires_at in renewed:
+            lease_table.renew(grant_id, expires_at)
+        print('Renewed {} leases'.format(len(renewed)))
+
+    except mysql.connector.Error as error:
+        connection.rollback()
+        print('Failed renewing leases: {}'.format(error))
+        raise
+
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def reclaim_expired_leases(contract, ledger: ResourceLedger, now: float = None):
+    ''' Takes back the resources of all the leases that have expired.
+
+    The allocations are deleted in a single database transaction and the contract is
+    updated with one call to the free function per account and resource, whatever the
+    number of grants of that account that have expired. The grants whose free can not
+    be sent are put back, to be reclaimed in the next round '''
+
+    expired = leases.get_leases().expired(now)
+    if len(expired) == 0 and len(_unnotified) == 0:
+        return 0
 
-                except mysql.connector.Error as error:
-                    connection.rollback()
-                    print('Failed inserting new record into table: {}'.format(error))
+    connection = None
+    try:
+        connection = _getConnection()
+        cursor = connection.cursor()
+
+        # Leases deleted, of the shape { (resource, account) : [lease] }
+        freed = {}
+        for lease in expired:
+            cursor.execute("DELETE FROM {} WHERE id = '{}'"
+                           .format(RESOURCES[lease.resource].table, lease.grant_id))
+            # Freed by its client in the meantime
+            if cursor.rowcount == 0:
+                continue
+            freed.setdefault((lease.resource, lease.account), []).append(lease)
+        connection.commit()
+
+    except mysql.connector.Error as error:
+        if connection is not None:
+            connection.rollback()
+        print('Failed reclaiming expired leases, retrying later: {}'.format(error))
+        # Try again in the next round
+        for lease in expired:
+            leases.get_leases().add(lease)
+        return 0
+
+    finally:
+        if connection is not None:
+            cursor.close()
+            connection.close()
+
+    views = get_view_cache(contract.web3, contract)
+    for (resource, account), freed_leases in freed.items():
+        spec = RESOURCES[resource]
+        amount = sum(lease.amount for lease in freed_leases)
+        try:
+            tx_submitter.submit(getattr(contract.functions, spec.free_function)(account, amount))
+        except Exception as error:
+            print('Failed freeing {} of {}, retrying later: {}'.format(spec.name, account, error))
+            _restore_leases(freed_leases)
+            continue
+
+        views.invalidate(account)
+        ledger.release({resource: amount})
+        _unnotified.extend((account, lease.grant_id) for lease in freed_leases)
+        print('Reclaimed {} {} of {}. {} available: {} {}'.format(
+            amount, spec.unit, account, spec.name, ledger.available_of(resource), spec.unit))
+
+    # Tell the clients which of their grants are gone, together with the ones
+    # that could not be told in the previous rounds
+    if len(_unnotified) != 0:
+        reclaimed = list(_unnotified)
+        try:
+            tx_submitter.submit(contract.functions.notifyExpiredLeases(
+                [account for account, _ in reclaimed],
+                [_grant_id_bytes(grant_id) for _, grant_id in reclaimed]))
+            del _unnotified[:len(reclaimed)]
+        except Exception as error:
+            print('Failed notifying {} reclaimed grants, retrying later: {}'.format(len(reclaimed), error))
 
-                finally:
-                    cursor.close()
-                    connection.close()
+    return len(expired)
 
-            time.sleep(1)
 
-    except KeyboardInterrupt:
-        print("[*] free_storage: exiting...")
-        sys.exit(0)
+def _restore_leases(expired: list):
+    ''' Inserts back the allocations of expired leases whose resources could not be
+    freed in the contract, and their leases, so they are reclaimed in the next round '''
+    connection = _getConnection()
+    cursor = connection.cursor()
+    try:
+        for lease in expired:
+            cursor.execute("INSERT IGNORE INTO {}(id, account_address, amount, expires_at) value ('{}','{}',{},FROM_UNIXTIME({}))"
+                           .format(RESOURCES[lease.resource].table, lease.grant_id, lease.account,
+                                   lease.amount, lease.expires_at))
+        connection.commit()
+    except mysql.connector.Error as error:
+        connection.rollback()
+        print('Failed restoring expired leases: {}'.format(error))
+    finally:
+        cursor.close()
+        connection.close()
 
+    for lease in expired:
+        leases.get_leases().add(lease)
 
-def cpu_allocator(contract,  available_cpu: Value, lock: Lock, fromBlock=0, toBlock='latest'):
-    """ Similar to the storage allocator, this method allocates cpu computing power to a certain
-    client after it's requested, returning an id for said reservation """
 
-    print('[x] cpu_allocator: started')
+def build_event_pump(w3: Web3, contract, ledger: ResourceLedger, fromBlock=0):
+    ''' Builds the event pump that pulls all the contract events and sends each one
+    of them to its handler. Every handler resumes from its last checkpoint stored
+    in the database and logs that were already processed are never handled twice '''
 
-    # Create the filter necessary
-    cpu_allocator_filter = contract.events.CPUPetition.createFilter(
-        fromBlock=fromBlock,
-        toBlock=toBlock)
-    time.sleep(1)
+    pump = EventPump(w3, contract, fromBlock=fromBlock,
+                     checkpoints=CheckpointStore(_getConnection),
+                     ledger=processed_events.setup(_getConnection))
 
-    # Concise contract to access the balances in a much more direct way
-    concise_contract = ConciseContract(contract)
+    pump.register('Register', partial(handle_register, contract))
+    pump.register('Transfer', handle_transfer)
+    pump.register('LeaseRenewal', handle_renewals)
 
-    try:
-        # Main loop of the receiver
-        while True:
-            new_cpu_petitions = cpu_allocator_filter.get_new_entries()
-
-            if len(new_cpu_petitions) != 0:
-
-                # Open mysql connection
-                try:
-                    connection = _getConnection()
-                    cursor = connection.cursor()
-
-                    with lock:
-                        for petition in new_cpu_petitions:
-                            args = petition['args']
-                            print(
-                                'Cpu_petition: {} -> {}'.format(args['account'], args['amount']))
-
-                            # Check to see if rejecting and accepting works, we need
-                            # to change it after
-                            if available_cpu.value - args['amount'] >= 0:
-                                cpu_id = uuid.uuid4()
-                                price = BlockchainServer.calculate_price_of_request(Resource.computing_power, int(args['amount']),available_cpu, args['account'])
-                                
-                                # Get balance of the account requesting storage
-                                balance = concise_contract.balanceOf(args['account'])
-                                print('Balance is {} and price is {}'.format(balance, price))
-
-                                if balance >= price:
-                                    # Decrease the balance
-                                    print('Accepting Request')
-                                    # Update balance, False = decrement
-                                    contract.functions.updateBalance(
-                                        args['account'],
-                                        int(price),
-                                        False
-                                    ).transact()
-                                    contract.functions.answerComputingPowerRequest(
-                                        args['account'],
-                                        args['amount'],
-                                        str(cpu_id),
-                                        True).transact()
-                                    available_cpu.value -= args['amount']
-
-                                    # 1) Insert cpu allocation in the database
-                                    cursor.execute("""
-                                    INSERT INTO cpu_allocations(id, account_address, amount) value
-                                    ('{}', '{}', {})""".format(str(cpu_id), args['account'], args['amount']))
-
-                                    # 2) Update client balance in the database
-                                    cursor.execute("UPDATE clients set coin_balance = coin_balance - {} where account_address = '{}'".format(price, args['account']))
-
-                                    # 3) Insert new transaction pending of charge
-                                    cursor.execute("INSERT INTO pending_charges(id, account_address, charge) value ('{}','{}',{})"
-                                    .format(cpu_id, args['account'], price))
-
-                                    # Commit changes
-                                    connection.commit()
-
-                                    new_balance = concise_contract.balanceOf(args['account'])
-                                    print('New balance', new_balance)
-                                
-                                else:
-                                    # Client does not have enough funds
-                                    print('Not enough funds')
-                                    print('Rejecting request')
-                                    contract.functions.answerComputingPowerRequest(
-                                    args['account'],
-                                    args['amount'],
-                                    '',
-                                    False).transact()
-
-                            else:
-                                # Not enough spare CPU
-                                print('Rejecting request... number {} is not even'
-                                      .format(args['amount']))
-                                contract.functions.answerComputingPowerRequest(
-                                    args['account'],
-                                    args['amount'],
-                                    '',
-                                    False).transact()
-
-                except mysql.connector.Error as error:
-                    connection.rollback()
-                    print('Error in mysql: {}'.format(error))
-
-                finally:
-                    cursor.close()
-                    connection.close()
-
-            # Sleep until the next comprobation
-            time.sleep(1)
-
-    except KeyboardInterrupt:
-        print("[*] cpu_allocator: exiting...")
-        sys.exit(0)
-
-
-def free_cpu_listener(contract, available_cpu: Value, lock: Lock, fromBlock=0, toBlock='latest'):
-    """ Receives the CPU freeing petitions from all the clients.
-    After that, it deletes the database entries of the given reservation indexed by an uuid
-    and executes the owner-only accesible function in the smart contract to complete the procedure
-    of making the memory available again """
-
-    print('[x] free_cpu: started')
-
-    # Create the listener for the events
-    free_cpu_listener = contract.events.FreeComputingPower.createFilter(
-        fromBlock=fromBlock,
-        toBlock=toBlock)
-    time.sleep(1)
+    # The petitions and frees of every resource
+    for resource, spec in RESOURCES.items():
+        pump.register(spec.petition_event, partial(
+            handle_petitions, contract, ledger, resource))
+        pump.register(spec.free_event, partial(
+            handle_free, contract, ledger, resource))
 
-    try:
-        while True:
-            requests = free_cpu_listener.get_new_entries()
+    return pump
 
-            if len(requests) != 0:
 
-                try:
-                    connection = _getConnection()
-                    cursor = connection.cursor()
+class _BatchAnswers:
+    ''' Collects the answers to a batch of petitions so they can be sent
+    to the contract's batch entry points in a single transaction. Every answer
+    echoes the request id chosen by the client in its petition '''
 
-                    for entry in requests:
-                        args = entry['args']  # Devuelve account e id
-                        cursor.execute("SELECT amount from cpu_allocations WHERE id = '{}'"
-                                       .format(args['grantID']))
-                        results = cursor.fetchall()
-                        print(results)
-                        amount = results[0][0]
+    def __init__(self):
+        self.accounts = []
+        self.amounts = []
+        self.grant_ids = []
+        self.accepted = []
+        self.charges = []
+        self.request_ids = []
 
-                        # Delete the cpu reservation from the database
-                        cursor.execute("DELETE FROM cpu_allocations WHERE id ='{}'"
-                                       .format(args['grantID']))
-                        connection.commit()
-                        print("Deleted cpu reservation")
-                        connection.commit()
+    def accept(self, account: str, amount: int, grant_id: str, charge: int, request_id: int):
+        self._add(account, amount, grant_id, True, charge, request_id)
 
-                        cc = ConciseContract(contract)
-                        print("Comp. Power use before:",
-                              cc.cpuUse(args['account']))
+    def reject(self, account: str, amount: int, request_id: int):
+        self._add(account, amount, '', False, 0, request_id)
 
-                        # Execute the owner only method of the contract
-                        contract.functions._freeComputingPower(
-                            args['account'], amount).transact()
+    def arguments(self):
+        ''' Arguments for the contract batch functions. The grant ids travel as bytes32 '''
+        grant_ids = [_grant_id_bytes(grant_id) for grant_id in self.grant_ids]
+        return (self.accounts, self.amounts, grant_ids, self.accepted, self.charges, self.request_ids)
 
-                        print("Comp. Power use after:",
-                              cc.cpuUse(args['account']))
+    def __len__(self):
+        return len(self.accounts)
 
-                        with lock:
-                            available_cpu.value += amount
-                            print('Updated amount:', available_cpu.value)
+    def _add(self, account, amount, grant_id, accepted, charge, request_id):
+        self.accounts.append(account)
+        self.amounts.append(int(amount))
+        self.grant_ids.append(grant_id)
+        self.accepted.append(accepted)
+        self.charges.append(int(charge))
+        self.request_ids.append(int(request_id))
 
-                except mysql.connector.Error as error:
-                    connection.rollback()
-                    print('Failed inserting new record into table: {}'.format(error))
 
-                finally:
-                    cursor.close()
-                    connection.close()
+# Grants reclaimed whose clients have not been told yet, of the shape [(account, grant_id)]
+_unnotified = []
 
-            time.sleep(1)
 
-    except KeyboardInterrupt:
-        print("[*] free_cpu: exiting...")
-        sys.exit(0)
+def _grant_id_bytes(grant_id: str):
+    ''' Grant id as the bytes32 taken by the batch functions of the contract '''
+    return Web3.toBytes(text=grant_id).ljust(32, b'\0')
 
 
 def _getConnection():
@@ -499,6 +609,6 @@ def _createConnectionPool():
         pool_reset_session=True,
         database='tfg',
         host='localhost',
-        user=user,
-        password=pwd
+        user='diego',
+        password='passwd'
     )
@@ -0,0 +1,261 @@
+''' Single event pump that replaces the per-event polling listeners.
+
+Instead of keeping one filter (and one process) per contract event, the pump
+pulls the logs of every event it has a handler for with a single eth_getLogs
+call per block range and hands each batch of logs to its handler '''
+
+import time
+import sys
+from web3 import Web3
+from web3.utils.events import get_event_data
+from eth_utils import event_abi_to_log_topic
+from checkpoints import BLOCK_DONE
+
+
+class EventPump:
+    ''' Pulls all the contract logs and dispatches them to typed handlers.
+
+    Handlers receive a list of decoded entries with the same shape as the ones
+    returned by the old filters' get_new_entries(). A handler sees all the logs
+    of its own event in the fetched block range as a single batch.
+
+    If a checkpoint store is given, every handler resumes from the last log it
+    processed and logs at or before its checkpoint are never delivered again.
+    If a processed events ledger is given, logs re-delivered by the node are
+    dropped before reaching the handlers. The handlers record the logs they
+    process in the ledger themselves, in their own database transaction.
+
+    A handler that fails does not stop the others: its batch is parked and retried
+    in the next polls until it succeeds, while the pump goes on with the logs of the
+    other handlers. The later batches of that handler are parked behind it, so its logs
+    are still handled in order, and its stored checkpoint stays before the oldest
+    parked log, so they are delivered again if the server is restarted '''
+
+    # Maximum number of blocks asked for in a single eth_getLogs call
+    MAX_BLOCK_RANGE = 1000
+
+    # Number of blocks after which the checkpoints are persisted even if
+    # no logs were processed
+    CHECKPOINT_INTERVAL = 100
+
+    # Maximum seconds between polls while the node keeps failing, and between
+    # retries of a parked batch
+    MAX_BACKOFF = 60
+
+    def __init__(self, w3: Web3, contract, fromBlock=0, poll_interval=1, checkpoints=None, ledger=None):
+        self.w3 = w3
+        self.contract = contract
+        self.from_block = fromBlock
+        self.next_block = None
+        self.poll_interval = poll_interval
+        self.checkpoint_store = checkpoints
+        self.ledger = ledger
+
+        # Event abis indexed by their topic, of the shape { topic : abi }
+        self.event_abis = {
+            Web3.toHex(event_abi_to_log_topic(abi)): abi
+            for abi in contract.abi if abi['type'] == 'event'}
+
+        # Registered handlers of the shape { topic : (name, handler) }
+        self.handlers = {}
+
+        # Position of the last log processed by every handler,
+        # of the shape { name : (block_number, log_index) }
+        self.checkpoints = {}
+        self._last_saved_block = None
+
+        # Batches waiting for their handler to succeed, in the order of their logs,
+        # of the shape { name : [(topic, batch)] }
+        self.parked = {}
+        # Failures of the oldest parked batch of every handler and the time it
+        # is retried, of the shape { name : (failures, retry_at) }
+        self.failures = {}
+
+    def register(self, event_name: str, handler, name: str = None):
+        ''' Registers the handler that will receive the logs of an event.
+        The name identifies the checkpoint of the handler and defaults to the event name '''
+        for topic, abi in self.event_abis.items():
+            if abi['name'] == event_name:
+                self.handlers[topic] = (name or event_name, handler)
+                return
+        raise ValueError('Unknown event {}'.format(event_name))
+
+    def poll(self):
+        ''' Fetches the logs of all the new blocks and dispatches them.
+        Returns the number of logs processed '''
+
+        if self.next_block is None:
+            self._restore_checkpoints()
+
+        processed = self._retry_parked()
+        latest = self.w3.eth.blockNumber
+
+        while self.next_block <= latest:
+            to_block = min(self.next_block + self.MAX_BLOCK_RANGE - 1, latest)
+            logs = self.w3.eth.getLogs({
+                'address': self.contract.address,
+                'fromBlock': self.next_block,
+                'toBlock': to_block,
+                'topics': [list(self.handlers.keys())]})
+
+            processed += self._dispatch(logs)
+            self.next_block = to_block + 1
+
+            # Every handler has now been given all the logs of the range
+            for name, _ in self.handlers.values():
+                self.checkpoints[name] = (to_block, BLOCK_DONE)
+            if len(logs) != 0 or self._last_saved_block is None or \
+                    to_block - self._last_saved_block >= self.CHECKPOINT_INTERVAL:
+                self._save_checkpoints({name: self._stored_checkpoint(name)
+                                        for name in self.checkpoints})
+                self._last_saved_block = to_block
+
+        return processed
+
+    def run_forever(self):
+        ''' Polls the node until explicit shutdown '''
+        print('[x] event_pump: started')
+        interval = self.poll_interval
+        try:
+            while True:
+                try:
+                    self.poll()
+                    interval = self.poll_interval
+                except Exception as error:
+                    # The same range is fetched again when the node is back
+                    interval = min(2*interval, self.MAX_BACKOFF)
+                    print('[*] event_pump: error polling, retrying in {}s: {}'.format(interval, error))
+                time.sleep(interval)
+
+        except KeyboardInterrupt:
+            print('[*] event_pump: exiting...')
+            sys.exit(0)
+
+    def _dispatch(self, logs):
+        ''' Decodes the logs and sends all the logs of the same event to their handler
+        as a single batch, so for instance all the petitions of a resource in the range
+        are admitted together. The handlers are called in the order of the first log of
+        their event. Returns the number of logs dispatched '''
+
+        # Batches in the order their first log was seen, of the shape { topic : batch }
+        batches = {}
+
+        for log in sorted(logs, key=lambda l: (l['blockNumber'], l['logIndex'])):
+            topic = Web3.toHex(log['topics'][0])
+            if topic not in self.handlers:
+                continue
+
+            # Skip the logs already processed before the last shutdown
+            name, _ = self.handlers[topic]
+            if (log['blockNumber'], log['logIndex']) <= self.checkpoints.get(name, (-1, -1)):
+                continue
+
+            batches.setdefault(topic, []).append(get_event_data(self.event_abis[topic], log))
+
+        return sum(self._handle(topic, batch) for topic, batch in batches.items())
+
+    def _handle(self, topic, batch):
+        ''' Sends a batch to its handler, or parks it behind the ones of the handler
+        already parked, and checkpoints it. Returns the number of logs handled '''
+        name, _ = self.handlers[topic]
+        last = batch[-1]
+
+        handled = 0
+        if name in self.parked:
+            self.parked[name].append((topic, batch))
+        else:
+            handled = self._run_handler(topic, batch)
+            if handled is None:
+                self.parked[name] = [(topic, batch)]
+                self._failed(name, 1)
+                handled = 0
+
+        self.checkpoints[name] = (last['blockNumber'], last['logIndex'])
+        self._save_checkpoints({name: self._stored_checkpoint(name)})
+        return handled
+
+    def _run_handler(self, topic, batch):
+        ''' Runs the handler of a batch. Returns the number of logs handled, None if
+        the handler failed '''
+        name, handler = self.handlers[topic]
+
+        if self.ledger is not None:
+            batch = self.ledger.filter_new(batch)
+        if len(batch) == 0:
+            return 0
+
+        try:
+            handler(batch)
+        except Exception as error:
+            print('[*] event_pump: {} failed with {} logs, parking them: {}'.format(
+                name, len(batch), error))
+            return None
+
+        return len(batch)
+
+    def _failed(self, name: str, failures: int):
+        # The oldest parked batch is retried waiting twice as long after every failure
+        self.failures[name] = (failures, time.time() + min(2**(failures - 1), self.MAX_BACKOFF))
+
+    def _retry_parked(self):
+        ''' Runs again the batches whose handler failed, in order, until one of them
+        fails again. Returns the number of logs handled '''
+        handled = 0
+        now = time.time()
+        for name in list(self.parked):
+            failures, retry_at = self.failures[name]
+            if retry_at > now:
+                continue
+
+            batches = self.parked[name]
+            while len(batches) != 0:
+                topic, batch = batches[0]
+                result = self._run_handler(topic, batch)
+                if result is None:
+                    self._failed(name, failures + 1)
+                    break
+                handled += result
+                batches.pop(0)
+
+            if len(batches) == 0:
+                del self.parked[name]
+                del self.failures[name]
+                print('[x] event_pump: {} handled all its parked logs'.format(name))
+                self._save_checkpoints({name: self._stored_checkpoint(name)})
+
+        return handled
+
+    def _stored_checkpoint(self, name: str):
+        ''' Checkpoint saved for the handler: the last log given to it, or the one
+        before its oldest parked log, so parked logs are delivered again after a restart '''
+        if name in self.parked:
+            first = self.parked[name][0][1][0]
+            return (first['blockNumber'], first['logIndex'] - 1)
+        return self.checkpoints[name]
+
+    def _restore_checkpoints(self):
+        ''' Loads the stored checkpoints and resumes from the oldest one '''
+        if self.checkpoint_store is not None:
+            stored = self.checkpoint_store.load()
+            for name, _ in self.handlers.values():
+                if name in stored:
+                    self.checkpoints[name] = stored[name]
+
+        # Resume from the first block not fully processed by every handler
+        resume = []
+        for name, _ in self.handlers.values():
+            if name not in self.checkpoints:
+                resume.append(self.from_block)
+            else:
+                block, index = self.checkpoints[name]
+                resume.append(block + 1 if index == BLOCK_DONE else block)
+
+        self.next_block = min(resume) if len(resume) != 0 else self.from_block
+
+        if self.ledger is not None:
+            self.ledger.load(fromBlock=self.next_block)
+        print('[x] event_pump: resuming from block', self.next_block)
+
+    def _save_checkpoints(self, checkpoints: dict):
+        if self.checkpoint_store is not None:
+            self.checkpoint_store.save(checkpoints)
@@ -1,23 +1,22 @@
 from web3.contract import ConciseContract
-from solc import compile_source
 import pprint
 from web3 import Web3
-import os
+from receipt_watcher import get_watcher
+import deployments
+import artifacts
 
 def deploy_contracts(w3: Web3, account: str, total_storage: int):
+    ''' Compiles and deploys a new instance of the contract and records it
+    in the deployment registry '''
 
     pp = pprint.PrettyPrinter(indent=4)
 
+    # Read the contract source
+    token_source = deployments.read_source()
 
-    with open(os.path.dirname(os.path.abspath(__file__)) + '/../contracts/token.sol', 'r') as tokenContract:
-        
-        # Read the files and return the ConsiseContracts
-        token_source = tokenContract.read()
-
-    compiled_token = compile_source(token_source)
-
-    # Get the compiled contracts ready for deployment
-    token_interface = compiled_token['<stdin>:IoToken']
+    # Get the compiled contracts ready for deployment. It is only
+    # compiled if the artifact cache does not have it yet
+    token_interface = artifacts.compile_contract('IoToken', token_source)
 
 
     # Create contract
@@ -27,7 +26,7 @@ def deploy_contracts(w3: Web3, account: str, total_storage: int):
 
     # Deploy the Token (We configure storage available as 1TB)
     tx_hash = Token.constructor(total_storage, 210000,account).transact()
-    tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
+    tx_receipt = get_watcher(w3).wait(tx_hash)
 
     # Create contract instance
     iot_token = w3.eth.contract(
@@ -36,4 +35,32 @@ def deploy_contracts(w3: Web3, account: str, total_storage: int):
     pp.pprint(token_interface['abi'])
     print('Contract address', tx_receipt.contractAddress)
 
+    # Register it so the next starts and the clients attach to it
+    deployments.record(w3, tx_receipt.contractAddress, token_interface['abi'],
+                       deployments.source_hash(token_source), tx_receipt.blockNumber)
+
     return iot_token
+
+
+def attach_contract(w3: Web3):
+    ''' Returns the contract registered for this network and the block it was
+    deployed in. Fails if there is none or the source has changed since then,
+    in which case the contract has to be deployed explicitly '''
+
+    deployment = deployments.load(w3)
+    if deployment is None:
+        raise RuntimeError('No contract deployed in this network, deploy it with --deploy')
+
+    if deployment['source_hash'] != deployments.source_hash(deployments.read_source()):
+        raise RuntimeError('The contract source has changed since it was deployed, deploy it again with --deploy')
+
+    if not deployments.is_deployed(w3, deployment):
+        raise RuntimeError('There is no contract at {}, deploy it again with --deploy'
+                           .format(deployment['address']))
+
+    print('Attached to contract', deployment['address'])
+    iot_token = w3.eth.contract(
+        address = Web3.toChecksumAddress(deployment['address']),
+        abi = deployment['abi'])
+
+    return iot_token, deployment['block_number']
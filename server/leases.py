@@ -0,0 +1,109 @@
+''' Leases of the resources granted to the clients.
+
+Every grant can be given a lease duration. The client has to renew the lease before
+it expires, otherwise the server takes the resources back. The expiry times are kept
+in a hierarchical timing wheel, so finding the expired leases does not require
+scanning all of them nor querying the database '''
+
+import threading
+import time
+
+from timing_wheel import TimingWheel
+
+
+class Lease:
+    ''' A grant of some amount of a resource to a client '''
+
+    def __init__(self, grant_id: str, resource, account: str, amount: int, expires_at: float):
+        self.grant_id = grant_id
+        self.resource = resource
+        self.account = account
+        self.amount = amount
+        self.expires_at = expires_at
+
+
+class LeaseTable:
+    ''' Active leases indexed by grant id '''
+
+    def __init__(self, duration: int):
+        # Seconds a grant lasts without being renewed, None for grants without lease
+        self.duration = duration
+
+        # { grant_id : Lease }
+        self.leases = {}
+        self.wheel = TimingWheel(time.time())
+        self.lock = threading.Lock()
+
+    def load(self, get_connection, tables: dict):
+        ''' Loads the leases of the allocation tables, of the shape { resource : table } '''
+        connection = get_connection()
+        cursor = connection.cursor()
+        try:
+            for resource, table in tables.items():
+                cursor.execute('''SELECT id, account_address, amount, UNIX_TIMESTAMP(expires_at)
+                    FROM {} WHERE expires_at IS NOT NULL'''.format(table))
+                for grant_id, account, amount, expires_at in cursor.fetchall():
+                    self.add(Lease(grant_id, resource, account, int(amount), float(expires_at)))
+            print('Loaded {} leases'.format(len(self.leases)))
+        finally:
+            cursor.close()
+            connection.close()
+
+    def expiry(self, now: float = None):
+        ''' Expiry time of a grant made or renewed now, None if grants have no lease '''
+        if not self.duration:
+            return None
+        return (time.time() if now is None else now) + self.duration
+
+    def add(self, lease: Lease):
+        ''' Adds a lease already stored in its allocation table '''
+        with self.lock:
+            self.leases[lease.grant_id] = lease
+            self.wheel.add(lease.grant_id, lease.expires_at)
+
+    def get(self, grant_id: str):
+        with self.lock:
+            return self.leases.get(grant_id)
+
+    def renew(self, grant_id: str, expires_at: float):
+        ''' Extends a lease. The old timer is ignored when it fires '''
+        with self.lock:
+            lease = self.leases.get(grant_id)
+            if lease is None:
+                return None
+            lease.expires_at = expires_at
+            self.wheel.add(grant_id, expires_at)
+            return lease
+
+    def release(self, grant_id: str):
+        ''' Removes a lease, because it was freed or reclaimed. Returns it if it was active '''
+        with self.lock:
+            return self.leases.pop(grant_id, None)
+
+    def expired(self, now: float = None):
+        ''' Removes and returns all the leases that have expired '''
+        now = time.time() if now is None else now
+        with self.lock:
+            expired = []
+            for grant_id in self.wheel.advance(now):
+                lease = self.leases.get(grant_id)
+                # Freed or renewed since the timer was set
+                if lease is None or lease.expires_at > now:
+                    continue
+                expired.append(self.leases.pop(grant_id))
+            return expired
+
+
+# Leases of the server process
+_leases = None
+
+
+def setup(duration: int):
+    ''' Creates the lease table of this process '''
+    global _leases
+    _leases = LeaseTable(duration)
+    return _leases
+
+
+def get_leases():
+    return _leases
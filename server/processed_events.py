@@ -0,0 +1,94 @@
+''' Ledger of the contract logs already handled by the server.
+
+Logs are identified by (transaction hash, log index). Keeping them in a set backed
+by a table with that unique key makes a log re-delivered by the node, or replayed
+after a restart, cost a lookup instead of a second charge or reservation.
+
+Every handler inserts the rows of its logs in the same database transaction as
+its own work, and only sends its transactions to the contract once it has been
+committed '''
+
+from web3 import Web3
+
+
+def event_key(entry):
+    ''' Unique key of a decoded log entry '''
+    return (Web3.toHex(entry['transactionHash']), int(entry['logIndex']))
+
+
+class ProcessedEvents:
+    ''' In-memory set of processed logs persisted in the processed_events table '''
+
+    def __init__(self, get_connection):
+        self.get_connection = get_connection
+        # Set of (tx_hash, log_index)
+        self.processed = set()
+
+    def load(self, fromBlock=0):
+        ''' Loads the keys of the logs processed since the given block.
+        Older logs can not be delivered again by the event pump so they are not needed '''
+        connection = self.get_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT tx_hash, log_index FROM processed_events WHERE block_number >= {}"
+                           .format(int(fromBlock)))
+            self.processed = {(tx_hash, int(index))
+                              for tx_hash, index in cursor.fetchall()}
+            print('Loaded {} processed events'.format(len(self.processed)))
+        finally:
+            cursor.close()
+            connection.close()
+
+    def __contains__(self, entry):
+        return event_key(entry) in self.processed
+
+    def filter_new(self, entries):
+        ''' Returns the entries that have not been processed yet,
+        dropping also the duplicates inside the batch '''
+        new_entries = []
+        keys = set()
+        for entry in entries:
+            key = event_key(entry)
+            if key not in self.processed and key not in keys:
+                keys.add(key)
+                new_entries.append(entry)
+        return new_entries
+
+    def record(self, cursor, entries, handler: str):
+        ''' Inserts the entries in the processed_events table with the cursor of their
+        handler, so they are committed - or rolled back - together with its work.
+        remember() must be called once the transaction is committed '''
+        if len(entries) == 0:
+            return
+
+        cursor.executemany('''
+            INSERT IGNORE INTO processed_events(tx_hash, log_index, block_number, handler)
+            VALUES (%s, %s, %s, %s)''',
+            [event_key(entry) + (int(entry['blockNumber']), handler) for entry in entries])
+
+    def remember(self, entries):
+        ''' Adds the entries of a committed transaction to the processed set '''
+        self.processed.update(event_key(entry) for entry in entries)
+
+    def forget(self, cursor, entries):
+        ''' Deletes the entries with the cursor of their handler, so they are
+        handled again when the pump retries them '''
+        keys = [event_key(entry) for entry in entries]
+        cursor.executemany(
+            "DELETE FROM processed_events WHERE tx_hash = %s AND log_index = %s", keys)
+        self.processed.difference_update(keys)
+
+
+# Ledger of the server process
+_ledger = None
+
+
+def setup(get_connection):
+    ''' Creates the ledger of this process '''
+    global _ledger
+    _ledger = ProcessedEvents(get_connection)
+    return _ledger
+
+
+def get_ledger():
+    return _ledger
@@ -0,0 +1,56 @@
+''' Ledger of the resources available in the server.
+
+Every resource lives in one slot of a single shared-memory array protected by
+a single lock, so a reservation of several resources at once is atomic: either
+all of them are reserved or none is '''
+
+from multiprocessing import Array, Lock
+
+
+class ResourceLedger:
+    ''' Available amount of every resource, indexed by the Resource enum.
+
+    Resources are identified by their value so members of the same enum
+    imported through different modules are treated as the same resource '''
+
+    def __init__(self, totals: dict):
+        # Slot of every resource in the array, of the shape { resource value : index }
+        self.slots = {resource.value: index for index, resource in enumerate(totals)}
+        self.totals = {resource.value: int(total) for resource, total in totals.items()}
+
+        self.available = Array('q', [int(total) for total in totals.values()], lock=False)
+        self.lock = Lock()
+
+    def available_of(self, resource):
+        ''' Amount of the resource currently available '''
+        with self.lock:
+            return self.available[self.slots[resource.value]]
+
+    def total_of(self, resource):
+        return self.totals[resource.value]
+
+    def reserve(self, amounts: dict):
+        ''' Atomically reserves the given amounts, of the shape { resource : amount }.
+        Returns True if all of them were available and have been reserved '''
+        with self.lock:
+            for resource, amount in amounts.items():
+                if self.available[self.slots[resource.value]] - amount < 0:
+                    return False
+            for resource, amount in amounts.items():
+                self.available[self.slots[resource.value]] -= amount
+            return True
+
+    def release(self, amounts: dict):
+        ''' Returns the given amounts to the ledger '''
+        with self.lock:
+            for resource, amount in amounts.items():
+                self.available[self.slots[resource.value]] += amount
+
+    def set_available(self, resource, amount: int):
+        with self.lock:
+            self.available[self.slots[resource.value]] = amount
+
+    def snapshot(self):
+        ''' Available amount of every resource, of the shape { resource value : amount } '''
+        with self.lock:
+            return {value: self.available[index] for value, index in self.slots.items()}
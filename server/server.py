@@ -1,7 +1,7 @@
 """ Basic server class """
 
-from web3 import Web3, HTTPProvider
-from multiprocessing import Process, Value, Lock
+from web3 import Web3
+from multiprocessing import Value, Lock
 from multiprocessing.connection import Listener
 import schedule
 import event_listeners
@@ -14,7 +14,18 @@ import os
 import time
 import sys
 
+# Modules shared by the clients and the server
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
 import initialization
+import tx_submitter
+import client_cache
+import settlement
+import leases
+import warm_start
+import providers
+from resource_ledger import ResourceLedger
+from checkpoints import CheckpointStore
 
 
 class Resource(Enum):
@@ -61,31 +72,88 @@ class BlockchainServer:
     # Pricing constants
     ETA = 1
 
+    # Seconds between settlement rounds of the pending charges
+    SETTLEMENT_INTERVAL = 30
+
+    # Seconds a grant lasts unless its client renews it, None for grants without lease.
+    # The clients do not renew their grants on their own, so leases are off by default
+    LEASE_DURATION = None
+    # Seconds between reclaims of the expired leases
+    RECLAIM_INTERVAL = 5
+
+    # Snapshot of the resource ledger left by a clean shutdown
+    LEDGER_SNAPSHOT_FILE = os.path.dirname(os.path.abspath(__file__)) + '/ledger_snapshot.json'
+
+    # Tables whose rows belong to the deployed contract, emptied when a new one is deployed.
+    # The leases are the expiry times of the allocations
+    CONTRACT_TABLES = ('storage_allocations', 'cpu_allocations', 'bandwidth_allocations',
+                       'memory_allocations', 'pending_charges', 'processed_events')
+
+    # Node of the blockchain: an http(s) or ws(s) URI, or the path of its IPC
+    # socket if it runs in the same host
+    NODE_URI = providers.NODE_URI
+
     # Server listening port
     LISTENING_PORT = 12000  # Listening port for connections
 
-    def __init__(self):
-
-        self.w3 = Web3(HTTPProvider("http://localhost:8545"))
+    # Columns added to the tables after they were first created, of the shape
+    # (table, column, ALTER TABLE clause). CREATE TABLE IF NOT EXISTS does not
+    # add them to the tables of an existing database
+    COLUMN_MIGRATIONS = [
+        ('clients', 'credit_updated_at',
+         'ADD COLUMN credit_updated_at timestamp default current_timestamp AFTER credit'),
+        # Charges pending from older versions are returned in the next settlement round
+        ('pending_charges', 'due_at',
+         'ADD COLUMN due_at timestamp default current_timestamp, ADD INDEX (due_at)'),
+    ] + [
+        # Grants of older versions have no lease
+        (table, 'expires_at', 'ADD COLUMN expires_at timestamp null default null, ADD INDEX (expires_at)')
+        for table in ('storage_allocations', 'cpu_allocations', 'bandwidth_allocations', 'memory_allocations')
+    ]
+
+    def __init__(self, deploy: bool = False):
+
+        self.w3 = Web3(providers.make_provider(self.NODE_URI))
 
         # Initialize database
         self._initialize_database()
 
+        # Load the clients in the in-memory cache, which writes them back
+        # to the database in batches
+        client_cache.setup(_getConnection)
+
         # Setup the default account
         self.account = self.w3.eth.accounts[0]
         self.w3.eth.defaultAccount = self.account
 
-        # Deploy contract and get back the python interface
-        # for interacting with it
-        self.contract = initialization.deploy_contracts(
-            w3=self.w3,
-            account=self.account,
-            total_storage=self.TOTAL_STORAGE)
+        # Deploy a new contract only if asked to. The grants, charges and
+        # checkpoints of the event handlers belong to the old one, so they are dropped
+        if deploy:
+            initialization.deploy_contracts(
+                w3=self.w3,
+                account=self.account,
+                total_storage=self.TOTAL_STORAGE)
+            self._clear_contract_state()
+            CheckpointStore(_getConnection).clear()
+
+        # Attach to the registered contract and get back the python
+        # interface for interacting with it
+        self.contract, self.deployment_block = initialization.attach_contract(self.w3)
+
+        # Pending charges ordered by the time they have to be returned
+        settlement.setup(_getConnection, self.contract, self.ETA)
+
+        # Leases of the grants, reclaimed when their clients stop renewing them
+        leases.setup(self.LEASE_DURATION).load(_getConnection, {
+            resource: spec.table for resource, spec in event_listeners.RESOURCES.items()})
 
         # Connections with the multiple sniffers.
         # They are organized as (ip_address, port) : connection
         self.connections = {}
 
+        # Resource ledger, created when the server starts serving
+        self.ledger = None
+
     def serve_forever(self):
         """ Serve until excplicit shutdown 
 
@@ -95,43 +163,19 @@ class BlockchainServer:
 
         """
         # Creation of shared memory objects
-        # 1) CPU
-        available_cpu = Value('i', self.TOTAL_CPU)
-        cpu_lock = Lock()
-        # 2) STORAGE
-        available_storage = Value('i', self.TOTAL_STORAGE)
-        st_lock = Lock()
-        # 3) BANDWIDTH
-        available_bandwidth = Value('i', self.TOTAL_BANDWIDTH)
-        bw_lock = Lock()
-        # 4) MEMORY
-        available_memory = Value('i', self.TOTAL_MEMORY)
-        mem_lock = Lock()
-
-        # Creation of processes
-        register_process = Process(
-            target=event_listeners.register_listerner, args=(self.w3, self.contract, ))
-        register_process.start()
-
-        transfer_process = Process(
-            target=event_listeners.transfer_listener, args=(self.contract,))
-        transfer_process.start()
-
-        storage_process = Process(
-            target=event_listeners.storage_allocator, args=(self.contract, available_storage, st_lock))
-        storage_process.start()
-
-        free_storage_process = Process(
-            target=event_listeners.free_storage_listener, args=(self.contract, available_storage, st_lock))
-        free_storage_process.start()
-
-        cpu_process = Process(
-            target=event_listeners.cpu_allocator, args=(self.contract, available_cpu, cpu_lock))
-        cpu_process.start()
-
-        free_cpu_process = Process(
-            target=event_listeners.free_cpu_listener,  args=(self.contract, available_cpu, cpu_lock))
-        free_cpu_process.start()
+        # 1) RESOURCES, all of them in a single ledger
+        ledger = self.ledger = self._create_resource_ledger()
+        # 2) OWNER NONCE, shared by every transaction sent by the server
+        nonce = Value('q', -1)
+        nonce_lock = Lock()
+        tx_submitter.setup(self.w3, self.account, nonce, nonce_lock)
+
+        # Creation of the event pump. A single thread pulls the logs of all the
+        # contract events and dispatches them to their handlers. It runs in this
+        # process so it shares the client cache with the rest of the server
+        pump = event_listeners.build_event_pump(
+            self.w3, self.contract, ledger, fromBlock=self.deployment_block)
+        threading.Thread(target=pump.run_forever, daemon=True).start()
 
         # Start connection listening threaad
         threading.Thread(
@@ -139,13 +183,38 @@ class BlockchainServer:
 
         # Schedule the update sending
         schedule.every(40).seconds.do(self._send_updated_info)
-        schedule.every(3).minutes.do(self._review_pending_charges)
+        schedule.every(self.SETTLEMENT_INTERVAL).seconds.do(self._review_pending_charges)
+        schedule.every(self.RECLAIM_INTERVAL).seconds.do(self._reclaim_expired_leases, ledger)
 
         # Infinite loop
         while True:
             schedule.run_pending()
             time.sleep(5)
 
+    def _create_resource_ledger(self):
+        """ Creates the ledger with the total amount of every resource, minus what
+        is still allocated from previous runs. The allocations are checked against
+        the contract before anything is granted """
+        ledger = ResourceLedger({
+            Resource.computing_power: self.TOTAL_CPU,
+            Resource.storage: self.TOTAL_STORAGE,
+            Resource.bandwidth: self.TOTAL_BANDWIDTH,
+            Resource.memory: self.TOTAL_MEMORY})
+
+        specs = {resource: spec for resource, spec in event_listeners.RESOURCES.items()}
+        warm_start.restore(ledger, _getConnection,
+                           {resource: spec.table for resource, spec in specs.items()},
+                           self.LEDGER_SNAPSHOT_FILE)
+
+        accounts = [client.account for client in client_cache.get_cache().all()]
+        warm_start.check_contract(self.contract, ledger, _getConnection, specs, accounts)
+        return ledger
+
+    def shutdown(self):
+        """ Leaves a snapshot of the ledger for the next start """
+        if self.ledger is not None:
+            warm_start.save_snapshot(self.ledger, self.LEDGER_SNAPSHOT_FILE)
+
     def _wait_for_reports(self, connection):
         """ Server thread that listens for reports """
 
@@ -153,116 +222,70 @@ class BlockchainServer:
         while True:
             report = connection.recv()
             print('Received report from sniffer', report)
-
-            # Here update credit based on behavior
-
-            # Get current registered devices
-            try:
-                db_conn = _getConnection()
-                cursor = db_conn.cursor()
-                cursor.execute(
-                    "Select account_address, mac_address, credit from clients")
-                current_clients = cursor.fetchall()
-
-                # Update credit and balances of all the clients
-                for client in current_clients:
-                    # Extract parameters from the client
-                    account_address, mac_address, credit = client
-                    credit = int(credit)
-                    print('Client data: {}, {}, {}'.format(
-                        account_address, mac_address, credit))
-
-                    # check if it is reported and if it is calculate the credit reduction
-                    if mac_address in report.keys() and report[mac_address] != 0:
-                        # Discount 5 credit for every suspicious behavior
-                        penalty = 5*int(report[mac_address])
-                        print('Penalty for {} is {}'.format(
-                            mac_address, penalty))
-
-                        new_credit = credit - penalty
-                        # If the credit is less than 0 or 0 we have to clock the client
-                        if new_credit <= 0:
-                            new_credit = 0
-                            print('Credit has been exhausted, blocking client')
-                            # Block the client in the contract
-                            self.contract.functions.freezeAccount(
-                                account_address, True).transact()
-                            # Block the client in the database
-                            cursor.execute("UPDATE clients SET isBlocked = {} WHERE account_address = '{}'"
-                                           .format(True, account_address))
-
-                        # Update the credit
-                        cursor.execute("UPDATE clients SET credit = {} WHERE account_address = '{}'"
-                                       .format(new_credit, account_address))
-                        print('New credit =', new_credit)
-                        db_conn.commit()
-
-                    else:
-                        # If it has not commited any irregular behavior we update his credit and balance
-                        # If credit is at its max we don't update it
-                        if credit != 100:
-                            credit += 1
-                            print(
-                                "Increased credit for {} -> {}".format(account_address, credit))
-                            cursor.execute("UPDATE clients SET credit = {} where account_address = '{}'"
-                                           .format(credit, account_address))
-                            db_conn.commit()
-
-                cursor.close()
-                db_conn.close()
-
-            except mysql.connector.Error as error:
-                db_conn.rollback()
-                print('Error while updating credits: {}'.format(error))
+            self._process_report(report)
+
+    def _process_report(self, report: dict):
+        """ Updates the credit of the clients based on the behavior
+        reported by a sniffer.
+
+        Only the reported clients are touched: the credit of the rest recovers
+        with time and is computed when it is read (see client_cache.recovered_credit).
+        The penalties are written by the next flush of the client cache and the
+        exhausted accounts are frozen with a single transaction """
+
+        cache = client_cache.get_cache()
+        now = time.time()
+
+        # New credit of the penalised clients, of the shape { account : credit }
+        penalties = {}
+        # Clients whose credit has been exhausted
+        frozen = set()
+
+        for mac_address, behaviors in report.items():
+            client = cache.by_mac(mac_address)
+            # Only reported clients get a penalty
+            if client is None or behaviors == 0:
+                continue
+
+            # Discount 5 credit for every suspicious behavior
+            penalty = 5*int(behaviors)
+            new_credit = cache.credit(client.account, now) - penalty
+            print('Penalty for {} is {}, new credit = {}'.format(
+                mac_address, penalty, max(new_credit, 0)))
+
+            # If the credit is less than 0 or 0 we have to block the client
+            if new_credit <= 0:
+                new_credit = 0
+                print('Credit has been exhausted, blocking client')
+                frozen.add(client.account)
+
+            penalties[client.account] = new_credit
+
+        if len(penalties) == 0:
+            return
+
+        # The penalised clients get their new credit, recovering from now on. It goes
+        # through the cache, the only writer of the credits and blocks, so a flush in
+        # progress never overwrites it
+        cache.set_credits(penalties, now, frozen)
+
+        # Block all the exhausted clients in the contract at once
+        if len(frozen) != 0:
+            tx_submitter.submit(self.contract.functions.freezeAccounts(
+                list(frozen), True))
 
     def _review_pending_charges(self):
-
+        """ Returns the pending charges that are due to the clients """
         print('Reviewing pending charges')
-        try:
-            connection = _getConnection()
-            cursor = connection.cursor()
-
-            cursor.execute("select * from pending_charges")
-            pending_charges = cursor.fetchall()
-
-            for charge in pending_charges:
-                res_id, account, amount = charge
-                cursor.execute(
-                    "Select credit from clients where account_address = '{}'".format(account))
-                results = cursor.fetchall()
-                credit = int(results[0][0])
-                # Update balance in db and contract
-                cursor.execute("UPDATE clients set coin_balance = coin_balance + {} where account_address = '{}'"
-                               .format(int(amount)+credit*self.ETA, account))
-                self.contract.functions.updateBalance(
-                    account,
-                    int(amount)+credit*self.ETA,
-                    True
-                ).transact()
-                print('Updated balance of client {}, {}'.format(
-                    account, int(amount)+credit*self.ETA))
-
-                # Delete that charge
-                cursor.execute("DELETE from pending_charges where id = '{}'"
-                               .format(res_id))
-                print('Deleted reservation entry')
-
-                connection.commit()
-
-            cursor.close()
-            connection.close()
-
-        except mysql.connector.Error as e:
-            connection.rollback()
-            print("An error ocurred: {}".format(e))
+        settlement.get_engine().settle()
+
+    def _reclaim_expired_leases(self, ledger: ResourceLedger):
+        """ Takes back the resources of the grants whose lease has expired """
+        event_listeners.reclaim_expired_leases(self.contract, ledger)
 
     def _send_updated_info(self):
         """ Sends updated info to the packet sniffer """
-        db_conn = _getConnection()
-        cursor = db_conn.cursor(dictionary=True)
-        cursor.execute(
-            "Select account_address, ip_address, mac_address, isBlocked from clients")
-        results = cursor.fetchall()
+        results = self._get_clients_info()
 
         for address, connection in self.connections.copy().items():
             try:
@@ -274,8 +297,9 @@ class BlockchainServer:
 
         #print('Connection dictionary:', self.connections)
 
-        cursor.close()
-        db_conn.close()
+    def _get_clients_info(self):
+        """ Returns the info of the clients the packet sniffers need """
+        return [client.as_sniffer_info() for client in client_cache.get_cache().all()]
 
     def _sniffer_connection_listener(self):
         """ Thread listening for new connection requests and 
@@ -299,11 +323,38 @@ class BlockchainServer:
 
         # Execute the commands for initializing the database
         self._execute_mysql_script(cursor)
+        self._migrate_database(cursor)
 
         conn.commit()
         cursor.close()
         conn.close()
 
+    def _clear_contract_state(self):
+        ''' Deletes the allocations, pending charges and processed events of the previous
+        contract, together with the ledger snapshot. The clients are kept, they register
+        again in the new contract '''
+        conn = _getConnection()
+        cursor = conn.cursor()
+        for table in self.CONTRACT_TABLES:
+            cursor.execute('DELETE FROM {}'.format(table))
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+        if os.path.exists(self.LEDGER_SNAPSHOT_FILE):
+            os.remove(self.LEDGER_SNAPSHOT_FILE)
+        print('Cleared the state of the previous contract')
+
+    def _migrate_database(self, cur):
+        ''' Adds the columns missing in a database created by an older version of the server '''
+        for table, column, clause in self.COLUMN_MIGRATIONS:
+            cur.execute('''SELECT COUNT(*) FROM information_schema.columns
+                WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s''',
+                        (table, column))
+            if cur.fetchone()[0] == 0:
+                print('Adding column {} to table {}'.format(column, table))
+                cur.execute('ALTER TABLE {} {}'.format(table, clause))
+
     def _execute_mysql_script(self, cur):
         ''' Executes all the mysql commands in a sql file '''
 
@@ -318,65 +369,35 @@ class BlockchainServer:
                     print("Command skipped")
 
     @staticmethod
-    def calculate_price_of_request(resource_type: Resource, amount: int, value: Value, account: str):
+    def calculate_price_of_request(resource_type: Resource, amount: int, available: int, account: str):
         """ This method will calculate the price to apply a priori 
         for a particular request and return it so the client can be charged 
 
-        We don't need to wait for the lock since all the price calculations will be performed while
-        'holding' the lock """
-
-        credit = None
+        The credit is read from the client cache, so no database connection is needed.
+        The available amount is the one in the resource ledger before the reservation """
 
         # Get credit for the account
-        try:
-            connection = _getConnection()
-            cursor = connection.cursor()
-
-            cursor.execute(
-                "SELECT credit from clients where account_address = '{}'".format(account))
-            results = cursor.fetchall()
-            credit = int(results[0][0])
-            print('Credit of account {} is {}'.format(account, credit))
-
-        except mysql.connector.Error as error:
-            connection.rollback()
-            print('Failed getting new record into table: {}'.format(error))
-
-        finally:
-            cursor.close()
-            connection.close()
+        credit = client_cache.get_cache().credit(account)
+        print('Credit of account {} is {}'.format(account, credit))
 
-        if credit is None:
+        # Clients without credit can not be priced
+        if not credit:
             return None
 
-        # If asking for computing power
-        if resource_type == Resource.computing_power:
-            price = _f(Price.computing_power.value,
-                       amount, value.value, credit)
-            print('Price os reservation is', price, 'IoTokens')
-            return int(round(price))
-        # Asking for storage
-        elif resource_type == Resource.storage:
-            print('Price for all: {}, amount: {}, available: {}'.format(
-                Price.storage.value, amount, value.value))
-            price = _f(Price.storage.value, amount, value.value, credit)
-            return int(round(price))
-        # Asking for bandwidth
-        # elif resource_type == Resource.bandwidth:
-           # price = Price.bandwidth.value**(amount/value.value)
-            # return int(round(price))
-        # Asking for memory
-        # elif resource_type == Resource.memory:
-            #price = Price.memory.value**(amount/value.value)
-            # return int(round(price))
+        # Every resource uses the same formula with its own price
+        price = _f(Price[resource_type.name].value, amount, available, credit)
+        print('Price of reservation is', price, 'IoTokens')
+        return int(round(price))
 
 
 def main():
-    server = BlockchainServer()
+    # The contract is only deployed when explicitly asked to
+    server = BlockchainServer(deploy='--deploy' in sys.argv)
     time.sleep(5)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
+        server.shutdown()
         sys.exit(0)
 
 
@@ -8,16 +8,20 @@ CREATE TABLE IF NOT EXISTS clients(
 		priority int default 4,
 		coin_balance float,
 		credit int default 100 not null, -- the credit is initialized at 100
+		credit_updated_at timestamp default current_timestamp, -- credit recovers over time since then
 		isBlocked bool default false,
 		isRegistered bool default false
         );
 
--- Table to keep track of storage allocations
+-- Table to keep track of storage allocations.
+-- expires_at is the end of the lease of the grant, null if it has no lease
 CREATE TABLE IF NOT EXISTS storage_allocations(
     id varchar(100) primary key,
     account_address varchar(100) not null,
     amount int, 
-    Foreign Key (account_address) references clients(account_address)
+    expires_at timestamp null default null,
+    Foreign Key (account_address) references clients(account_address),
+    index(expires_at)
     );
 
 -- Table to keep track of cpu allocations
@@ -25,14 +29,55 @@ CREATE TABLE IF NOT EXISTS cpu_allocations(
     id varchar(100) primary key,
     account_address varchar(100) not null,
     amount int, 
-    Foreign Key (account_address) references clients(account_address)
+    expires_at timestamp null default null,
+    Foreign Key (account_address) references clients(account_address),
+    index(expires_at)
+    );
+
+-- Table to keep track of bandwidth allocations
+CREATE TABLE IF NOT EXISTS bandwidth_allocations(
+    id varchar(100) primary key,
+    account_address varchar(100) not null,
+    amount int, 
+    expires_at timestamp null default null,
+    Foreign Key (account_address) references clients(account_address),
+    index(expires_at)
+    );
+
+-- Table to keep track of memory allocations
+CREATE TABLE IF NOT EXISTS memory_allocations(
+    id varchar(100) primary key,
+    account_address varchar(100) not null,
+    amount int, 
+    expires_at timestamp null default null,
+    Foreign Key (account_address) references clients(account_address),
+    index(expires_at)
     );
 
 -- Table of the charges pending to return to the clients
 CREATE TABLE IF NOT EXISTS pending_charges(
     id varchar(100) primary key,
     account_address varchar(100),
-    charge int
+    charge int,
+    due_at timestamp default current_timestamp, -- when the charge is returned
+    index (due_at)
+);
+
+-- Last log fully processed by each one of the event handlers
+CREATE TABLE IF NOT EXISTS event_checkpoints(
+    handler varchar(100) primary key,
+    block_number bigint not null,
+    log_index int not null
+);
+
+-- Logs already handled by the server, used to make event handling idempotent
+CREATE TABLE IF NOT EXISTS processed_events(
+    tx_hash varchar(66) not null,
+    log_index int not null,
+    block_number bigint not null,
+    handler varchar(100),
+    primary key (tx_hash, log_index),
+    index (block_number)
 );
 
 /*delimiter //
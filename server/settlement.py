@@ -0,0 +1,152 @@
+''' Settlement of the charges pending to be returned to the clients.
+
+The charges are kept in a min-heap ordered by the time they are due, so every
+settlement round only looks at the charges that are actually due and settles all
+of them with one database transaction and one batched balance update on chain '''
+
+import heapq
+import threading
+import time
+import mysql.connector
+
+import client_cache
+import tx_submitter
+from view_cache import get_view_cache
+
+
+class SettlementEngine:
+    ''' Min-heap of pending charges of the shape (due_at, charge_id, account, amount) '''
+
+    # Seconds after which a charge is returned to the client
+    SETTLEMENT_DELAY = 3*60
+
+    def __init__(self, get_connection, contract, eta: int):
+        self.get_connection = get_connection
+        self.contract = contract
+        # Credit multiplier added to every returned charge
+        self.eta = eta
+
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def load(self):
+        ''' Loads the pending charges stored in the database '''
+        connection = self.get_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT id, account_address, charge, UNIX_TIMESTAMP(due_at) FROM pending_charges")
+            with self.lock:
+                self.heap = [(float(due_at), charge_id, account, int(amount))
+                             for charge_id, account, amount, due_at in cursor.fetchall()]
+                heapq.heapify(self.heap)
+            print('Loaded {} pending charges'.format(len(self.heap)))
+        finally:
+            cursor.close()
+            connection.close()
+
+    def due_time(self, now: float = None):
+        ''' Due time of a charge made now '''
+        return (time.time() if now is None else now) + self.SETTLEMENT_DELAY
+
+    def add(self, charge_id: str, account: str, amount: int, due_at: float):
+        ''' Adds a charge already stored in the pending_charges table '''
+        with self.lock:
+            heapq.heappush(self.heap, (due_at, charge_id, account, int(amount)))
+
+    def settle(self, now: float = None):
+        ''' Returns all the charges that are due. Returns the number of charges settled '''
+        now = time.time() if now is None else now
+
+        due = []
+        with self.lock:
+            while len(self.heap) != 0 and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+
+        if len(due) == 0:
+            return 0
+
+        # Amount returned to every account, the charges plus the credit bonus
+        cache = client_cache.get_cache()
+        refunds = {}
+        for _, _, account, amount in due:
+            credit = cache.credit(account) or 0
+            refunds[account] = refunds.get(account, 0) + amount + credit*self.eta
+
+        connection = None
+        try:
+            connection = self.get_connection()
+            cursor = connection.cursor()
+
+            cursor.execute("DELETE FROM pending_charges WHERE id IN ({})"
+                           .format(', '.join(['%s'] * len(due))), [charge[1] for charge in due])
+            connection.commit()
+
+        except mysql.connector.Error as error:
+            if connection is not None:
+                connection.rollback()
+            print('Error settling pending charges, retrying later: {}'.format(error))
+            # Retry them in the next round
+            self._push(due)
+            return 0
+
+        finally:
+            if connection is not None:
+                cursor.close()
+                connection.close()
+
+        # One transaction for all the accounts, sent once the charges are no longer
+        # pending so a failed commit can never refund them twice
+        try:
+            tx_submitter.submit(self.contract.functions.updateBalances(
+                list(refunds.keys()), list(refunds.values()), True))
+        except Exception as error:
+            # Whatever failed, the charges are no longer pending and have to be put back
+            print('Error sending the refunds, retrying later: {}'.format(error))
+            self._restore(due)
+            return 0
+
+        for account, refund in refunds.items():
+            cache.add_balance(account, refund)
+        get_view_cache(self.contract.web3, self.contract).invalidate(*refunds.keys())
+        print('Settled {} charges of {} clients'.format(len(due), len(refunds)))
+        return len(due)
+
+    def _push(self, charges: list):
+        with self.lock:
+            for charge in charges:
+                heapq.heappush(self.heap, charge)
+
+    def _restore(self, charges: list):
+        ''' Puts back charges whose refund could not be sent, in the database
+        and in the heap, so they are settled in the next round '''
+        try:
+            connection = self.get_connection()
+            cursor = connection.cursor()
+            cursor.executemany(
+                "INSERT IGNORE INTO pending_charges(id, account_address, charge, due_at) VALUES (%s, %s, %s, FROM_UNIXTIME(%s))",
+                [(charge_id, account, amount, due_at) for due_at, charge_id, account, amount in charges])
+            connection.commit()
+            cursor.close()
+            connection.close()
+
+        except mysql.connector.Error as error:
+            print('Error restoring pending charges: {}'.format(error))
+
+        self._push(charges)
+
+
+# Settlement engine of the server process
+_engine = None
+
+
+def setup(get_connection, contract, eta: int):
+    ''' Creates and loads the settlement engine of this process '''
+    global _engine
+    _engine = SettlementEngine(get_connection, contract, eta)
+    _engine.load()
+    return _engine
+
+
+def get_engine():
+    return _engine
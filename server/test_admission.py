@@ -0,0 +1,71 @@
+""" Tests of the admission scheduler. Run from this directory with python -m unittest test_admission """
+
+import unittest
+
+import admission
+from admission import Petition, GREEDY, KNAPSACK
+
+
+def petition(account: str, amount: int, price: int = 10, balance: int = 1000,
+             priority: int = 4, credit: int = 100):
+    return Petition(None, account, amount, price, balance, priority, credit)
+
+
+def accounts(admitted: list):
+    return [(p.account, p.amount) for p in admitted]
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def test_rank_by_priority_credit_and_amount(self):
+        petitions = [petition('a', 30, priority=4), petition('b', 20, priority=1),
+                     petition('c', 10, priority=4, credit=50), petition('d', 5, priority=4)]
+        self.assertEqual(accounts(admission.rank(petitions)),
+                         [('b', 20), ('d', 5), ('a', 30), ('c', 10)])
+
+    def test_greedy_admits_in_rank_order_while_they_fit(self):
+        petitions = [petition('a', 60), petition('b', 50, priority=1), petition('c', 40)]
+        self.assertEqual(accounts(admission.admit(petitions, 100, GREEDY)),
+                         [('b', 50), ('c', 40)])
+
+    def test_knapsack_fills_the_capacity(self):
+        petitions = [petition('a', 60), petition('b', 40), petition('c', 25), petition('d', 35)]
+        admitted = admission.admit(petitions, 100, KNAPSACK)
+        self.assertEqual(sum(p.amount for p in admitted), 100)
+
+    def test_knapsack_serves_higher_priorities_first(self):
+        petitions = [petition('a', 90, priority=4), petition('b', 30, priority=1),
+                     petition('c', 70, priority=4)]
+        self.assertEqual(accounts(admission.admit(petitions, 100, KNAPSACK)),
+                         [('b', 30), ('c', 70)])
+
+    def test_unaffordable_petitions_are_rejected(self):
+        petitions = [petition('a', 10, price=50, balance=40), petition('b', 10)]
+        for policy in (GREEDY, KNAPSACK):
+            self.assertEqual(accounts(admission.admit(petitions, 100, policy)), [('b', 10)])
+
+    def test_knapsack_gives_unaffordable_capacity_to_lower_priorities(self):
+        # d can only pay for one of its petitions, the capacity of the other one
+        # must go to the next priority level
+        petitions = [petition('d', 30, price=10, balance=15, priority=1),
+                     petition('d', 30, price=10, balance=15, priority=1),
+                     petition('b', 50, priority=4), petition('c', 50, priority=4)]
+        for policy in (GREEDY, KNAPSACK):
+            admitted = admission.admit(petitions, 100, policy)
+            self.assertEqual(accounts(admitted), [('d', 30), ('b', 50)], policy)
+
+    def test_balance_counts_the_previous_levels(self):
+        petitions = [petition('a', 10, price=10, balance=25, priority=1),
+                     petition('a', 10, price=10, balance=25, priority=2),
+                     petition('a', 10, price=10, balance=25, priority=3)]
+        self.assertEqual(len(admission.admit(petitions, 100, KNAPSACK)), 2)
+
+    def test_large_capacities_use_greedy(self):
+        petitions = [petition('a', 600), petition('b', 500), petition('c', 500)]
+        capacity = admission.KNAPSACK_MAX_CAPACITY + 100
+        self.assertEqual(admission.admit(petitions, capacity, KNAPSACK),
+                         admission.admit(petitions, capacity, GREEDY))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+""" Tests of the timing wheel. Run from this directory with python -m unittest test_timing_wheel """
+
+import math
+import random
+import unittest
+
+from timing_wheel import TimingWheel
+
+
+class TimingWheelTest(unittest.TestCase):
+
+    def test_timer_fires_at_its_tick(self):
+        wheel = TimingWheel(100)
+        wheel.add('a', 103.5)
+        self.assertEqual(wheel.advance(103), [])
+        self.assertEqual(wheel.advance(103.9), [])
+        self.assertEqual(wheel.advance(104), ['a'])
+        self.assertEqual(wheel.advance(200), [])
+
+    def test_timers_already_due_fire_in_the_next_advance(self):
+        wheel = TimingWheel(100)
+        wheel.add('past', 50)
+        wheel.add('now', 100)
+        self.assertEqual(sorted(wheel.advance(100)), ['now', 'past'])
+
+    def test_timers_cascade_from_the_upper_wheels(self):
+        # Ticks of 4 and 16 slots away need the second and third wheels
+        wheel = TimingWheel(0, slots=4, levels=3)
+        wheel.add('level1', 9)
+        wheel.add('level2', 37)
+        self.assertTrue(any(wheel.wheels[1]) and any(wheel.wheels[2]))
+
+        self.assertEqual(wheel.advance(8), [])
+        self.assertEqual(wheel.advance(9), ['level1'])
+        self.assertEqual(wheel.advance(36), [])
+        self.assertEqual(wheel.advance(37), ['level2'])
+
+    def test_timers_beyond_the_wheels_wait_in_the_overflow(self):
+        wheel = TimingWheel(0, slots=4, levels=2)
+        wheel.add('far', 100)
+        self.assertEqual(len(wheel.overflow), 1)
+
+        self.assertEqual(wheel.advance(99), [])
+        self.assertEqual(wheel.overflow, [])
+        self.assertEqual(wheel.advance(100), ['far'])
+
+    def test_a_long_jump_fires_everything_due(self):
+        wheel = TimingWheel(0, slots=4, levels=2)
+        for key in range(50):
+            wheel.add(key, key * 7.5)
+        self.assertEqual(sorted(wheel.advance(200)), [key for key in range(50) if key * 7.5 <= 200])
+
+    def test_timers_fire_neither_early_nor_late(self):
+        rng = random.Random(1)
+        for slots, levels in ((4, 1), (4, 3), (8, 2), (64, 3)):
+            now = rng.uniform(0, 10**6)
+            wheel = TimingWheel(now, slots=slots, levels=levels)
+            pending = {}
+            for step in range(300):
+                for n in range(rng.randint(0, 3)):
+                    when = now + rng.choice([rng.uniform(-5, 5), rng.uniform(0, 100), rng.uniform(0, 50000)])
+                    pending[(step, n)] = when
+                    wheel.add((step, n), when)
+
+                now += rng.choice([0.3, 1, 7, 60, 500])
+                for key in wheel.advance(now):
+                    self.assertLessEqual(math.ceil(pending.pop(key)), now // 1)
+                for when in pending.values():
+                    self.assertGreater(math.ceil(when), now // 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+''' Hierarchical timing wheel.
+
+Timers are kept in a few wheels of slots of increasing granularity: the first wheel
+has one slot per tick, the second one slot per turn of the first one, and so on.
+Adding a timer is O(1) and advancing the clock only touches the slots of the ticks
+that have passed, so thousands of timers cost nothing while they are not due.
+Timers beyond the last wheel wait in an overflow list until they get close enough.
+
+Timers can not be cancelled, the owner of the keys has to ignore the ones that
+are no longer valid when they fire (lazy cancellation) '''
+
+import math
+
+
+class TimingWheel:
+
+    def __init__(self, start: float, tick: float = 1, slots: int = 64, levels: int = 3):
+        # Seconds of every tick of the first wheel
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+
+        # Last tick processed
+        self.current = int(start // tick)
+
+        # wheels[level][slot] = [(key, expiry tick)]
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        # Timers too far in the future for the wheels
+        self.overflow = []
+        # Timers already due when they were added
+        self.due = []
+
+    def add(self, key, when: float):
+        ''' Adds a timer that fires at time when '''
+        self._insert(key, int(math.ceil(when / self.tick)))
+
+    def advance(self, now: float):
+        ''' Moves the clock up to now and returns the keys of the timers that fired '''
+        fired = [key for key, _ in self.due]
+        self.due = []
+
+        target = int(now // self.tick)
+        while self.current < target:
+            self.current += 1
+
+            # Every time a wheel completes a turn, the next slot of the wheel
+            # above is spread over the lower ones
+            for level in range(1, self.levels):
+                span = self.slots ** level
+                if self.current % span != 0:
+                    break
+                self._cascade(self.wheels[level], (self.current // span) % self.slots)
+            else:
+                if self.current % self.slots ** self.levels == 0:
+                    overflow, self.overflow = self.overflow, []
+                    for key, expiry in overflow:
+                        self._insert(key, expiry)
+
+            slot = self.wheels[0][self.current % self.slots]
+            fired.extend(key for key, _ in slot)
+            slot.clear()
+
+        # Anything that landed in the due list while cascading
+        fired.extend(key for key, _ in self.due)
+        self.due = []
+        return fired
+
+    def _cascade(self, wheel, index: int):
+        timers = wheel[index]
+        wheel[index] = []
+        for key, expiry in timers:
+            self._insert(key, expiry)
+
+    def _insert(self, key, expiry: int):
+        delta = expiry - self.current
+        if delta <= 0:
+            self.due.append((key, expiry))
+            return
+
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1):
+                self.wheels[level][(expiry // self.slots ** level) % self.slots].append((key, expiry))
+                return
+
+        self.overflow.append((key, expiry))
@@ -0,0 +1,139 @@
+''' Transaction submitter shared by all the components of the server.
+
+All the owner-only transactions are sent from the same account, so instead of letting
+every transact() ask the node for a nonce and wait for the previous transaction, the
+submitter keeps the owner's nonce locally (in shared memory, so every process of the
+server uses the same counter), sends transactions without waiting for them to be mined
+and reconciles the receipts - resolved by the shared receipt watcher - in a background
+thread, bumping the gas price of the transactions that get stuck '''
+
+import threading
+import time
+from multiprocessing import Value, Lock
+from web3 import Web3
+from receipt_watcher import get_watcher
+
+
+class TransactionSubmitter:
+    ''' Pipelines the transactions of a single account '''
+
+    # Seconds without receipt after which a transaction is considered stuck
+    RECEIPT_TIMEOUT = 60
+    # Replacement transactions need a gas price at least 10% higher
+    GAS_BUMP = 1.125
+    # Times a stuck transaction is resent before giving up
+    MAX_RETRIES = 5
+    # Seconds between receipt reconciliations
+    POLL_INTERVAL = 1
+
+    def __init__(self, w3: Web3, account: str, nonce: Value = None, lock: Lock = None):
+        self.w3 = w3
+        self.account = account
+
+        # Next nonce to use, -1 until it is read from the node
+        self.nonce = nonce if nonce is not None else Value('q', -1)
+        self.lock = lock if lock is not None else Lock()
+        self.receipts = get_watcher(w3)
+
+        # Transactions not mined yet, of the shape
+        # { tx_hash : (transaction, sent_at, retries, receipt future) }
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+        threading.Thread(target=self._reconcile_forever, daemon=True).start()
+
+    def submit(self, function_call, transaction: dict = None):
+        ''' Builds, signs with the next nonce and sends the contract function call.
+        Returns the transaction hash without waiting for it to be mined '''
+
+        transaction = dict(transaction or {})
+        transaction.setdefault('from', self.account)
+        transaction.setdefault('gasPrice', self.w3.eth.gasPrice)
+
+        with self.lock:
+            if self.nonce.value < 0:
+                self._sync_nonce()
+            transaction['nonce'] = self.nonce.value
+            built = function_call.buildTransaction(transaction)
+
+            try:
+                tx_hash = self.w3.eth.sendTransaction(built)
+            except ValueError as error:
+                # Someone else used our nonce, get it again from the node and retry
+                print('Error sending transaction, resyncing nonce: {}'.format(error))
+                self._sync_nonce()
+                built['nonce'] = self.nonce.value
+                tx_hash = self.w3.eth.sendTransaction(built)
+
+            self.nonce.value += 1
+
+        with self.pending_lock:
+            self.pending[tx_hash] = (built, time.time(), 0, self.receipts.watch(tx_hash))
+        return tx_hash
+
+    def _sync_nonce(self):
+        ''' Reads the nonce from the node, counting the transactions in the pool.
+        Must be called holding the lock '''
+        self.nonce.value = self.w3.eth.getTransactionCount(self.account, 'pending')
+
+    def _reconcile_forever(self):
+        while True:
+            try:
+                self._reconcile()
+            except Exception as error:
+                print('Error reconciling receipts: {}'.format(error))
+            time.sleep(self.POLL_INTERVAL)
+
+    def _reconcile(self):
+        ''' Checks the receipts of the pending transactions and resends the stuck ones '''
+        with self.pending_lock:
+            pending = list(self.pending.items())
+
+        for tx_hash, (transaction, sent_at, retries, future) in pending:
+
+            if future.done():
+                receipt = future.result()
+                if receipt.get('status') == 0:
+                    print('Transaction {} reverted'.format(Web3.toHex(tx_hash)))
+                with self.pending_lock:
+                    self.pending.pop(tx_hash, None)
+
+            elif time.time() - sent_at > self.RECEIPT_TIMEOUT:
+                with self.pending_lock:
+                    self.pending.pop(tx_hash, None)
+                self.receipts.forget(tx_hash)
+
+                if retries >= self.MAX_RETRIES:
+                    print('Giving up on transaction {}'.format(Web3.toHex(tx_hash)))
+                    continue
+
+                # Same nonce with a higher gas price replaces the stuck transaction
+                transaction = dict(transaction)
+                transaction['gasPrice'] = int(transaction['gasPrice'] * self.GAS_BUMP) + 1
+                try:
+                    new_hash = self.w3.eth.sendTransaction(transaction)
+                    print('Resent stuck transaction {} as {}'.format(
+                        Web3.toHex(tx_hash), Web3.toHex(new_hash)))
+                    with self.pending_lock:
+                        self.pending[new_hash] = (transaction, time.time(), retries + 1,
+                                                  self.receipts.watch(new_hash))
+                except ValueError as error:
+                    # The original transaction was mined in the meantime
+                    print('Could not resend transaction: {}'.format(error))
+
+
+# Submitter of the current process
+_submitter = None
+
+
+def setup(w3: Web3, account: str, nonce: Value = None, lock: Lock = None):
+    ''' Creates the submitter of this process. Processes sharing the nonce
+    value and its lock share the same nonce sequence '''
+    global _submitter
+    _submitter = TransactionSubmitter(w3, account, nonce, lock)
+    return _submitter
+
+
+def submit(function_call, transaction: dict = None):
+    ''' Sends a contract function call through the submitter of this process '''
+    return _submitter.submit(function_call, transaction)
@@ -0,0 +1,129 @@
+''' Rebuilds the state of the resource ledger when the server starts.
+
+The amounts available are the totals minus what is still allocated in the database,
+computed with a single aggregate query. If the server was shut down cleanly it leaves
+a snapshot of the ledger, which is used instead and deleted, so it is never trusted
+after a crash.
+
+Before the server starts granting, the amount available of every resource is
+compared with the one of the contract, all of them read with a single batch. Only the
+resources where they disagree are checked account by account against the resource
+mappings of the contract. Their amounts available become the totals minus, account
+by account, the larger of what the database and the contract have in use, so the
+server never grants more than the contract has '''
+
+import json
+import os
+from providers import batch_view_calls
+
+
+def restore(ledger, get_connection, tables: dict, snapshot_file: str = None):
+    ''' Sets the amounts available of the ledger. tables is of the shape { resource : table } '''
+
+    snapshot = load_snapshot(snapshot_file) if snapshot_file is not None else None
+    if snapshot is not None and snapshot['totals'] == _keys_to_str(ledger.totals):
+        for resource in tables:
+            ledger.set_available(resource, snapshot['available'][str(resource.value)])
+        print('Restored ledger from snapshot:', ledger.snapshot())
+        return
+
+    allocated = allocated_amounts(get_connection, tables)
+    for resource in tables:
+        ledger.set_available(resource, ledger.total_of(resource) - allocated[resource])
+    print('Restored ledger from the allocations:', ledger.snapshot())
+
+
+def allocated_amounts(get_connection, tables: dict):
+    ''' Total amount allocated of every resource, of the shape { resource : amount } '''
+    resources = list(tables)
+    connection = get_connection()
+    cursor = connection.cursor()
+    try:
+        cursor.execute(' UNION ALL '.join(
+            'SELECT {}, COALESCE(SUM(amount), 0) FROM {}'.format(index, tables[resource])
+            for index, resource in enumerate(resources)))
+        return {resources[int(index)]: int(amount) for index, amount in cursor.fetchall()}
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def save_snapshot(ledger, snapshot_file: str):
+    ''' Writes the ledger to the snapshot file, to be used in the next start '''
+    temporary = snapshot_file + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump({'totals': _keys_to_str(ledger.totals),
+                   'available': _keys_to_str(ledger.snapshot())}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, snapshot_file)
+    print('Saved ledger snapshot in', snapshot_file)
+
+
+def load_snapshot(snapshot_file: str):
+    ''' Reads and deletes the snapshot file. Returns None if there is none '''
+    try:
+        with open(snapshot_file) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    finally:
+        if os.path.exists(snapshot_file):
+            os.remove(snapshot_file)
+    return snapshot
+
+
+def check_contract(contract, ledger, get_connection, specs: dict, accounts: list):
+    ''' Compares the amounts available of the ledger with the ones of the contract,
+    specs being of the shape { resource : ResourceSpec }. The allocations of the resources
+    that disagree are compared with the resource mappings of the contract for the given
+    clients, printing every mismatch, and their amounts available are set to the totals
+    minus what is in use. It must run before the server starts granting '''
+
+    in_contract = batch_view_calls(contract.web3, contract,
+                                   [(spec.available_variable, ()) for spec in specs.values()])
+    mismatched = {}
+    for (resource, spec), available in zip(specs.items(), in_contract):
+        if available == ledger.available_of(resource):
+            print('{} available agrees with the contract: {} {}'.format(spec.name, available, spec.unit))
+        else:
+            print('{} available: {} {} in the ledger, {} {} in the contract'.format(
+                spec.name, ledger.available_of(resource), spec.unit, available, spec.unit))
+            mismatched[resource] = spec
+
+    if len(mismatched) == 0:
+        return
+
+    connection = get_connection()
+    cursor = connection.cursor()
+    try:
+        for resource, spec in mismatched.items():
+            cursor.execute('SELECT account_address, SUM(amount) FROM {} GROUP BY account_address'
+                           .format(spec.table))
+            allocated = {account: int(amount) for account, amount in cursor.fetchall()}
+
+            in_use = 0
+            mismatches = 0
+            # All the use mappings are read with a single batch
+            checked = list(set(accounts) | set(allocated))
+            uses = batch_view_calls(contract.web3, contract,
+                                    [(spec.use_mapping, (account,)) for account in checked])
+            for account, in_contract in zip(checked, uses):
+                in_database = allocated.get(account, 0)
+                if in_contract != in_database:
+                    mismatches += 1
+                    print('{} of {}: {} {} in the database, {} {} in the contract'.format(
+                        spec.name, account, in_database, spec.unit, in_contract, spec.unit))
+                in_use += max(in_contract, in_database)
+
+            ledger.set_available(resource, max(ledger.total_of(resource) - in_use, 0))
+            print('Checked {} allocations against the contract: {} mismatches'.format(
+                spec.name, mismatches))
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def _keys_to_str(amounts: dict):
+    # JSON objects only have string keys
+    return {str(key): amount for key, amount in amounts.items()}